@@ -0,0 +1,60 @@
+#!/usr/bin/env python2.7
+"""
+Throughput of get_counters against the previous regex loop on large pages.
+
+Usage: ./benchmark_counters.py [repeat]
+"""
+import os
+import random
+import re
+import sys
+import timeit
+
+source_dir = os.path.join(os.path.dirname(__file__), 'source')
+sys.path.insert(0, source_dir)
+
+from source.lib import COUNTER_TYPES, get_counters
+
+
+def get_counters_regex_loop(content):
+    """get_counters before the single-pass scanner"""
+    counters = []
+    for counter_name, regexp in COUNTER_TYPES:
+        if re.match(regexp, content):
+            counters.append(counter_name)
+    return counters
+
+
+def make_page(size, tail=''):
+    rnd = random.Random(size)
+    parts = [
+        '<div class="item">', 'lorem ipsum dolor sit amet ', '<a href="http://example.com/page">',
+        '<script src="/static/app.js"></script>', '\n', '<img src="//cdn.example.com/i.png">'
+    ]
+    body = []
+    length = 0
+    while length < size:
+        part = rnd.choice(parts)
+        body.append(part)
+        length += len(part)
+    return '<html><head></head><body>' + ''.join(body) + tail + '</body></html>'
+
+
+def main(argv):
+    repeat = int(argv[1]) if len(argv) > 1 else 5
+    pages = (
+        ('1MB, no counters', make_page(1024 * 1024)),
+        ('1MB, counter at end', make_page(1024 * 1024, '<script src="//mc.yandex.ru/metrika/watch.js"></script>')),
+        ('10MB, no counters', make_page(10 * 1024 * 1024)),
+    )
+    print '{:<22} {:>14} {:>14} {:>8}'.format('page', 'regex MB/s', 'scanner MB/s', 'speedup')
+    for name, page in pages:
+        assert get_counters(page) == get_counters_regex_loop(page)
+        mb = len(page) / 1024.0 / 1024.0
+        old = min(timeit.repeat(lambda: get_counters_regex_loop(page), number=1, repeat=repeat))
+        new = min(timeit.repeat(lambda: get_counters(page), number=1, repeat=repeat))
+        print '{:<22} {:>14.1f} {:>14.1f} {:>7.1f}x'.format(name, mb / old, mb / new, old / new)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
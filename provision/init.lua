@@ -743,6 +743,49 @@ queue.urgent = function(space, tube, delayed, ...)
     return put_task(space, tube, ipri, delayed, ...)
 end
 
+-- take first ready task of the tube, nil if there is no one
+local function take_ready(space, tube)
+    local iterator = box.space[space].index[idx_tube]
+                            :iterator(box.index.EQ, tube, ST_READY)
+
+    for task in iterator do
+        local now = box.time64()
+        local created = box.unpack('l', task[i_created])
+        local ttr = box.unpack('l', task[i_ttr])
+        local ttl = box.unpack('l', task[i_ttl])
+        local event = now + ttr
+        if event > created + ttl then
+            event = created + ttl
+            -- tube started too late
+            if event <= now then
+                break
+            end
+        end
+
+
+        task = box.update(space,
+            task[i_uuid],
+                '=p=p=p+p',
+                i_status,
+                ST_TAKEN,
+
+                i_event,
+                event,
+
+                i_cid,
+                box.session.id(),
+
+                i_ctaken,
+                1
+        )
+
+        queue.workers[space][tube].ch:put(true, 0)
+        queue.consumers[space][tube]:put(true, 0)
+        queue.stat[space][tube]:inc('take')
+        return rettask(task)
+    end
+end
+
 -- queue.take(space, tube, timeout)
 -- take task for processing
 queue.take = function(space, tube, timeout)
@@ -762,44 +805,9 @@ queue.take = function(space, tube, timeout)
 
     while true do
 
-        local iterator = box.space[space].index[idx_tube]
-                                :iterator(box.index.EQ, tube, ST_READY)
-
-        for task in iterator do
-            local now = box.time64()
-            local created = box.unpack('l', task[i_created])
-            local ttr = box.unpack('l', task[i_ttr])
-            local ttl = box.unpack('l', task[i_ttl])
-            local event = now + ttr
-            if event > created + ttl then
-                event = created + ttl
-                -- tube started too late
-                if event <= now then
-                    break
-                end
-            end
-
-
-            task = box.update(space,
-                task[i_uuid],
-                    '=p=p=p+p',
-                    i_status,
-                    ST_TAKEN,
-
-                    i_event,
-                    event,
-
-                    i_cid,
-                    box.session.id(),
-
-                    i_ctaken,
-                    1
-            )
-
-            queue.workers[space][tube].ch:put(true, 0)
-            queue.consumers[space][tube]:put(true, 0)
-            queue.stat[space][tube]:inc('take')
-            return rettask(task)
+        local task = take_ready(space, tube)
+        if task ~= nil then
+            return task
         end
 
         if timeout > 0 then
@@ -816,6 +824,37 @@ queue.take = function(space, tube, timeout)
     end
 end
 
+-- queue.take_many(space, tube, count, timeout)
+-- take up to count tasks for processing in one call:
+-- waits for the first task like queue.take, then takes
+-- only tasks that are ready right now
+queue.take_many = function(space, tube, count, timeout)
+
+    space = tonumber(space)
+
+    if count == nil then
+        count = 1
+    else
+        count = tonumber(count)
+    end
+
+    local task = queue.take(space, tube, timeout)
+    if task == nil then
+        return
+    end
+
+    local tasks = { task }
+    while #tasks < count do
+        task = take_ready(space, tube)
+        if task == nil then
+            break
+        end
+        table.insert(tasks, task)
+    end
+
+    return unpack(tasks)
+end
+
 
 -- queue.delete(space, id)
 --  deletes task from queue
@@ -853,6 +892,61 @@ queue.ack = function(space, id)
 end
 
 
+-- ack taken task and put data into tube, see queue.ack_and_put
+local function ack_and_put_task(space, id, put_space, tube, delay, ttl, ttr, pri, data)
+    local task = box.select(space, idx_task, id)
+    if task == nil then
+        error('Task not found')
+    end
+
+    if task[i_status] ~= ST_TAKEN then
+        error('Task is not taken')
+    end
+
+    if box.unpack('i', task[i_cid]) ~= box.session.id() then
+        error('Only consumer that took the task can it ack')
+    end
+
+    -- empty pri: keep priority of the acked task
+    if pri == nil or pri == '' then
+        pri = max_pri - pri_unpack(task[i_pri]) - queue.default.pri
+    end
+
+    put_space = tonumber(put_space)
+    queue.stat[put_space][tube]:inc('put')
+    put_task(put_space, tube, queue.default.ipri, delay, ttl, ttr, pri, data)
+
+    queue.stat[space][ task[i_tube] ]:inc('ack')
+    box.delete(space, id)
+end
+
+-- queue.ack_and_put(space, id, put_space, tube, delay, ttl, ttr, pri, data, ...)
+--  ack taken task and put its result into (other) tube in one call
+--   arguments are groups of
+--      1. id - taken task
+--      2. put_space, tube, delay, ttl, ttr, pri - like in queue.put
+--         (empty pri - priority of the acked task)
+--      3. data - result task data
+--   returns ids of tasks that were acked, tasks that
+--   fail are left as they are
+queue.ack_and_put = function(space, ...)
+    space = tonumber(space)
+
+    local args = {...}
+    local acked = {}
+    for i = 1, #args, 8 do
+        local ok, err = pcall(ack_and_put_task, space, unpack(args, i, i + 7))
+        if ok then
+            table.insert(acked, args[i])
+        else
+            print("ack_and_put error for task ", args[i], ": ", err)
+        end
+    end
+
+    return unpack(acked)
+end
+
+
 -- queue.touch(space, id)
 --  prolong ttr for taken task
 queue.touch = function(space, id)
@@ -958,6 +1052,30 @@ queue.bury = function(space, id)
     return rettask(task)
 end
 
+-- queue.settle(space, action, id, ...)
+--  ack or bury taken tasks in one call
+--   arguments are pairs of action ('ack' or 'bury') and task id
+--   returns ids of tasks that were settled, tasks that
+--   fail are left as they are
+queue.settle = function(space, ...)
+    local args = {...}
+    local settled = {}
+    for i = 1, #args, 2 do
+        local action, id = args[i], args[i + 1]
+        local ok, err = false, 'Unknown action'
+        if action == 'ack' or action == 'bury' then
+            ok, err = pcall(queue[action], space, id)
+        end
+        if ok then
+            table.insert(settled, id)
+        else
+            print("settle error for task ", id, " (", action, "): ", err)
+        end
+    end
+
+    return unpack(settled)
+end
+
 -- queue.dig(space, id)
 --  dig(unbury) task
 queue.dig = function(space, id)
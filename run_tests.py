@@ -12,6 +12,20 @@ from source.tests.test_redirect_checker import RedirectCheckerTestCase
 from source.tests.lib.test_utils import UtilsTestCase
 from source.tests.lib.test_worker import WorkerTestCase
 from source.tests.lib.test_init import InitTestCase
+from source.tests.lib.test_engine import EngineTestCase
+from source.tests.lib.test_curl_pool import CurlPoolTestCase
+from source.tests.lib.test_hop_cache import HopCacheTestCase
+from source.tests.lib.test_scheduler import SchedulerTestCase
+from source.tests.lib.test_probe import ProbeTestCase
+from source.tests.lib.test_resolver import ResolverTestCase
+from source.tests.lib.test_gevent_curl import GeventCurlTestCase
+from source.tests.lib.test_health import HealthTestCase
+from source.tests.lib.test_autoscale import AutoscaleTestCase
+from source.tests.lib.test_queue_connection import QueueConnectionTestCase
+from source.tests.lib.test_breaker import BreakerTestCase
+from source.tests.lib.test_singleflight import SingleFlightTestCase
+from source.tests.lib.test_session_pool import SessionPoolTestCase
+from source.tests.lib.test_callback_lanes import CallbackLanesTestCase
 
 
 if __name__ == '__main__':
@@ -20,7 +34,21 @@ if __name__ == '__main__':
         unittest.makeSuite(RedirectCheckerTestCase),
         unittest.makeSuite(UtilsTestCase),
         unittest.makeSuite(WorkerTestCase),
-        unittest.makeSuite(InitTestCase)
+        unittest.makeSuite(InitTestCase),
+        unittest.makeSuite(EngineTestCase),
+        unittest.makeSuite(CurlPoolTestCase),
+        unittest.makeSuite(HopCacheTestCase),
+        unittest.makeSuite(SchedulerTestCase),
+        unittest.makeSuite(ProbeTestCase),
+        unittest.makeSuite(ResolverTestCase),
+        unittest.makeSuite(GeventCurlTestCase),
+        unittest.makeSuite(HealthTestCase),
+        unittest.makeSuite(AutoscaleTestCase),
+        unittest.makeSuite(QueueConnectionTestCase),
+        unittest.makeSuite(BreakerTestCase),
+        unittest.makeSuite(SingleFlightTestCase),
+        unittest.makeSuite(SessionPoolTestCase),
+        unittest.makeSuite(CallbackLanesTestCase)
     ))
     result = unittest.TextTestRunner().run(suite)
     sys.exit(not result.wasSuccessful())
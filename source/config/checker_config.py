@@ -12,17 +12,89 @@ OUTPUT_QUEUE_SPACE = 0
 
 OUTPUT_QUEUE_TUBE = 'url_redirect.queue'
 
+# число процессов-воркеров (None - по процессу на ядро, для режима gevent)
 WORKER_POOL_SIZE = 10
+# размер пула по очередям: от WORKER_POOL_MIN до WORKER_POOL_MAX воркеров, по воркеру на
+# AUTOSCALE_BACKLOG_PER_WORKER готовых задач; пул не растет при загрузке CPU от AUTOSCALE_MAX_CPU
+# и при AUTOSCALE_MAX_OUTPUT_BACKLOG готовых результатов, а уменьшается по воркеру, когда
+# не меньше AUTOSCALE_IDLE_TAKE_RATIO взятий из очереди уходят впустую (лишние воркеры доделывают задачи)
+WORKER_AUTOSCALE = True
+WORKER_POOL_MIN = 2
+WORKER_POOL_MAX = 40
+AUTOSCALE_BACKLOG_PER_WORKER = 200
+AUTOSCALE_IDLE_TAKE_RATIO = 0.5
+AUTOSCALE_MAX_CPU = 0.9
+AUTOSCALE_MAX_OUTPUT_BACKLOG = 100000
+# 'multi' - цепочки редиректов на одном CurlMulti воркера, 'gevent' - каждая задача в своем гринлете
+WORKER_MODE = 'multi'
+# воркеры форкаются из заранее подготовленного главного процесса, пул пополняется сразу
+# после выхода воркера, время запуска и память воркеров пишутся в лог
+WORKER_PREFORK = True
+# сколько цепочек редиректов (в режиме gevent - задач) один воркер проверяет одновременно (1 - по одной задаче)
+WORKER_MAX_IN_FLIGHT = 100
+# ограничения всех воркеров машины на запросы к одному хосту: одновременных и в секунду (None - без
+# ограничения); делятся поровну между воркерами обеих групп при наибольшем размере пула
+HOST_MAX_CONCURRENCY = 40
+HOST_MAX_RATE = 100
+# пул curl-хендлов воркера: сколько простаивающих хендлов держать и сколько секунд
+CURL_POOL_MAX_IDLE = 100
+CURL_POOL_IDLE_TIMEOUT = 60
+
+# общий для воркеров кэш переходов цепочек (None - выключен), время жизни записи в секундах
+HOP_CACHE_PATH = '/tmp/redirect_checker_hops.sqlite'
+HOP_CACHE_TTL = 3600
+HOP_CACHE_MAX_ENTRIES = 100000
+# кэш DNS воркера: время жизни адресов и неудач резолвинга в секундах, потоков резолвинга (0 - выключен)
+DNS_CACHE_TTL = 300
+DNS_CACHE_NEGATIVE_TTL = 30
+DNS_CACHE_MAX_ENTRIES = 10000
+DNS_RESOLVER_THREADS = 4
+# общий для воркеров выключатель хостов (None - выключен): после скольких ошибок подряд хост
+# выключается и на сколько секунд (время удваивается с каждой неудачной пробой до BREAKER_MAX_DELAY)
+BREAKER_PATH = '/tmp/redirect_checker_hosts.sqlite'
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_BASE_DELAY = 30
+BREAKER_MAX_DELAY = 3600
+# общее для воркеров совмещение проверок одного урла (None - выключено): сколько секунд ждать
+# проверяющего урл воркера, прежде чем проверить самим, и сколько держать готовый результат
+SINGLE_FLIGHT_PATH = '/tmp/redirect_checker_flights.sqlite'
+SINGLE_FLIGHT_LEASE = 30
+SINGLE_FLIGHT_LINGER = 5
 QUEUE_TAKE_TIMEOUT = 0.1
+# как часто воркер пишет в лог статистику своих кэшей и пулов, в секундах
+STATS_INTERVAL = 60
 
 SLEEP = 10
 
 HTTP_TIMEOUT = 3
+# таймаут установки соединения одного запроса (None - ограничен только HTTP_TIMEOUT)
+HTTP_CONNECT_TIMEOUT = 1
+# время на проверку всей цепочки редиректов, по истечении результат обрывается типом TIMEOUT
+TASK_TIMEOUT = 15
 MAX_REDIRECTS = 30
+# сколько байт тела ответа загружать не больше (None - без ограничения)
+MAX_BODY_BYTES = 1024 * 1024
+# поиск мета-редиректов: 'head' - быстрый разбор <head>, 'bs4' - полный разбор BeautifulSoup
+META_PARSER = 'head'
+# запрос переходов: 'head' - сначала HEAD, GET только если нужно тело страницы; 'get' - всегда GET
+HOP_PROBE = 'head'
 RECHECK_DELAY = 300
+# очередь перепроверок на сервере входной очереди (None - перепроверки возвращаются во входную очередь)
+# и проверяющая ее отдельная группа воркеров: размер группы, таймаут запроса и время на цепочку
+RECHECK_QUEUE_TUBE = 'url_recheck.queue'
+RECHECK_WORKER_POOL_SIZE = 2
+RECHECK_HTTP_TIMEOUT = 10
+RECHECK_TASK_TIMEOUT = 60
 USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/31.0.1650.63 Safari/537.36"
 
 CHECK_URL = "http://t.mail.ru"
+# фоновая проверка сети (None - CHECK_URL на каждой итерации, при недоступности воркеры останавливаются):
+# сеть есть, если отвечает хоть один урл; после NETWORK_FAIL_THRESHOLD неудачных проверок подряд
+# воркеры перестают брать задачи, после NETWORK_RECOVER_THRESHOLD успешных - продолжают
+NETWORK_CHECK_URLS = ("http://t.mail.ru", "http://mail.ru", "http://ya.ru")
+NETWORK_CHECK_INTERVAL = 5
+NETWORK_FAIL_THRESHOLD = 3
+NETWORK_RECOVER_THRESHOLD = 2
 
 LOGGING = {
     'version': 1,
@@ -8,6 +8,27 @@ QUEUE_TAKE_TIMEOUT = 0.1
 QUEUE_TUBE = 'api.push_notifications'
 
 HTTP_CONNECTION_TIMEOUT = 30
+# keep-alive соединения с хостами колбэков: не больше CALLBACK_MAX_CONNECTIONS на хост,
+# соединения хоста закрываются после CALLBACK_IDLE_TIMEOUT секунд без запросов
+CALLBACK_MAX_CONNECTIONS = 10
+CALLBACK_IDLE_TIMEOUT = 60
+# хосты колбэков, принимающие уведомления пачкой (JSON-массивом):
+# хост (с портом, если он указан в callback_url) -> (не больше уведомлений в пачке, секунд ожидания пачки), например
+# {'partner.example.com': (100, 0.5)}
+CALLBACK_BATCH_HOSTS = {}
+# квоты одновременных запросов: CALLBACK_HOST_QUOTA к хосту колбэка; к медленному
+# хосту (средняя длительность запроса от CALLBACK_SLOW_LATENCY секунд) -
+# CALLBACK_SLOW_HOST_QUOTA, ко всем медленным вместе - CALLBACK_SLOW_LANE_SIZE.
+# Задачи хоста с занятой квотой возвращаются в очередь на CALLBACK_DEFER_DELAY секунд
+CALLBACK_HOST_QUOTA = 5
+CALLBACK_SLOW_HOST_QUOTA = 1
+CALLBACK_SLOW_LANE_SIZE = 3
+CALLBACK_SLOW_LATENCY = 5
+CALLBACK_DEFER_DELAY = 5
+# обработанные задачи подтверждаются пачками: не больше ACK_BATCH_SIZE за запрос,
+# первая задача пачки ждет отправки не дольше ACK_FLUSH_INTERVAL секунд
+ACK_BATCH_SIZE = 100
+ACK_FLUSH_INTERVAL = 0.05
 SLEEP = 0.1
 SLEEP_ON_FAIL = 10
 
@@ -1,32 +1,59 @@
 # coding: utf-8
+from HTMLParser import HTMLParser
 from StringIO import StringIO
 from logging import getLogger, NullHandler
 import re
+from time import time
 from urllib import quote, quote_plus
 from urlparse import urljoin, urlsplit, urlparse, urlunparse
 
-from bs4 import BeautifulSoup
 import pycurl
 
+from curl_pool import get_curl_pool
+from resolver import get_dns_cache
+from scheduler import get_host
+
 logger = getLogger('redirect_checker')
 logger.addHandler(NullHandler())
 
 REDIRECT_META = 'meta_tag'
 REDIRECT_HTTP = 'http_status'
+REDIRECT_ERROR = 'ERROR'
+# цепочка не пройдена до конца за отведенное задаче время
+REDIRECT_TIMEOUT = 'TIMEOUT'
 
 OK_REDIRECT = re.compile(r'http://(www\.)?odnoklassniki\.ru/.*st\.redirect', re.I)
 OK_URL = re.compile(r'http(?:s)?://(www\.)?odnoklassniki\.ru/', re.I)
 MM_URL = re.compile(r'http(?:s)?://my\.mail\.ru/apps/', re.I)
 
-COUNTER_TYPES = (
-    ('GOOGLE_ANALYTICS', re.compile(r'.*google-analytics\.com/ga\.js.*', re.I+re.S)),
-    ('YA_METRICA', re.compile(r'.*mc\.yandex\.ru/metrika/watch\.js.*', re.I+re.S)),
-    ('TOP_MAIL_RU', re.compile(r'.*top-fwz1\.mail\.ru/counter.*', re.I+re.S)),
-    ('TOP_MAIL_RU', re.compile(r'.*top\.mail\.ru/jump\?from.*', re.I+re.S)),
-    ('DOUBLECLICK', re.compile(r'.*//googleads\.g\.doubleclick\.net/pagead/viewthroughconversion.*', re.I+re.S)),
-    ('VISUALDNA', re.compile(r'.*//a1\.vdna-assets\.com/analytics\.js.*', re.I+re.S)),
-    ('LI_RU', re.compile(r'.*/counter\.yadro\.ru/hit.*', re.I+re.S)),
-    ('RAMBLER_TOP100', re.compile(r'.*counter\.rambler\.ru/top100.*', re.I+re.S))
+# ответы, в которых имеет смысл искать мета-редиректы и счетчики
+HTML_CONTENT_TYPE = re.compile(r'\s*(text/|[^;]*(html|xml))', re.I)
+HEAD_END = re.compile(r'</head\s*>|<body[\s>]', re.I)
+
+# разбор мета-тегов в <head> без построения дерева документа
+HEAD_SKIP = re.compile(r'<!--.*?-->|<(script|style)\b.*?</\1\s*>', re.I | re.S)
+HEAD_SKIP_START = re.compile(r'<!--|<(?:script|style)\b', re.I)
+META_TAG = re.compile(r'<meta\b((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>', re.I)
+TAG_ATTR = re.compile(r'([^\s=/>"\']+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>"\']+)))?')
+REFRESH_URL = re.compile(r"url\s*=\s*['\"]?([^'\"]+)", re.I)
+
+META_PARSER_HEAD = 'head'
+META_PARSER_BS4 = 'bs4'
+
+COUNTER_URLS = (
+    ('GOOGLE_ANALYTICS', 'google-analytics.com/ga.js'),
+    ('YA_METRICA', 'mc.yandex.ru/metrika/watch.js'),
+    ('TOP_MAIL_RU', 'top-fwz1.mail.ru/counter'),
+    ('TOP_MAIL_RU', 'top.mail.ru/jump?from'),
+    ('DOUBLECLICK', '//googleads.g.doubleclick.net/pagead/viewthroughconversion'),
+    ('VISUALDNA', '//a1.vdna-assets.com/analytics.js'),
+    ('LI_RU', '/counter.yadro.ru/hit'),
+    ('RAMBLER_TOP100', 'counter.rambler.ru/top100')
+)
+
+COUNTER_TYPES = tuple(
+    (counter_name, re.compile(r'.*' + re.escape(counter_url) + r'.*', re.I+re.S))
+    for counter_name, counter_url in COUNTER_URLS
 )
 
 
@@ -38,35 +65,146 @@ def to_str(val, errors='strict'):
     return val.encode('utf8', errors=errors) if isinstance(val, unicode) else val
 
 
+class CounterScanner(object):
+    """
+    Ищет счетчики в хтмл-странице, которая может приходить по частям.
+
+    Каждая часть один раз приводится к нижнему регистру и проверяется поиском
+    подстрок COUNTER_URLS, уже найденные счетчики больше не ищутся. Хвост
+    предыдущей части сохраняется, чтобы найти урл счетчика на стыке частей.
+    """
+
+    overlap = max(len(counter_url) for _, counter_url in COUNTER_URLS) - 1
+
+    def __init__(self):
+        self.found = [False] * len(COUNTER_URLS)
+        self.tail = ''
+
+    @property
+    def done(self):
+        """Найдены все счетчики, дальше страницу можно не смотреть"""
+        return all(self.found)
+
+    def feed(self, chunk):
+        data = self.tail + chunk.lower()
+        for i, (_, counter_url) in enumerate(COUNTER_URLS):
+            if not self.found[i] and counter_url in data:
+                self.found[i] = True
+        self.tail = data[-self.overlap:]
+
+    def counters(self):
+        return [
+            counter_name
+            for (counter_name, _), found in zip(COUNTER_URLS, self.found)
+            if found
+        ]
+
+
 def get_counters(content):
     """
     Ищет в хтмл-странице счетичик и возвращает массив типов найденных
     """
-    counters = []
-    for counter_name, regexp in COUNTER_TYPES:
-        if re.match(regexp, content):
-            counters.append(counter_name)
-    return counters
+    scanner = CounterScanner()
+    scanner.feed(content)
+    return scanner.counters()
 
 
-def check_for_meta(content, url):
+def get_refresh_url(refresh, url):
     """
-    Ищет в хтмл-странице мета-редирект теги и возраещет урл редиректа
+    Разбирает значение content мета-тега refresh ("5; url=...")
+    и возвращает абсолютный урл редиректа
+    """
+    splitted = refresh.split(";")
+    if len(splitted) != 2:
+        return
+    wait, text = splitted
+    text = text.strip()
+    m = REFRESH_URL.search(text)
+    if m:
+        meta_url = m.groups()[0]
+        return urljoin(url, to_unicode(meta_url, 'ignore'))
+
+
+_html_parser = HTMLParser()
+
+
+def parse_tag_attrs(attrs):
+    """Атрибуты тега в виде словаря (имена в нижнем регистре, сущности раскрыты)"""
+    result = {}
+    for name, double_quoted, single_quoted, unquoted in TAG_ATTR.findall(attrs):
+        value = double_quoted or single_quoted or unquoted
+        result.setdefault(name.lower(), _html_parser.unescape(to_unicode(value, 'ignore')))
+    return result
+
+
+def find_head_end(content):
+    """
+    Ищет конец <head> (</head> или <body>) в странице, из которой уже убраны
+    комментарии и скрипты (HEAD_SKIP).
+
+    :return: позиция сразу за концом <head> или None, если его нет или он может
+        оказаться внутри незакрытого комментария или скрипта
+    """
+    m = HEAD_END.search(content)
+    if not m or HEAD_SKIP_START.search(content, 0, m.start()):
+        return None
+    return m.end()
+
+
+def check_for_meta_in_head(content, url):
+    """
+    Ищет мета-редирект только в <head>: разбирает мета-теги до </head> или <body>
+    и возвращает урл первого refresh-тега, в котором он указан
     """
+    content = HEAD_SKIP.sub('', content)
+    end = find_head_end(content)
+    head = content[:end] if end is not None else content
+    for tag in META_TAG.finditer(head):
+        attrs = parse_tag_attrs(tag.group(1))
+        if attrs.get('http-equiv', '').lower() == 'refresh' and 'content' in attrs:
+            meta_url = get_refresh_url(attrs['content'], url)
+            if meta_url:
+                return meta_url
+
+
+def check_for_meta_bs4(content, url):
+    """
+    Ищет мета-редирект в первом мета-теге страницы, разбирая ее целиком BeautifulSoup
+    """
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(content, "html.parser")
     result = soup.find("meta")
     if result and 'content' in result.attrs:
         for attr, value in result.attrs.items():
             if attr == 'http-equiv' and value.lower() == 'refresh':
-                splitted = result['content'].split(";")
-                if len(splitted) != 2:
-                    return
-                wait, text = splitted
-                text = text.strip()
-                m = re.search(r"url\s*=\s*['\"]?([^'\"]+)", text, re.I)
-                if m:
-                    meta_url = m.groups()[0]
-                    return urljoin(url, to_unicode(meta_url, 'ignore'))
+                return get_refresh_url(result['content'], url)
+
+
+META_PARSERS = {
+    META_PARSER_HEAD: check_for_meta_in_head,
+    META_PARSER_BS4: check_for_meta_bs4,
+}
+
+_meta_parser = META_PARSER_HEAD
+
+
+def set_meta_parser(name):
+    """
+    Выбирает способ поиска мета-редиректов для процесса:
+    META_PARSER_HEAD (по умолчанию) или META_PARSER_BS4
+    """
+    global _meta_parser
+    if name not in META_PARSERS:
+        raise ValueError(u'Unknown meta parser {}'.format(name))
+    _meta_parser = name
+
+
+def check_for_meta(content, url):
+    """
+    Ищет в хтмл-странице мета-редирект теги и возраещет урл редиректа
+    """
+    return META_PARSERS[_meta_parser](content, url)
 
 
 def fix_market_url(url):
@@ -77,42 +215,218 @@ def fix_market_url(url):
     return 'http://play.google.com/store/apps/' + url
 
 
-def make_pycurl_request(url, timeout, useragent=None):
-    """Делает http запрос (без перехода по редиректам)
-    Возвращает контент ответа и возможный редирект
-    :return: содержимое ответа, урл редиректа
+class ResponseBuffer(object):
+    """
+    Принимает ответ curl по частям (WRITEFUNCTION и HEADERFUNCTION).
+
+    Загрузка прерывается, как только тело перестает быть нужным: ответ не html,
+    в <head> уже найден мета-редирект, после <head> без редиректа найдены все
+    счетчики или тело превысило max_body_bytes.
+    Если задан dns_cache, хост из Location резолвится, пока загружается тело.
+    """
+
+    def __init__(self, url, max_body_bytes=None, dns_cache=None):
+        self.url = url
+        self.max_body_bytes = max_body_bytes
+        self.dns_cache = dns_cache
+        self.buff = StringIO()
+        self.size = 0
+        self.content_type = None
+        self.head_checked = False
+        self.counter_scanner = CounterScanner()
+        self.aborted = False
+
+    def header(self, line):
+        name, sep, value = line.partition(':')
+        if not sep:
+            return
+        name = name.strip().lower()
+        if name == 'content-type':
+            self.content_type = value.strip()
+        elif name == 'location' and self.dns_cache is not None:
+            self.dns_cache.prefetch(prepare_url(urljoin(self.url, to_unicode(value.strip(), 'ignore'))))
+
+    def write(self, chunk):
+        if self.content_type and not HTML_CONTENT_TYPE.match(self.content_type):
+            return self.abort()
+
+        if self.max_body_bytes is not None and self.size + len(chunk) > self.max_body_bytes:
+            self.buff.write(chunk[:self.max_body_bytes - self.size])
+            self.size = self.max_body_bytes
+            return self.abort()
+
+        self.buff.write(chunk)
+        self.size += len(chunk)
+
+        if self.head_checked:
+            self.counter_scanner.feed(chunk)
+        else:
+            meta_found = self.check_head()
+            if self.head_checked:
+                self.counter_scanner.feed(self.buff.getvalue())
+            if meta_found:
+                return self.abort()
+
+        if self.counter_scanner.done:
+            return self.abort()
+
+    def check_head(self):
+        """
+        Когда <head> загружен целиком, проверяет его на мета-редирект.
+
+        :return: True, если редирект найден и остаток тела не нужен
+        """
+        content = HEAD_SKIP.sub('', self.buff.getvalue())
+        end = find_head_end(content)
+        if end is None:
+            return False
+        self.head_checked = True
+        return bool(check_for_meta(content[:end], self.url))
+
+    def counters(self):
+        """Счетчики в загруженном теле (то же, что get_counters(getvalue()), но без повторного поиска)"""
+        if not self.head_checked:
+            # конец <head> так и не встретился, и тело еще не просматривалось
+            self.head_checked = True
+            self.counter_scanner.feed(self.buff.getvalue())
+        return self.counter_scanner.counters()
+
+    def abort(self):
+        """Число, отличное от длины куска, заставляет curl прервать загрузку"""
+        self.aborted = True
+        return 0
+
+    def getvalue(self):
+        return self.buff.getvalue()
+
+
+def to_msec(seconds):
+    """Таймаут в миллисекундах для curl (0 у curl означает "без ограничения")"""
+    return max(int(seconds * 1000), 1)
+
+
+_curl_performer = None
+
+
+def set_curl_performer(perform):
+    """
+    Задает для процесса, как выполнять curl-запросы: perform(curl) вместо
+    curl.perform() (например, GeventCurlMulti.perform), None - curl.perform()
+    """
+    global _curl_performer
+    _curl_performer = perform
+
+
+def perform_curl(curl):
+    if _curl_performer is None:
+        curl.perform()
+    else:
+        _curl_performer(curl)
 
+
+def setup_curl(curl, url, timeout, buff, useragent=None, head=False, connect_timeout=None, dns_cache=None):
+    """
+    Настраивает curl-хендл на запрос одного урла (без перехода по редиректам),
+    head=True - HEAD-запрос вместо GET. Таймауты в секундах, могут быть дробными.
+    Если задан dns_cache (DnsCache), известный адрес хоста передается curl
+
+    :raises pycurl.error: если хост недавно не удалось разрешить
     """
     prepared_url = to_str(prepare_url(url), 'ignore')
-    buff = StringIO()
-    curl = pycurl.Curl()
     curl.setopt(curl.URL, prepared_url)
+    if dns_cache is not None:
+        resolve = dns_cache.curl_resolve(prepared_url)
+        if resolve:
+            curl.setopt(curl.RESOLVE, resolve)
     if useragent:
         curl.setopt(curl.USERAGENT, useragent)
-    curl.setopt(curl.WRITEDATA, buff)
+    curl.setopt(curl.WRITEFUNCTION, buff.write)
+    curl.setopt(curl.HEADERFUNCTION, buff.header)
     curl.setopt(curl.FOLLOWLOCATION, False)
-    # curl.setopt(curl.CONNECTTIMEOUT, timeout)
-    curl.setopt(curl.TIMEOUT, timeout)
-    curl.perform()
+    if head:
+        curl.setopt(curl.NOBODY, True)
+    if connect_timeout:
+        curl.setopt(curl.CONNECTTIMEOUT_MS, to_msec(connect_timeout))
+    curl.setopt(curl.TIMEOUT_MS, to_msec(timeout))
+
+
+def read_curl_response(curl, buff):
+    """Достает из выполненного curl-хендла контент ответа и урл редиректа"""
     content = buff.getvalue()
     redirect_url = curl.getinfo(curl.REDIRECT_URL)
-    curl.close()
     if redirect_url is not None:
         redirect_url = to_unicode(redirect_url, 'ignore')
     return content, redirect_url
 
 
-def get_url(url, timeout, user_agent=None):
+def read_head_response(curl, buff):
+    """Достает из выполненного HEAD-запроса код ответа, content-type и урл редиректа"""
+    _, redirect_url = read_curl_response(curl, buff)
+    return curl.getinfo(curl.RESPONSE_CODE), buff.content_type, redirect_url
+
+
+def make_pycurl_request(url, timeout, useragent=None, max_body_bytes=None, connect_timeout=None):
+    """Делает http запрос (без перехода по редиректам)
+    Возвращает контент ответа и возможный редирект
+    Тело ответа загружается не больше, чем нужно для поиска редиректа и счетчиков
+    (и не больше max_body_bytes)
+    :return: содержимое ответа, урл редиректа
+
+    """
+    dns_cache = get_dns_cache()
+    buff = ResponseBuffer(url, max_body_bytes, dns_cache)
+    curl_pool = get_curl_pool()
+    curl = curl_pool.acquire()
+    try:
+        setup_curl(curl, url, timeout, buff, useragent, connect_timeout=connect_timeout, dns_cache=dns_cache)
+        try:
+            perform_curl(curl)
+        except pycurl.error:
+            if not buff.aborted:
+                raise
+        content, redirect_url = read_curl_response(curl, buff)
+    finally:
+        curl_pool.release(curl)
+    return content, redirect_url
+
+
+def make_head_request(url, timeout, useragent=None, connect_timeout=None):
+    """Делает HEAD запрос (без перехода по редиректам)
+    :return: код ответа, content-type, урл редиректа
     """
-    :return: урл, тип редиректа, содержимое страницы (если есть)
+    dns_cache = get_dns_cache()
+    buff = ResponseBuffer(url, dns_cache=dns_cache)
+    curl_pool = get_curl_pool()
+    curl = curl_pool.acquire()
+    try:
+        setup_curl(curl, url, timeout, buff, useragent, head=True, connect_timeout=connect_timeout,
+                   dns_cache=dns_cache)
+        perform_curl(curl)
+        response = read_head_response(curl, buff)
+    finally:
+        curl_pool.release(curl)
+    return response
+
+
+def probe_url(url, timeout, useragent, prober, connect_timeout=None):
+    """
+    Пробует пройти переход HEAD-запросом.
+
+    :return: содержимое ответа, урл редиректа или None, если нужен GET
     """
-    content = None
     try:
-        content, new_redirect_url = make_pycurl_request(url, timeout, user_agent)
-    except (pycurl.error, ValueError) as e:
-        logger.error(u'error in url {} {}'.format(url, e))
-        return url, 'ERROR', content  # TODO add exception in ERROR
+        response, error = make_head_request(url, timeout, useragent, connect_timeout), None
+    except pycurl.error as e:
+        response, error = None, e
+    return prober.check_head(url, response, error)
+
 
+def process_response(url, content, new_redirect_url):
+    """
+    Определяет следующий урл цепочки по ответу на запрос url
+
+    :return: урл, тип редиректа, содержимое страницы
+    """
     redirect_type = None
 
     # ignoring ok login redirects
@@ -132,55 +446,217 @@ def get_url(url, timeout, user_agent=None):
     return prepare_url(new_redirect_url), redirect_type, content
 
 
-def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
+def cut_timeouts(deadline, timeout, connect_timeout=None, now=None):
+    """
+    Таймауты запроса, урезанные до времени, оставшегося до deadline (time())
+
+    :return: таймаут запроса, таймаут соединения или None, если время вышло
+    """
+    if deadline is None:
+        return timeout, connect_timeout
+    remaining = deadline - (now or time())
+    if remaining <= 0:
+        return None
+    return min(timeout, remaining), min(connect_timeout or remaining, remaining)
+
+
+def get_url(url, timeout, user_agent=None, max_body_bytes=None, prober=None, connect_timeout=None, deadline=None):
+    """
+    Если задан prober (HeadProber), переход сначала запрашивается HEAD-ом,
+    а GET делается, только если нужно тело страницы. Если задан deadline
+    (time()), таймауты GET-а после HEAD-а урезаются до оставшегося времени.
+
+    :return: урл, тип редиректа, содержимое страницы (если есть);
+        TIMEOUT, если после HEAD-а время до deadline вышло; ERROR без содержимого
+        (None), если запрос не удался, и с содержимым, если хост ответил,
+        но урл следующего перехода кривой
+    """
+    content = None
+    try:
+        probed = None
+        if prober is not None and prober.use_head(url):
+            probed = probe_url(url, timeout, user_agent, prober, connect_timeout)
+            if probed is None:
+                timeouts = cut_timeouts(deadline, timeout, connect_timeout)
+                if timeouts is None:
+                    logger.error(u'task timeout after HEAD in url {}'.format(url))
+                    return url, REDIRECT_TIMEOUT, None
+                timeout, connect_timeout = timeouts
+        if probed is None:
+            probed = make_pycurl_request(url, timeout, user_agent, max_body_bytes, connect_timeout)
+        content, new_redirect_url = probed
+        return process_response(url, content, new_redirect_url)
+    except (pycurl.error, ValueError) as e:
+        logger.error(u'error in url {} {}'.format(url, e))
+        return url, REDIRECT_ERROR, content  # TODO add exception in ERROR
+
+
+class RedirectHistory(object):
+    """
+    Состояние проверки цепочки редиректов одного урла.
+
+    Цепочка продвигается по одному переходу через add_hop(), пока не станет done.
+    Если задан hop_cache, переходы из сети сохраняются в него, а follow_cache()
+    проходит уже известную часть цепочки без запросов.
+    Если задан deadline (time()), после него цепочка обрывается переходом TIMEOUT.
+    """
+
+    def __init__(self, url, max_redirects=30, hop_cache=None, deadline=None):
+        self.url = prepare_url(url)
+        self.max_redirects = max_redirects
+        self.hop_cache = hop_cache
+        self.deadline = deadline
+        self.history_types = []
+        self.history_urls = [self.url]
+        self.next_url = self.url
+        self.content = None
+        self.counters = None
+        self.cache_miss_url = None
+        # урл, по HEAD-ответу которого нужен GET
+        self.probed_url = None
+
+        # ignore mm / ok domains
+        self.done = bool(re.match(MM_URL, self.url) or re.match(OK_URL, self.url))
+
+    def add_hop(self, redirect_url, redirect_type, content, counters=None):
+        """
+        Добавляет в историю результат запроса next_url (результат get_url)
+
+        :param counters: счетчики, уже найденные в content при загрузке
+            (None - конечная страница просматривается здесь)
+        """
+        if counters is None and not redirect_url:
+            counters = get_counters(content) if content else []
+        if self.hop_cache is not None:
+            self.hop_cache.put(self.next_url, redirect_url, redirect_type, content, counters)
+        self._add_hop(redirect_url, redirect_type, content, counters)
+
+    def follow_cache(self):
+        """
+        Проходит по закэшированным переходам, пока следующий переход есть в кэше
+        """
+        while self.hop_cache is not None and not self.done and self.next_url != self.cache_miss_url:
+            hop = self.hop_cache.get(self.next_url)
+            if hop is None:
+                self.cache_miss_url = self.next_url
+                return
+            redirect_url, redirect_type, counters = hop
+            self._add_hop(redirect_url, redirect_type, None, counters)
+
+    def hop_timeouts(self, timeout, connect_timeout=None, now=None):
+        """
+        Таймауты следующего перехода, урезанные до оставшегося времени задачи
+
+        :return: таймаут запроса, таймаут соединения или None, если время вышло
+        """
+        return cut_timeouts(self.deadline, timeout, connect_timeout, now)
+
+    def expired(self, now=None):
+        return self.deadline is not None and (now or time()) >= self.deadline
+
+    def add_timeout(self):
+        """Обрывает цепочку на next_url: время задачи вышло"""
+        logger.error(u'task timeout in url {}'.format(self.next_url))
+        self._add_hop(self.next_url, REDIRECT_TIMEOUT, None)
+
+    def _add_hop(self, redirect_url, redirect_type, content, counters=None):
+        self.content = content
+        self.counters = counters
+        if not redirect_url:
+            self.done = True
+            return
+
+        self.history_types.append(redirect_type)
+        self.history_urls.append(redirect_url)
+        self.next_url = redirect_url
+
+        if redirect_type in (REDIRECT_ERROR, REDIRECT_TIMEOUT):
+            self.done = True
+        elif len(self.history_urls) > self.max_redirects or (redirect_url in self.history_urls[:-1]):
+            self.done = True
+
+    def result(self):
+        """
+        :return: типы редиректов, урлы редиректов, счетчики на конечном урле
+        """
+        if self.counters is not None:
+            counters = self.counters
+        else:
+            counters = get_counters(self.content) if self.content else []
+        return self.history_types, self.history_urls, counters
+
+
+def get_redirect_history(url, timeout, max_redirects=30, user_agent=None, max_body_bytes=None, hop_cache=None,
+                         prober=None, connect_timeout=None, task_timeout=None, breaker=None, scheduler=None):
     """
     Входные параметры:
 
     + url - урл для которого необходимо получить редиректы
     + timeout - таймаут на проверку *одного* урла
+    + connect_timeout - таймаут на установку соединения (None - ограничен только timeout)
+    + task_timeout - время на проверку всей цепочки (None - без ограничения), по его
+      истечении цепочка обрывается и последним типом редиректа становится TIMEOUT
     + max_redirects - максимальное количество редиректов, после превышения проверка останавливается
     + user_agent - юзер-агент, если не передает, то будет дефолтный из pycurl
+    + max_body_bytes - сколько байт тела ответа загружать не больше (None - без ограничения)
+    + hop_cache - кэш переходов (HopCache), None - все переходы запрашиваются из сети
+    + prober - HeadProber для запроса переходов сначала HEAD-ом, None - всегда GET
+    + breaker - HostBreaker, переход на выключенный хост сразу становится ERROR без запроса
+    + scheduler - HostScheduler, запрос ждет места по ограничениям на хост (None - без ограничений)
 
 
     Выходные параметры:
     Массив из трех элементов
 
-    1. типы найденных редиректов (варианты: meta_tag, http_status, ERROR)
+    1. типы найденных редиректов (варианты: meta_tag, http_status, ERROR, TIMEOUT)
     2. урлы редиректов (включая конечный)
     3. установленные счетчики на конечном урле
 
     """
-    url = prepare_url(url)
-    history_types = []
-    history_urls = [url]
-    redirect_url = url
-
-    # ignore mm / ok domains
-    if re.match(MM_URL, url) or re.match(OK_URL, url):
-        return history_types, history_urls, []
-
-    content = None
+    deadline = time() + task_timeout if task_timeout is not None else None
+    history = RedirectHistory(url, max_redirects, hop_cache, deadline)
     while True:
-        redirect_url, redirect_type, content = get_url(
-            url=redirect_url,
-            timeout=timeout,
-            user_agent=user_agent
-        )
-        if not redirect_url:
+        history.follow_cache()
+        if history.done:
             break
-
-        history_types.append(redirect_type)
-        history_urls.append(redirect_url)
-
-        if redirect_type == 'ERROR':
+        timeouts = history.hop_timeouts(timeout, connect_timeout)
+        if timeouts is None:
+            history.add_timeout()
             break
-
-        if len(history_urls) > max_redirects or (redirect_url in history_urls[:-1]):
+        host = get_host(history.next_url)
+        if breaker is not None and breaker.check(host):
+            logger.error(u'host of url {} is failing. skipped'.format(history.next_url))
+            history.add_hop(history.next_url, REDIRECT_ERROR, None)
             break
+        if scheduler is not None and not scheduler.acquire(host, deadline):
+            history.add_timeout()
+            break
+        try:
+            if scheduler is not None:
+                # место запроса к хосту могло освободиться не сразу
+                timeouts = history.hop_timeouts(timeout, connect_timeout)
+            hop = get_url(
+                url=history.next_url,
+                timeout=timeouts[0],
+                user_agent=user_agent,
+                max_body_bytes=max_body_bytes,
+                prober=prober,
+                connect_timeout=timeouts[1],
+                deadline=deadline
+            ) if timeouts is not None else (history.next_url, REDIRECT_TIMEOUT, None)
+        finally:
+            if scheduler is not None:
+                scheduler.finish(host, time())
+        if hop[1] == REDIRECT_TIMEOUT or (hop[1] == REDIRECT_ERROR and history.expired()):
+            # запрос оборвал остаток времени задачи, а не ошибка сайта
+            history.add_timeout()
+            break
+        if breaker is not None:
+            # ERROR с содержимым - ошибка страницы, а не хоста
+            breaker.record(host, hop[1] != REDIRECT_ERROR or hop[2] is not None)
+        history.add_hop(*hop)
 
-    counters = get_counters(content) if content else []
-
-    return history_types, history_urls, counters
+    return history.result()
 
 
 def prepare_url(url):
@@ -0,0 +1,122 @@
+# coding: utf-8
+from logging import getLogger
+
+from tarantool.error import DatabaseError
+
+logger = getLogger('redirect_checker')
+
+
+def read_cpu_times(path='/proc/stat'):
+    """
+    :return: (занятое, общее) время всех процессоров в тиках
+    """
+    with open(path) as f:
+        fields = [int(value) for value in f.readline().split()[1:9]]
+    # idle + iowait
+    idle = sum(fields[3:5])
+    return sum(fields) - idle, sum(fields)
+
+
+def get_counter(stats, name):
+    try:
+        return int(stats.get(name, 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+class PoolAutoscaler(object):
+    """
+    Размер пула воркеров по статистике очередей (queue.statistics).
+
+    Пул растет, когда готовых задач во входной очереди больше, чем по
+    backlog_per_worker на воркер: сразу до нужного числа воркеров, но не
+    выше max_workers и не при загрузке CPU от max_cpu или при max_output_backlog
+    готовых результатов в выходной очереди (их все равно некому забрать).
+    Пул уменьшается на одного воркера за раз, когда не меньше idle_take_ratio
+    взятий из входной очереди с прошлого раза ушли впустую (take_timeout),
+    то есть воркеры простаивают.
+    """
+
+    def __init__(self, input_tube, output_tube, min_workers, max_workers, size=None, backlog_per_worker=100,
+                 idle_take_ratio=0.5, max_cpu=0.9, max_output_backlog=None):
+        self.input_tube = input_tube
+        self.output_tube = output_tube
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.backlog_per_worker = backlog_per_worker
+        self.idle_take_ratio = idle_take_ratio
+        self.max_cpu = max_cpu
+        self.max_output_backlog = max_output_backlog
+        self.size = min(max(size or min_workers, min_workers), max_workers)
+
+        self.takes = None
+        self.cpu_times = None
+
+    def sample_cpu(self):
+        """
+        :return: загрузка CPU (0..1) с прошлого вызова или None
+        """
+        try:
+            busy, total = read_cpu_times()
+        except (IOError, ValueError, IndexError):
+            return None
+        last, self.cpu_times = self.cpu_times, (busy, total)
+        if last is None or total <= last[1]:
+            return None
+        return (busy - last[0]) / float(total - last[1])
+
+    def idle_ratio(self, input_stats):
+        """
+        :return: доля взятий из очереди впустую с прошлого вызова или None
+        """
+        takes = get_counter(input_stats, 'take'), get_counter(input_stats, 'take_timeout')
+        last, self.takes = self.takes, takes
+        if last is None:
+            return None
+        taken, timed_out = takes[0] - last[0], takes[1] - last[1]
+        if taken < 0 or timed_out < 0 or taken + timed_out == 0:
+            # счетчики сбросились при перезапуске сервера или воркеров нет
+            return None
+        return timed_out / float(taken + timed_out)
+
+    def refresh(self):
+        """
+        Пересчитывает размер пула по текущей статистике очередей
+
+        :return: новый размер пула (прежний, если статистику получить не удалось)
+        """
+        cpu = self.sample_cpu()
+        try:
+            input_stats = self.input_tube.statistics()
+            output_stats = self.output_tube.statistics()
+        except DatabaseError as e:
+            logger.warning(u'Queue statistics fail: {}'.format(e))
+            return self.size
+        return self.update(input_stats, output_stats, cpu)
+
+    def update(self, input_stats, output_stats=None, cpu=None):
+        """
+        :return: новый размер пула
+        """
+        backlog = get_counter(input_stats.get('tasks', {}), 'ready')
+        output_backlog = get_counter((output_stats or {}).get('tasks', {}), 'ready')
+        idle_ratio = self.idle_ratio(input_stats)
+
+        size = self.size
+        if backlog > size * self.backlog_per_worker:
+            if cpu is not None and cpu >= self.max_cpu:
+                logger.info(u'Backlog {} but cpu is {:.0%}. pool size kept'.format(backlog, cpu))
+            elif self.max_output_backlog is not None and output_backlog >= self.max_output_backlog:
+                logger.info(u'Backlog {} but output backlog is {}. pool size kept'.format(backlog, output_backlog))
+            else:
+                needed = -(-backlog // self.backlog_per_worker)
+                size = min(max(needed, size + 1), self.max_workers)
+        elif idle_ratio is not None and idle_ratio >= self.idle_take_ratio:
+            size = max(size - 1, self.min_workers)
+
+        if size != self.size:
+            logger.info(u'Pool size {} -> {}. backlog={} output_backlog={} idle_takes={} cpu={}'.format(
+                self.size, size, backlog, output_backlog, idle_ratio, cpu
+            ))
+            self.size = size
+        return size
@@ -0,0 +1,180 @@
+# coding: utf-8
+from logging import getLogger
+import os
+import sqlite3
+from time import time
+
+from shared_db import connect_shared_db
+
+logger = getLogger('redirect_checker')
+
+
+class HostBreaker(object):
+    """
+    Выключатель (circuit breaker) хостов, у которых запросы подряд завершаются ошибкой.
+
+    Хранится в sqlite-файле, поэтому общий для всех воркеров на машине.
+    После failure_threshold ошибок подряд хост "выключается": запросы к нему
+    не делаются base_delay секунд. Затем одному запросу (одному воркеру) дается
+    пробовать хост: если он прошел, хост включается, если нет - выключается снова
+    на вдвое большее время, но не больше max_delay. Пробу, результат которой
+    так и не пришел, повторяют через probe_timeout секунд. Ошибки базы
+    (в том числе занятый другим процессом файл) не мешают проверке: хост
+    считается включенным.
+
+    Если задан network_up (multiprocessing.Event), пока он сброшен (сеть
+    недоступна), ошибки запросов не учитываются: хосты в них не виноваты.
+    """
+
+    evict_every = 100
+
+    def __init__(self, path, failure_threshold=5, base_delay=30, max_delay=3600, probe_timeout=30,
+                 network_up=None):
+        self.path = path
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.probe_timeout = probe_timeout
+        self.network_up = network_up
+        self.stats = {'rejected': 0, 'probes': 0, 'opened': 0, 'closed': 0, 'errors': 0}
+        self.records = 0
+        # хосты с ошибками, известные процессу: только для них успех пишется в базу
+        self.failing = set()
+
+        self.db = connect_shared_db(path)
+        try:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS hosts (host TEXT PRIMARY KEY, failures INTEGER, open_until REAL, '
+                'updated REAL)'
+            )
+        except sqlite3.Error as e:
+            self._error(e)
+
+    def delay(self, failures):
+        """Сколько секунд хост выключен после failures ошибок подряд"""
+        return min(self.base_delay * 2 ** max(failures - self.failure_threshold, 0), self.max_delay)
+
+    def check(self, host, now=None):
+        """
+        Можно ли сейчас делать запрос к хосту. Если хосту пора пробовать,
+        разрешает запрос только одному вызвавшему.
+
+        :return: 0, если можно, иначе через сколько секунд хост можно будет пробовать
+        """
+        if not host:
+            return 0
+        now = now or time()
+        try:
+            row = self.db.execute('SELECT failures, open_until FROM hosts WHERE host = ?', (host,)).fetchone()
+            if row is None:
+                return 0
+            self.failing.add(host)
+            failures, open_until = row
+            if failures < self.failure_threshold:
+                return 0
+            if now < open_until:
+                self.stats['rejected'] += 1
+                return open_until - now
+            claimed = self.db.execute(
+                'UPDATE hosts SET open_until = ? WHERE host = ? AND open_until = ?',
+                (now + self.probe_timeout, host, open_until)
+            ).rowcount
+        except sqlite3.Error as e:
+            self._error(e)
+            return 0
+
+        if claimed:
+            self.stats['probes'] += 1
+            return 0
+        # пробует другой воркер
+        self.stats['rejected'] += 1
+        return self.probe_timeout
+
+    def record(self, host, ok, now=None):
+        """Учитывает результат запроса к хосту"""
+        # урлы без хоста не выключают ничего
+        if not host or ok and host not in self.failing:
+            return
+        if not ok and self.network_up is not None and not self.network_up.is_set():
+            return
+
+        now = now or time()
+        try:
+            if ok:
+                self.failing.discard(host)
+                if self.db.execute('DELETE FROM hosts WHERE host = ?', (host,)).rowcount:
+                    self.stats['closed'] += 1
+                return
+
+            self.failing.add(host)
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute('SELECT failures FROM hosts WHERE host = ?', (host,)).fetchone()
+                failures = (row[0] if row else 0) + 1
+                open_until = now + self.delay(failures) if failures >= self.failure_threshold else 0
+                self.db.execute(
+                    'INSERT OR REPLACE INTO hosts VALUES (?, ?, ?, ?)', (host, failures, open_until, now)
+                )
+                self.db.execute('COMMIT')
+            except sqlite3.Error:
+                self.db.execute('ROLLBACK')
+                raise
+            if failures == self.failure_threshold:
+                self.stats['opened'] += 1
+                logger.info(u'Host {} is failing. requests paused for {}s'.format(host, self.delay(failures)))
+
+            self.records += 1
+            if self.records % self.evict_every == 0:
+                self.evict(now)
+        except sqlite3.Error as e:
+            self._error(e)
+
+    def retry_delay(self, host, now=None):
+        """
+        :return: через сколько секунд хост можно будет пробовать (0, если он включен)
+        """
+        if not host:
+            return 0
+        now = now or time()
+        try:
+            row = self.db.execute('SELECT failures, open_until FROM hosts WHERE host = ?', (host,)).fetchone()
+        except sqlite3.Error as e:
+            self._error(e)
+            return 0
+        if row is None or row[0] < self.failure_threshold:
+            return 0
+        return max(row[1] - now, 0)
+
+    def evict(self, now=None):
+        """Забывает хосты, о которых ничего не было слышно дольше max_delay"""
+        forget_before = (now or time()) - self.max_delay
+        self.db.execute('DELETE FROM hosts WHERE updated < ? AND open_until < ?', (forget_before, forget_before))
+        # check() снова заполнит множество для хостов, оставшихся в базе
+        self.failing.clear()
+
+    def _error(self, e):
+        self.stats['errors'] += 1
+        logger.error(u'host breaker error {}'.format(e))
+
+
+_host_breaker = None
+_host_breaker_pid = None
+
+
+def init_host_breaker(path, failure_threshold=5, base_delay=30, max_delay=3600, probe_timeout=30, network_up=None):
+    """
+    Открывает выключатель хостов для текущего процесса (path=None - выключен)
+    """
+    global _host_breaker, _host_breaker_pid
+    _host_breaker = HostBreaker(
+        path, failure_threshold, base_delay, max_delay, probe_timeout, network_up
+    ) if path else None
+    _host_breaker_pid = os.getpid()
+    return _host_breaker
+
+
+def get_host_breaker():
+    """Выключатель хостов текущего процесса или None, если он не открыт в этом процессе"""
+    if _host_breaker_pid != os.getpid():
+        return None
+    return _host_breaker
@@ -0,0 +1,113 @@
+# coding: utf-8
+import os
+from urlparse import urlsplit
+
+
+class CallbackLanes(object):
+    """
+    Квоты одновременных запросов к хостам колбэков одного процесса.
+
+    Хосты делятся на быстрые и медленные по средней (экспоненциально
+    сглаженной) длительности запроса: хост, у которого она не меньше
+    slow_latency секунд, медленный. К быстрому хосту одновременно идет
+    не больше host_quota запросов, к медленному - не больше slow_host_quota,
+    а ко всем медленным вместе - не больше slow_lane_size, так что остальные
+    места пула обработчиков остаются быстрым хостам.
+    """
+
+    smoothing = 0.3
+
+    def __init__(self, host_quota=5, slow_host_quota=1, slow_lane_size=3, slow_latency=5):
+        self.host_quota = host_quota
+        self.slow_host_quota = slow_host_quota
+        self.slow_lane_size = slow_lane_size
+        self.slow_latency = slow_latency
+
+        # хост -> запросов в работе
+        self.active = {}
+        # хост -> сглаженная длительность запроса
+        self.latency = {}
+        self.stats = {'entered': 0, 'deferred': 0}
+
+    def enter(self, url):
+        """
+        Занимает место для запроса к хосту url, если квота хоста и его полосы
+        это позволяет. Занятое место освобождает leave(). Урлы без хоста
+        не ограничиваются и не учитываются.
+
+        :return: занято ли место
+        :rtype: bool
+        """
+        host = self._host(url)
+        if not host:
+            return True
+        active = self.active.get(host, 0)
+        if self.is_slow(host):
+            slow_active = sum(count for other, count in self.active.iteritems() if self.is_slow(other))
+            allowed = active < self.slow_host_quota and slow_active < self.slow_lane_size
+        else:
+            allowed = active < self.host_quota
+
+        if not allowed:
+            self.stats['deferred'] += 1
+            return False
+        self.active[host] = active + 1
+        self.stats['entered'] += 1
+        return True
+
+    def leave(self, url, latency):
+        """Освобождает место запроса к хосту url и учитывает его длительность"""
+        host = self._host(url)
+        if not host:
+            return
+        active = self.active.pop(host, 0) - 1
+        if active > 0:
+            self.active[host] = active
+
+        previous = self.latency.get(host)
+        if previous is None:
+            self.latency[host] = latency
+        else:
+            self.latency[host] = previous + self.smoothing * (latency - previous)
+
+    def is_slow(self, host):
+        return self.latency.get(host, 0) >= self.slow_latency
+
+    def host_stats(self):
+        """
+        :return: хост -> полоса ('fast' или 'slow'), запросов в работе, сглаженная длительность
+        """
+        return dict(
+            (host, {
+                'lane': 'slow' if self.is_slow(host) else 'fast',
+                'active': self.active.get(host, 0),
+                'latency': latency
+            })
+            for host, latency in self.latency.iteritems()
+        )
+
+    @staticmethod
+    def _host(url):
+        return urlsplit(url).netloc.lower() if url else ''
+
+
+_callback_lanes = None
+_callback_lanes_pid = None
+
+
+def init_callback_lanes(host_quota=5, slow_host_quota=1, slow_lane_size=3, slow_latency=5):
+    """Создает квоты хостов колбэков текущего процесса с заданными настройками"""
+    global _callback_lanes, _callback_lanes_pid
+    _callback_lanes = CallbackLanes(host_quota, slow_host_quota, slow_lane_size, slow_latency)
+    _callback_lanes_pid = os.getpid()
+    return _callback_lanes
+
+
+def get_callback_lanes():
+    """
+    Квоты хостов колбэков текущего процесса. После fork дочерний процесс
+    получает собственные квоты, а не копию родительских.
+    """
+    if _callback_lanes is None or _callback_lanes_pid != os.getpid():
+        return init_callback_lanes()
+    return _callback_lanes
@@ -0,0 +1,84 @@
+# coding: utf-8
+from collections import deque
+import os
+from time import time
+
+import pycurl
+
+
+class CurlPool(object):
+    """
+    Пул переиспользуемых curl-хендлов одного процесса.
+
+    Хендлы разделяют через pycurl.CurlShare кэш DNS и TLS-сессий (и соединений,
+    если их умеет делить libcurl), а сам хендл после возврата в пул сохраняет
+    свои keep-alive соединения. Последний возвращенный хендл выдается первым;
+    простаивающие дольше idle_timeout или сверх max_idle закрываются.
+    """
+
+    def __init__(self, max_idle=100, idle_timeout=60):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        if hasattr(pycurl, 'LOCK_DATA_CONNECT'):
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+
+        self.idle = deque()
+        self.stats = {'created': 0, 'reused': 0, 'evicted': 0}
+
+    def acquire(self):
+        self.evict_idle()
+        if self.idle:
+            curl, _ = self.idle.pop()
+            self.stats['reused'] += 1
+            return curl
+
+        curl = pycurl.Curl()
+        curl.setopt(pycurl.SHARE, self.share)
+        self.stats['created'] += 1
+        return curl
+
+    def release(self, curl):
+        """
+        Возвращает хендл в пул, сбрасывая опции предыдущего запроса
+        (соединения, кэши и подключение к share при этом сохраняются)
+        """
+        curl.reset()
+        self.idle.append((curl, time()))
+        while len(self.idle) > self.max_idle:
+            self._evict()
+
+    def evict_idle(self):
+        deadline = time() - self.idle_timeout
+        while self.idle and self.idle[0][1] < deadline:
+            self._evict()
+
+    def _evict(self):
+        curl, _ = self.idle.popleft()
+        curl.close()
+        self.stats['evicted'] += 1
+
+
+_curl_pool = None
+_curl_pool_pid = None
+
+
+def init_curl_pool(max_idle=100, idle_timeout=60):
+    """Создает пул хендлов текущего процесса с заданными настройками"""
+    global _curl_pool, _curl_pool_pid
+    _curl_pool = CurlPool(max_idle, idle_timeout)
+    _curl_pool_pid = os.getpid()
+    return _curl_pool
+
+
+def get_curl_pool():
+    """
+    Пул хендлов текущего процесса. После fork дочерний процесс получает
+    собственный пул, а не копию родительского.
+    """
+    if _curl_pool is None or _curl_pool_pid != os.getpid():
+        return init_curl_pool()
+    return _curl_pool
@@ -0,0 +1,320 @@
+# coding: utf-8
+from collections import deque
+from functools import partial
+from logging import getLogger
+from time import time, sleep
+
+import pycurl
+
+from . import RedirectHistory, ResponseBuffer, setup_curl, read_curl_response, read_head_response, process_response, \
+    REDIRECT_ERROR
+from curl_pool import get_curl_pool
+from scheduler import get_host
+
+logger = getLogger('redirect_checker')
+
+
+class RedirectEngine(object):
+    """
+    Проверяет много цепочек редиректов одновременно на одном pycurl.CurlMulti.
+
+    Каждая цепочка продвигается на один переход по мере завершения ответов,
+    одновременно выполняется не больше max_in_flight запросов.
+
+    Если задан scheduler (HostScheduler), цепочка, следующий хост которой
+    сейчас ограничен, ждет в очереди, а ее место занимают запросы к другим хостам.
+    Если задан prober (HeadProber), переходы сначала запрашиваются HEAD-ом.
+    Если задан task_timeout, каждая цепочка проверяется не дольше него
+    (см. get_redirect_history). Если задан dns_cache (DnsCache), хосты цепочек
+    резолвятся в фоне, пока цепочки ждут своей очереди. Если задан breaker
+    (HostBreaker), переходы на выключенные хосты сразу становятся ERROR.
+    Если задан flights (SingleFlight), урл, который уже проверяется этим
+    или другим воркером, не проверяется второй раз: цепочка получает
+    готовый результат; результаты других воркеров проверяются не чаще
+    раза в flight_poll_interval секунд.
+    """
+
+    flight_poll_interval = 0.05
+
+    def __init__(self, timeout, max_redirects=30, user_agent=None, max_in_flight=100, curl_pool=None,
+                 max_body_bytes=None, hop_cache=None, scheduler=None, prober=None, connect_timeout=None,
+                 task_timeout=None, dns_cache=None, breaker=None, flights=None):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.task_timeout = task_timeout
+        self.max_redirects = max_redirects
+        self.user_agent = user_agent
+        self.max_body_bytes = max_body_bytes
+        self.hop_cache = hop_cache
+        self.scheduler = scheduler
+        self.prober = prober
+        self.dns_cache = dns_cache
+        self.breaker = breaker
+        self.flights = flights
+        self.max_in_flight = max_in_flight
+        self.curl_pool = curl_pool or get_curl_pool()
+
+        self.multi = pycurl.CurlMulti()
+        self.pending = deque()
+        self.in_flight = {}
+        self.throttled = 0
+        # урл -> колбэки: цепочки, которые проверяет этот движок, и которые проверяют другие воркеры
+        self.owned = {}
+        self.waiting = {}
+        self.flights_polled = 0
+
+    def free_count(self):
+        """
+        Сколько еще цепочек можно добавить, не превышая max_in_flight готовых к запуску.
+        Цепочки, ждущие своих хостов, места не занимают, но всего в движке
+        не больше 2 * max_in_flight цепочек.
+        """
+        runnable = len(self.in_flight) + len(self.pending) - self.throttled
+        room = 2 * self.max_in_flight - len(self.in_flight) - len(self.pending) - len(self.waiting)
+        return max(min(self.max_in_flight - runnable, room), 0)
+
+    def is_idle(self):
+        return not self.in_flight and not self.pending and not self.waiting
+
+    def submit(self, url, callback, use_cache=True):
+        """
+        Ставит урл на проверку.
+
+        :param callback: вызывается с результатом get_redirect_history,
+            когда цепочка будет пройдена
+        :param use_cache: False - проверить все переходы по сети, минуя кэш переходов
+            и не совмещая проверку с другими проверками того же урла
+        """
+        history = self._new_history(url, use_cache)
+        if history.done:
+            callback(history.result())
+            return
+        if self.flights is None or not use_cache:
+            self._enqueue(history, callback)
+            return
+
+        url = history.url
+        if url in self.owned:
+            self.owned[url].append(callback)
+            return
+        if url in self.waiting:
+            self.waiting[url].append(callback)
+            return
+        owned, result = self.flights.join(url)
+        if result is not None:
+            callback(result)
+        elif owned:
+            self.owned[url] = [callback]
+            self._enqueue(history, partial(self._land, url))
+        else:
+            self.waiting[url] = [callback]
+
+    def _new_history(self, url, use_cache=True):
+        deadline = time() + self.task_timeout if self.task_timeout is not None else None
+        return RedirectHistory(url, self.max_redirects, self.hop_cache if use_cache else None, deadline)
+
+    def _enqueue(self, history, callback):
+        if self.dns_cache is not None:
+            self.dns_cache.prefetch(history.next_url)
+        self.pending.append((history, callback))
+
+    def perform(self, select_timeout=1.0):
+        """
+        Одна итерация движка: ждет активности на сокетах не дольше select_timeout,
+        обрабатывает завершенные запросы и запускает следующие переходы.
+
+        :return: количество завершенных за итерацию цепочек
+        """
+        finished = self._poll_flights()
+        self._start_pending()
+        if self.throttled:
+            select_timeout = self._throttle_delay(select_timeout)
+        if not self.in_flight:
+            if self.pending or self.waiting:
+                # все оставшиеся цепочки ждут своих хостов или результатов других воркеров
+                sleep(select_timeout)
+            return finished
+
+        # только что добавленным запросам curl может требовать perform раньше,
+        # чем появится активность на сокетах
+        curl_timeout = self.multi.timeout()
+        if curl_timeout >= 0:
+            select_timeout = min(select_timeout, curl_timeout / 1000.0)
+        self.multi.select(select_timeout)
+        while True:
+            ret, _ = self.multi.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+
+        while True:
+            queued, ok_list, err_list = self.multi.info_read()
+            for curl in ok_list:
+                finished += self._finish_hop(curl)
+            for curl, errno, errmsg in err_list:
+                finished += self._finish_hop(curl, pycurl.error(errno, errmsg))
+            if not queued:
+                break
+
+        self._start_pending()
+        return finished
+
+    def _poll_flights(self):
+        """
+        Отдает ждущим цепочкам готовые результаты других воркеров. Урлы,
+        проверку которых другой воркер бросил, движок проверяет сам.
+
+        :return: количество завершенных цепочек
+        """
+        now = time()
+        if not self.waiting or now < self.flights_polled + self.flight_poll_interval:
+            return 0
+        self.flights_polled = now
+
+        finished = 0
+        for url in list(self.waiting):
+            owned, result = self.flights.join(url)
+            if result is not None:
+                self._deliver(self.waiting.pop(url), result)
+                finished += 1
+            elif owned:
+                self.owned[url] = self.waiting.pop(url)
+                history = self._new_history(url)
+                if history.done:
+                    self._land(url, history.result())
+                    finished += 1
+                else:
+                    self._enqueue(history, partial(self._land, url))
+        return finished
+
+    def _land(self, url, result):
+        """Публикует результат своей проверки урла и отдает его всем ждущим в движке"""
+        self.flights.publish(url, result)
+        self._deliver(self.owned.pop(url), result)
+
+    def _deliver(self, callbacks, result):
+        for callback in callbacks:
+            try:
+                callback(result)
+            except Exception as e:
+                logger.exception(e)
+
+    def _start_pending(self):
+        now = time()
+        throttled = deque()
+        while self.pending and len(self.in_flight) < self.max_in_flight:
+            history, callback = self.pending.popleft()
+            history.follow_cache()
+            if history.done:
+                self._advance(history, callback)
+                continue
+
+            timeouts = history.hop_timeouts(self.timeout, self.connect_timeout, now)
+            if timeouts is None:
+                history.add_timeout()
+                self._advance(history, callback)
+                continue
+
+            host = get_host(history.next_url)
+            if self.scheduler and not self.scheduler.can_start(host, now):
+                throttled.append((history, callback))
+                continue
+            if self.breaker and history.probed_url != history.next_url and self.breaker.check(host, now):
+                logger.error(u'host of url {} is failing. skipped'.format(history.next_url))
+                history.add_hop(history.next_url, REDIRECT_ERROR, None)
+                self._advance(history, callback)
+                continue
+            self._start_hop(history, callback, host, now, timeouts)
+
+        self.throttled = len(throttled)
+        self.pending.extendleft(reversed(throttled))
+
+    def _throttle_delay(self, select_timeout):
+        """Сколько ждать, пока освободится хост одной из ждущих цепочек"""
+        now = time()
+        delays = [self.scheduler.delay(get_host(history.next_url), now) for history, _ in self.pending]
+        return min([delay for delay in delays if delay > 0] + [select_timeout])
+
+    def _start_hop(self, history, callback, host, now, timeouts):
+        head = (
+            self.prober is not None and history.probed_url != history.next_url
+            and self.prober.use_head(history.next_url)
+        )
+        buff = ResponseBuffer(history.next_url, self.max_body_bytes, self.dns_cache)
+        curl = self.curl_pool.acquire()
+        try:
+            setup_curl(
+                curl, history.next_url, timeouts[0], buff, self.user_agent, head, timeouts[1], self.dns_cache
+            )
+        except (pycurl.error, ValueError) as e:
+            self.curl_pool.release(curl)
+            self._add_error_hop(history, callback, e)
+            return
+        if self.scheduler:
+            self.scheduler.start(host, now)
+        self.in_flight[curl] = (history, callback, buff, host, head)
+        self.multi.add_handle(curl)
+
+    def _finish_hop(self, curl, error=None):
+        self.multi.remove_handle(curl)
+        history, callback, buff, host, head = self.in_flight.pop(curl)
+        if self.scheduler:
+            self.scheduler.finish(host, time())
+        if buff.aborted:
+            # загрузку прервали сами, когда остаток тела стал не нужен
+            error = None
+        response, counters = None, None
+        if error is None:
+            if head:
+                response = read_head_response(curl, buff)
+            else:
+                content, redirect_url = read_curl_response(curl, buff)
+                # счетчики уже найдены по ходу загрузки, повторно тело не просматривается
+                counters = buff.counters()
+        self.curl_pool.release(curl)
+
+        if head:
+            try:
+                probed = self.prober.check_head(history.next_url, response, error)
+            except pycurl.error as e:
+                return self._add_error_hop(history, callback, e)
+            if probed is None:
+                # нужно тело страницы или хост не понимает HEAD - повторяем переход GET-ом
+                history.probed_url = history.next_url
+                self.pending.appendleft((history, callback))
+                return 0
+            content, redirect_url = probed
+        elif error is not None:
+            return self._add_error_hop(history, callback, error)
+
+        if self.breaker:
+            self.breaker.record(host, True)
+        try:
+            hop = process_response(history.next_url, content, redirect_url)
+        except ValueError as e:
+            # кривой Location или meta-урл обрывает только эту цепочку, как в get_url;
+            # хост при этом ответил, и ошибкой хоста это не считается
+            return self._add_error_hop(history, callback, e, host_failed=False)
+        history.add_hop(*hop, counters=counters)
+        return self._advance(history, callback)
+
+    def _add_error_hop(self, history, callback, error, host_failed=True):
+        if history.expired():
+            # запрос оборвал остаток времени задачи, а не ошибка сайта
+            history.add_timeout()
+            return self._advance(history, callback)
+        logger.error(u'error in url {} {}'.format(history.next_url, error))
+        if self.breaker and host_failed:
+            self.breaker.record(get_host(history.next_url), False)
+        history.add_hop(history.next_url, REDIRECT_ERROR, None)
+        return self._advance(history, callback)
+
+    def _advance(self, history, callback):
+        if not history.done:
+            self.pending.appendleft((history, callback))
+            return 0
+
+        try:
+            callback(history.result())
+        except Exception as e:
+            logger.exception(e)
+        return 1
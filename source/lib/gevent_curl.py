@@ -0,0 +1,111 @@
+# coding: utf-8
+from gevent import get_hub
+from gevent.event import AsyncResult
+import pycurl
+
+# события io-вотчеров gevent (libev EV_READ / EV_WRITE)
+GEVENT_READ = 1
+GEVENT_WRITE = 2
+
+
+class GeventCurlMulti(object):
+    """
+    Выполняет curl-запросы гринлетов на одном pycurl.CurlMulti.
+
+    perform(curl) блокирует только вызвавший гринлет: CurlMulti сообщает о
+    своих сокетах и таймаутах (M_SOCKETFUNCTION, M_TIMERFUNCTION), а цикл
+    событий gevent будит его по активности на них. Так сотни запросов идут
+    одновременно в одном потоке, а код над make_pycurl_request остается
+    последовательным.
+    """
+
+    def __init__(self):
+        self.loop = get_hub().loop
+        self.multi = pycurl.CurlMulti()
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self._on_socket)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self._on_timer)
+        self.watchers = {}
+        self.timer = None
+        self.kick = None
+        self.results = {}
+
+    def perform(self, curl):
+        """
+        Аналог curl.perform() для гринлета
+
+        :raises pycurl.error: если запрос завершился ошибкой
+        """
+        result = AsyncResult()
+        self.results[curl] = result
+        self.multi.add_handle(curl)
+        if self.kick is None:
+            # не все версии pycurl вызывают M_TIMERFUNCTION из add_handle,
+            # поэтому новые запросы запускаются явно на следующей итерации цикла
+            self.kick = self.loop.run_callback(self._kick)
+        try:
+            result.get()
+        finally:
+            if self.results.pop(curl, None) is not None:
+                # гринлет прервали до завершения запроса
+                self.multi.remove_handle(curl)
+
+    def _on_socket(self, event, fd, multi, data):
+        watcher = self.watchers.pop(fd, None)
+        if watcher is not None:
+            watcher.stop()
+        if event == pycurl.POLL_REMOVE:
+            return
+
+        events = 0
+        if event in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+            events |= GEVENT_READ
+        if event in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+            events |= GEVENT_WRITE
+        watcher = self.loop.io(fd, events)
+        watcher.start(self._on_io, fd, pass_events=True)
+        self.watchers[fd] = watcher
+
+    def _on_timer(self, timeout_ms):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+        if timeout_ms >= 0:
+            self.timer = self.loop.timer(timeout_ms / 1000.0)
+            self.timer.start(self._socket_action, pycurl.SOCKET_TIMEOUT, 0)
+
+    def _kick(self):
+        self.kick = None
+        self._socket_action(pycurl.SOCKET_TIMEOUT, 0)
+
+    def _on_io(self, events, fd):
+        action = 0
+        if events & GEVENT_READ:
+            action |= pycurl.CSELECT_IN
+        if events & GEVENT_WRITE:
+            action |= pycurl.CSELECT_OUT
+        self._socket_action(fd, action)
+
+    def _socket_action(self, fd, action):
+        while True:
+            ret, _ = self.multi.socket_action(fd, action)
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+
+        while True:
+            queued, ok_list, err_list = self.multi.info_read()
+            for curl in ok_list:
+                self._finish(curl)
+            for curl, errno, errmsg in err_list:
+                self._finish(curl, pycurl.error(errno, errmsg))
+            if not queued:
+                break
+
+    def _finish(self, curl, error=None):
+        self.multi.remove_handle(curl)
+        result = self.results.pop(curl, None)
+        if result is None:
+            return
+        if error is None:
+            result.set()
+        else:
+            result.set_exception(error)
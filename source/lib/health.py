@@ -0,0 +1,71 @@
+# coding: utf-8
+from logging import getLogger
+from multiprocessing import Event, Process
+import os
+from time import sleep
+
+from utils import check_network_status
+
+logger = getLogger('redirect_checker')
+
+HEALTH_PROCESS_NAME = 'network-health'
+
+
+class NetworkHealth(object):
+    """
+    Фоновая проверка сети с гистерезисом.
+
+    Раз в interval секунд проверяются check_urls: проверка успешна, если
+    ответил хоть один урл. Сеть считается упавшей после fail_threshold
+    неудачных проверок подряд и восстановившейся после recover_threshold
+    успешных, так что одна сбойная проверка ничего не меняет. Проверки идут
+    в отдельном процессе, а состояние видно всем процессам через
+    up (multiprocessing.Event): воркеры не берут новые задачи, пока он сброшен.
+    """
+
+    def __init__(self, check_urls, timeout, interval=5, fail_threshold=3, recover_threshold=2):
+        self.check_urls = check_urls
+        self.timeout = timeout
+        self.interval = interval
+        self.fail_threshold = fail_threshold
+        self.recover_threshold = recover_threshold
+
+        self.up = Event()
+        self.up.set()
+        self.failures = 0
+        self.successes = 0
+        self.process = None
+
+    def is_up(self):
+        return self.up.is_set()
+
+    def probe(self):
+        return any(check_network_status(url, self.timeout) for url in self.check_urls)
+
+    def record(self, ok):
+        """Учитывает результат очередной проверки"""
+        if ok:
+            self.failures = 0
+            self.successes += 1
+            if not self.up.is_set() and self.successes >= self.recover_threshold:
+                logger.info('Network is up. resuming task intake')
+                self.up.set()
+        else:
+            self.successes = 0
+            self.failures += 1
+            if self.up.is_set() and self.failures >= self.fail_threshold:
+                logger.critical('Network is down. pausing task intake')
+                self.up.clear()
+
+    def run(self, parent_pid):
+        parent_proc = '/proc/{}'.format(parent_pid)
+        while os.path.exists(parent_proc):
+            self.record(self.probe())
+            sleep(self.interval)
+
+    def ensure_running(self, parent_pid):
+        """Запускает процесс проверок, если он не запущен или умер"""
+        if self.process is None or not self.process.is_alive():
+            self.process = Process(target=self.run, args=(parent_pid,), name=HEALTH_PROCESS_NAME)
+            self.process.daemon = True
+            self.process.start()
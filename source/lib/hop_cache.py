@@ -0,0 +1,155 @@
+# coding: utf-8
+import json
+from logging import getLogger
+import os
+import sqlite3
+from time import time
+
+from . import get_counters
+from shared_db import connect_shared_db
+
+logger = getLogger('redirect_checker')
+
+
+class HopCache(object):
+    """
+    Кэш переходов цепочек редиректов: подготовленный урл -> следующий урл и тип
+    редиректа, для конечных страниц - найденные на них счетчики.
+
+    Хранится в sqlite-файле, поэтому общий для всех воркеров на машине
+    (каждый процесс открывает свое соединение). Записи живут ttl секунд;
+    сверх max_entries удаляются давно не использованные. Попадания не пишут
+    в файл сразу: время использования записей обновляется пачкой раз в
+    touch_every попаданий и перед вытеснением. Ошибки кэша (в том числе
+    занятый другим процессом файл) не мешают проверке: запрос считается промахом.
+    """
+
+    evict_every = 100
+    touch_every = 100
+
+    def __init__(self, path, ttl=3600, max_entries=100000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {'hits': 0, 'misses': 0, 'errors': 0}
+        self.puts = 0
+        # урл -> время попадания, еще не записанное в файл
+        self.touched = {}
+
+        self.db = connect_shared_db(path)
+        try:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS hops ('
+                'url TEXT PRIMARY KEY, next_url TEXT, redirect_type TEXT, counters TEXT, '
+                'expires REAL, accessed REAL)'
+            )
+            self.db.execute('CREATE INDEX IF NOT EXISTS hops_accessed ON hops (accessed)')
+        except sqlite3.Error as e:
+            self._error(e)
+
+    def get(self, url):
+        """
+        :return: (следующий урл, тип редиректа, счетчики конечной страницы или None)
+            или None, если перехода нет в кэше
+        """
+        now = time()
+        try:
+            row = self.db.execute(
+                'SELECT next_url, redirect_type, counters FROM hops WHERE url = ? AND expires > ?',
+                (url, now)
+            ).fetchone()
+        except sqlite3.Error as e:
+            self._error(e)
+            row = None
+
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+        self.touched[url] = now
+        if len(self.touched) >= self.touch_every:
+            self.flush_touched()
+        next_url, redirect_type, counters = row
+        return next_url, redirect_type, json.loads(counters) if counters is not None else None
+
+    def put(self, url, redirect_url, redirect_type, content, counters=None):
+        """
+        Запоминает результат get_url для url. Ошибки не кэшируются
+
+        :param counters: счетчики конечной страницы, если уже найдены (None - ищутся в content)
+        """
+        if redirect_type == 'ERROR':
+            return
+
+        if redirect_url:
+            counters = None
+        else:
+            if counters is None:
+                counters = get_counters(content) if content else []
+            counters = json.dumps(counters)
+
+        now = time()
+        try:
+            self.db.execute(
+                'INSERT OR REPLACE INTO hops VALUES (?, ?, ?, ?, ?, ?)',
+                (url, redirect_url, redirect_type, counters, now + self.ttl, now)
+            )
+            self.puts += 1
+            if self.puts % self.evict_every == 0:
+                self.evict(now)
+        except sqlite3.Error as e:
+            self._error(e)
+
+    def flush_touched(self):
+        """Записывает время использования записей, на которые были попадания, одной транзакцией"""
+        touched, self.touched = self.touched, {}
+        if not touched:
+            return
+        try:
+            self.db.execute('BEGIN')
+            try:
+                self.db.executemany(
+                    'UPDATE hops SET accessed = ? WHERE url = ?', [(now, url) for url, now in touched.iteritems()]
+                )
+                self.db.execute('COMMIT')
+            except sqlite3.Error:
+                self.db.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            self._error(e)
+
+    def evict(self, now=None):
+        """Удаляет просроченные записи и давно не использованные сверх max_entries"""
+        self.flush_touched()
+        self.db.execute('DELETE FROM hops WHERE expires <= ?', (now or time(),))
+        self.db.execute(
+            'DELETE FROM hops WHERE url IN ('
+            'SELECT url FROM hops ORDER BY accessed LIMIT max((SELECT count(*) FROM hops) - ?, 0))',
+            (self.max_entries,)
+        )
+
+    def _error(self, e):
+        self.stats['errors'] += 1
+        logger.error(u'hop cache error {}'.format(e))
+
+
+_hop_cache = None
+_hop_cache_pid = None
+
+
+def init_hop_cache(path, ttl=3600, max_entries=100000):
+    """
+    Открывает кэш переходов для текущего процесса (path=None - кэш выключен)
+    """
+    global _hop_cache, _hop_cache_pid
+    _hop_cache = HopCache(path, ttl, max_entries) if path else None
+    _hop_cache_pid = os.getpid()
+    return _hop_cache
+
+
+def get_hop_cache():
+    """Кэш переходов текущего процесса или None, если он не открыт в этом процессе"""
+    if _hop_cache_pid != os.getpid():
+        return None
+    return _hop_cache
@@ -0,0 +1,101 @@
+# coding: utf-8
+from collections import OrderedDict
+import os
+
+import pycurl
+
+from . import HTML_CONTENT_TYPE
+from scheduler import get_host
+
+PROBE_GET = 'get'
+PROBE_HEAD = 'head'
+
+# ошибки, после которых повторять переход GET-ом бессмысленно: хост недоступен или не успел ответить
+NO_FALLBACK_ERRORS = (pycurl.E_COULDNT_RESOLVE_HOST, pycurl.E_COULDNT_CONNECT, pycurl.E_OPERATION_TIMEDOUT)
+
+# статусы ответа на HEAD, которыми хост говорит, что не поддерживает метод
+NO_HEAD_STATUSES = (405, 501)
+
+# ошибки протокола, которыми на HEAD отвечают хосты, не умеющие его обрабатывать:
+# пустой ответ, тело в ответе на HEAD, обрыв ответа (E_FTP_WEIRD_SERVER_REPLY в старых
+# pycurl - это и CURLE_WEIRD_SERVER_REPLY для HTTP)
+NO_HEAD_ERRORS = (
+    pycurl.E_GOT_NOTHING, pycurl.E_FTP_WEIRD_SERVER_REPLY, pycurl.E_PARTIAL_FILE, pycurl.E_RECV_ERROR
+)
+
+
+class HeadProber(object):
+    """
+    Решает, пройден ли переход по ответу на HEAD-запрос или нужен полный GET.
+
+    Тело ответа не нужно, если в ответе есть Location или страница не html.
+    Хосты, не поддерживающие HEAD (405 или 501 в ответ, ошибка протокола),
+    запоминаются (не больше max_hosts), и для них переходы сразу запрашиваются
+    GET-ом. После других ошибочных ответов GET-ом повторяется только этот переход.
+    """
+
+    def __init__(self, max_hosts=10000):
+        self.max_hosts = max_hosts
+        self.no_head_hosts = OrderedDict()
+        self.stats = {'head': 0, 'need_body': 0, 'fallback': 0}
+
+    def use_head(self, url):
+        return get_host(url) not in self.no_head_hosts
+
+    def check_head(self, url, response=None, error=None):
+        """
+        Разбирает ответ на HEAD-запрос к url (результат read_head_response) или его ошибку.
+
+        :return: содержимое страницы (пустое) и урл редиректа, если переход пройден,
+            или None, если нужен GET
+        :raises pycurl.error: если хост недоступен или не ответил вовремя и GET тоже не пройдет
+        """
+        self.stats['head'] += 1
+        code = error.args[0] if error is not None and error.args else None
+        if code in NO_FALLBACK_ERRORS:
+            raise error
+
+        if error is not None or response[0] >= 400:
+            self.stats['fallback'] += 1
+            if code in NO_HEAD_ERRORS or (error is None and response[0] in NO_HEAD_STATUSES):
+                self._remember(get_host(url))
+            return None
+
+        status, content_type, redirect_url = response
+        if redirect_url is not None:
+            return '', redirect_url
+        if content_type and not HTML_CONTENT_TYPE.match(content_type):
+            return '', None
+
+        self.stats['need_body'] += 1
+        return None
+
+    def _remember(self, host):
+        self.no_head_hosts.pop(host, None)
+        self.no_head_hosts[host] = True
+        while len(self.no_head_hosts) > self.max_hosts:
+            self.no_head_hosts.popitem(last=False)
+
+
+_head_prober = None
+_head_prober_pid = None
+
+
+def init_head_prober(mode=PROBE_GET, max_hosts=10000):
+    """
+    Выбирает способ запроса переходов для текущего процесса:
+    PROBE_GET - всегда GET, PROBE_HEAD - сначала HEAD
+    """
+    global _head_prober, _head_prober_pid
+    if mode not in (PROBE_GET, PROBE_HEAD):
+        raise ValueError(u'Unknown probe mode {}'.format(mode))
+    _head_prober = HeadProber(max_hosts) if mode == PROBE_HEAD else None
+    _head_prober_pid = os.getpid()
+    return _head_prober
+
+
+def get_head_prober():
+    """HeadProber текущего процесса или None, если переходы запрашиваются GET-ом"""
+    if _head_prober_pid != os.getpid():
+        return None
+    return _head_prober
@@ -0,0 +1,125 @@
+# coding: utf-8
+import errno
+from logging import getLogger
+import os
+import select
+import socket
+from time import time
+
+import tarantool
+from tarantool.error import NetworkError
+from tarantool_queue import tarantool_queue
+
+logger = getLogger('redirect_checker')
+
+
+class QueueConnection(tarantool.Connection):
+    """
+    Соединение с tarantool, общее для всех очередей процесса на одном host:port.
+
+    Перед каждым запросом проверяет, что сокет жив, и при необходимости
+    переподключается. После неудачного подключения следующая попытка будет
+    не раньше чем через backoff секунд, задержка удваивается с каждой неудачей
+    до max_backoff. До этого запросы сразу завершаются NetworkError, не блокируя
+    воркер. Любая сетевая ошибка запроса тоже приходит как NetworkError.
+
+    При разрыве соединения сервер возвращает в очередь все задачи, взятые
+    через него, поэтому каждое подключение - новая сессия (session): задачи
+    прошлых сессий уже не принадлежат воркеру (см. utils.is_stale_task).
+    """
+
+    def __init__(self, host, port, backoff=0.1, max_backoff=10, socket_timeout=None):
+        kwargs = {'socket_timeout': socket_timeout} if socket_timeout is not None else {}
+        super(QueueConnection, self).__init__(host, port, connect_now=False, **kwargs)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.retry_at = 0
+        self.session = 0
+        self.stats = {'requests': 0, 'reconnects': 0, 'failures': 0}
+
+    def is_alive(self):
+        if self._socket is None or not self.connected:
+            return False
+        try:
+            readable, _, _ = select.select([self._socket], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        # между запросами сервер ничего не присылает: данные или EOF
+        # на сокете значат, что соединение разорвано
+        return not readable
+
+    def _opt_reconnect(self):
+        if self.is_alive():
+            return
+
+        now = time()
+        if now < self.retry_at:
+            raise NetworkError(socket.error(errno.ECONNREFUSED, 'Reconnect to {}:{} in {:.1f}s'.format(
+                self.host, self.port, self.retry_at - now
+            )))
+        try:
+            self.connect()
+        except NetworkError:
+            self.failures += 1
+            self.stats['failures'] += 1
+            self.retry_at = now + min(self.backoff * 2 ** (self.failures - 1), self.max_backoff)
+            logger.warning(u'Connection to {}:{} failed {} times in a row'.format(
+                self.host, self.port, self.failures
+            ))
+            raise
+        self.session += 1
+        if self.stats['requests']:
+            logger.info(u'Reconnected to {}:{}'.format(self.host, self.port))
+            self.stats['reconnects'] += 1
+        self.failures = 0
+
+    def _send_request(self, request, *args, **kwargs):
+        self.stats['requests'] += 1
+        try:
+            return super(QueueConnection, self)._send_request(request, *args, **kwargs)
+        except (NetworkError, socket.error) as e:
+            # ответ мог быть прочитан не до конца: сокет больше не годится
+            self.connected = False
+            if isinstance(e, NetworkError):
+                raise
+            raise NetworkError(socket.error(e.errno or errno.ECONNRESET, str(e)))
+
+
+class SharedQueue(tarantool_queue.Queue):
+    """
+    tarantool_queue.Queue, запросы которого идут через общее соединение
+    """
+
+    def __init__(self, connection, space):
+        super(SharedQueue, self).__init__(host=connection.host, port=connection.port, space=space)
+        self.connection = connection
+
+    @property
+    def tnt(self):
+        return self.connection
+
+
+_connections = {}
+_queues = {}
+_registry_pid = None
+
+
+def get_queue(host, port, space):
+    """
+    Очередь пространства space на host:port. Очереди процесса с одним
+    host:port используют одно соединение, с одним пространством - один объект.
+    Соединения родительского процесса после форка не используются.
+    """
+    global _registry_pid
+    if _registry_pid != os.getpid():
+        _connections.clear()
+        _queues.clear()
+        _registry_pid = os.getpid()
+
+    key = (host, port, space)
+    if key not in _queues:
+        if (host, port) not in _connections:
+            _connections[(host, port)] = QueueConnection(host, port)
+        _queues[key] = SharedQueue(_connections[(host, port)], space)
+    return _queues[key]
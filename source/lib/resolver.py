@@ -0,0 +1,173 @@
+# coding: utf-8
+from collections import OrderedDict
+from logging import getLogger
+import os
+from Queue import Queue
+import socket
+import threading
+from time import time
+from urlparse import urlsplit
+
+import pycurl
+
+logger = getLogger('redirect_checker')
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# с libcurl 7.75 записи CURLOPT_RESOLVE с "+" устаревают в кэше curl как обычные, а не живут вечно
+RESOLVE_PREFIX = '+' if pycurl.version_info()[2] >= 0x074b00 else ''
+# несколько адресов хоста в одной записи CURLOPT_RESOLVE понимает libcurl с 7.59
+RESOLVE_MULTIPLE = pycurl.version_info()[2] >= 0x073b00
+
+
+def is_ip_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+
+def split_host_port(url):
+    """
+    :return: хост и порт урла или None, если урл без хоста или с ip-адресом
+        (резолвить нечего)
+    """
+    try:
+        parts = urlsplit(url)
+        host, port = parts.hostname, parts.port or DEFAULT_PORTS.get(parts.scheme.lower())
+    except ValueError:
+        return None
+    if not host or not port or is_ip_address(host):
+        return None
+    return host.lower(), port
+
+
+class DnsCache(object):
+    """
+    Кэш DNS воркера с разрешением имен в фоне.
+
+    Хосты резолвятся в threads фоновых потоках (socket.getaddrinfo), поэтому
+    prefetch() не блокирует: адреса хоста следующего перехода ищутся, пока
+    загружается текущий ответ. Найденные адреса передаются curl через
+    CURLOPT_RESOLVE все сразу, чтобы curl мог перейти к следующему, если
+    первый не отвечает, как при обычном резолвинге. Адреса живут ttl секунд, неудачи кэшируются на negative_ttl
+    секунд, и запросы к таким хостам сразу завершаются ошибкой резолвинга.
+    Пока адреса не найдены, curl резолвит хост сам, как без кэша.
+    """
+
+    def __init__(self, ttl=300, negative_ttl=30, max_entries=10000, threads=4):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.stats = {'hits': 0, 'misses': 0, 'negative_hits': 0, 'prefetches': 0, 'resolved': 0, 'failed': 0}
+
+        # хост -> (кортеж адресов или None для неудачи, время истечения)
+        self.entries = OrderedDict()
+        self.resolving = set()
+        self.lock = threading.Lock()
+        self.queue = Queue()
+        for _ in xrange(threads):
+            thread = threading.Thread(target=self._resolve_loop)
+            thread.daemon = True
+            thread.start()
+
+    def prefetch(self, url):
+        """Ставит хост урла в очередь на резолвинг, если его адресов нет в кэше"""
+        host_port = split_host_port(url)
+        if host_port is None:
+            return
+        host = host_port[0]
+        now = time()
+        with self.lock:
+            entry = self.entries.get(host)
+            if (entry is not None and entry[1] > now) or host in self.resolving:
+                return
+            self.resolving.add(host)
+            self.stats['prefetches'] += 1
+        self.queue.put(host)
+
+    def lookup(self, host, now=None):
+        """
+        :return: (найден ли хост в кэше, кортеж адресов или None для закэшированной неудачи)
+        """
+        now = now or time()
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is None or entry[1] <= now:
+                self.stats['misses'] += 1
+                return False, None
+            if entry[0] is None:
+                self.stats['negative_hits'] += 1
+            else:
+                self.stats['hits'] += 1
+            return True, entry[0]
+
+    def curl_resolve(self, url):
+        """
+        Значение CURLOPT_RESOLVE для запроса урла. Если хоста нет в кэше,
+        ставит его на резолвинг для следующих запросов.
+
+        :return: список "хост:порт:адрес1,адрес2,..." (пустой, если адреса не известны)
+        :raises pycurl.error: если хост недавно не удалось разрешить
+        """
+        host_port = split_host_port(url)
+        if host_port is None:
+            return []
+        host, port = host_port
+        found, addresses = self.lookup(host)
+        if not found:
+            self.prefetch(url)
+            return []
+        if addresses is None:
+            raise pycurl.error(pycurl.E_COULDNT_RESOLVE_HOST, 'Could not resolve host: {} (cached)'.format(host))
+        if not RESOLVE_MULTIPLE:
+            addresses = addresses[:1]
+        addresses = ','.join('[{}]'.format(address) if ':' in address else address for address in addresses)
+        return ['{}{}:{}:{}'.format(RESOLVE_PREFIX, host, port, addresses)]
+
+    def _resolve_loop(self):
+        while True:
+            host = self.queue.get()
+            addresses = None
+            try:
+                addresses = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+            except (socket.error, UnicodeError) as e:
+                logger.info(u'dns prefetch failed for {} {}'.format(host, e))
+            else:
+                # в порядке getaddrinfo, без повторов
+                addresses = tuple(OrderedDict((info[4][0], None) for info in addresses)) or None
+            self._store(host, addresses)
+
+    def _store(self, host, addresses, now=None):
+        expires = (now or time()) + (self.ttl if addresses is not None else self.negative_ttl)
+        with self.lock:
+            self.resolving.discard(host)
+            self.stats['resolved' if addresses is not None else 'failed'] += 1
+            self.entries.pop(host, None)
+            self.entries[host] = (addresses, expires)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+_dns_cache = None
+_dns_cache_pid = None
+
+
+def init_dns_cache(ttl=300, negative_ttl=30, max_entries=10000, threads=4):
+    """
+    Запускает кэш DNS для текущего процесса (threads=0 - кэш выключен)
+    """
+    global _dns_cache, _dns_cache_pid
+    _dns_cache = DnsCache(ttl, negative_ttl, max_entries, threads) if threads else None
+    _dns_cache_pid = os.getpid()
+    return _dns_cache
+
+
+def get_dns_cache():
+    """Кэш DNS текущего процесса или None, если он не запущен в этом процессе"""
+    if _dns_cache_pid != os.getpid():
+        return None
+    return _dns_cache
@@ -0,0 +1,92 @@
+# coding: utf-8
+import os
+from time import time, sleep
+from urlparse import urlsplit
+
+
+def get_host(url):
+    try:
+        return (urlsplit(url).hostname or '').lower()
+    except ValueError:
+        return ''
+
+
+class HostScheduler(object):
+    """
+    Ограничения на запросы к одному хосту: не больше max_concurrency одновременных
+    запросов и не больше max_rate запросов в секунду (None - без ограничения).
+
+    RedirectEngine сам откладывает цепочки по can_start()/delay(); при проверке
+    по одной задаче и в гринлетах место запроса ждут в acquire() функцией sleep
+    (в гринлетах - gevent.sleep).
+    """
+
+    # как часто проверять, не освободилось ли место одновременного запроса
+    poll_interval = 0.05
+
+    def __init__(self, max_concurrency=None, max_rate=None, sleep=sleep):
+        self.max_concurrency = max_concurrency
+        self.min_interval = 1.0 / max_rate if max_rate else 0
+        self.sleep = sleep
+        self.active = {}
+        self.next_start = {}
+
+    def can_start(self, host, now):
+        if self.max_concurrency and self.active.get(host, 0) >= self.max_concurrency:
+            return False
+        return self.next_start.get(host, 0) <= now
+
+    def delay(self, host, now):
+        """
+        Через сколько секунд к хосту можно будет обратиться по ограничению частоты
+        (0 - уже можно или хост ждет завершения одновременных запросов)
+        """
+        return max(self.next_start.get(host, 0) - now, 0)
+
+    def acquire(self, host, deadline=None):
+        """
+        Ждет, пока к хосту можно будет обратиться, и занимает место запроса
+        (освобождает его finish()).
+
+        :return: занято ли место до deadline (time())
+        """
+        while True:
+            now = time()
+            if self.can_start(host, now):
+                self.start(host, now)
+                return True
+            if deadline is not None and now >= deadline:
+                return False
+            wait = self.delay(host, now) or self.poll_interval
+            self.sleep(min(wait, deadline - now) if deadline is not None else wait)
+
+    def start(self, host, now):
+        self.active[host] = self.active.get(host, 0) + 1
+        if self.min_interval:
+            self.next_start[host] = now + self.min_interval
+
+    def finish(self, host, now):
+        active = self.active.pop(host, 0) - 1
+        if active > 0:
+            self.active[host] = active
+        if self.next_start.get(host, now) < now:
+            del self.next_start[host]
+
+
+_host_scheduler = None
+_host_scheduler_pid = None
+
+
+def init_host_scheduler(max_concurrency=None, max_rate=None, sleep=sleep):
+    """Создает ограничения на запросы к хостам для текущего процесса"""
+    global _host_scheduler, _host_scheduler_pid
+    _host_scheduler = HostScheduler(max_concurrency, max_rate, sleep)
+    _host_scheduler_pid = os.getpid()
+    return _host_scheduler
+
+
+def get_host_scheduler():
+    """Ограничения на запросы к хостам текущего процесса или None, если они не созданы в этом процессе"""
+    if _host_scheduler_pid != os.getpid():
+        return None
+    return _host_scheduler
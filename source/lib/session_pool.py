@@ -0,0 +1,116 @@
+# coding: utf-8
+from cookielib import DefaultCookiePolicy
+import os
+from time import time
+from urlparse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class NoCookiesPolicy(DefaultCookiePolicy):
+    """Политика cookie-jar, которая не сохраняет и не отправляет cookies"""
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+class SessionPool(object):
+    """
+    Keep-alive сессии requests одного процесса: по сессии на хост (схема и host:port).
+
+    Сессия держит не больше max_connections соединений с хостом, запросы
+    сверх этого ждут освободившегося соединения. Сессии создаются при первом
+    запросе к хосту, то есть после patch_all: ожидание соединения и сами сокеты
+    переключают гринлеты, поэтому сессии можно делить между гринлетами.
+    Сессии без запросов дольше idle_timeout закрываются.
+
+    Через одну сессию хоста идут колбэки разных клиентов, поэтому cookies
+    в сессиях не сохраняются (NoCookiesPolicy): иначе cookie, выставленная
+    ответом на колбэк одного клиента, ушла бы с колбэком другого.
+    """
+
+    def __init__(self, max_connections=10, idle_timeout=60):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+
+        # хост -> [сессия, запросов в работе, время последнего запроса]
+        self.sessions = {}
+        self.stats = {'created': 0, 'requests': 0, 'evicted': 0}
+
+    def post(self, url, *args, **kwargs):
+        """requests.post через сессию хоста url"""
+        self.evict_idle()
+        entry = self._get_entry(url)
+        entry[1] += 1
+        self.stats['requests'] += 1
+        try:
+            return entry[0].post(url, *args, **kwargs)
+        finally:
+            entry[1] -= 1
+            entry[2] = time()
+
+    def evict_idle(self, now=None):
+        deadline = (now or time()) - self.idle_timeout
+        for host, (session, active, used) in self.sessions.items():
+            if not active and used < deadline:
+                del self.sessions[host]
+                session.close()
+                self.stats['evicted'] += 1
+
+    def host_stats(self):
+        """
+        :return: хост -> запросов в работе, открыто соединений, запросов всего
+        """
+        stats = {}
+        for host, (session, active, _) in self.sessions.iteritems():
+            pools = [
+                adapter.poolmanager.pools[key]
+                for adapter in session.adapters.itervalues()
+                for key in adapter.poolmanager.pools.keys()
+            ]
+            stats[host] = {
+                'active': active,
+                'connections': sum(pool.num_connections for pool in pools),
+                'requests': sum(pool.num_requests for pool in pools)
+            }
+        return stats
+
+    def _get_entry(self, url):
+        parts = urlsplit(url)
+        host = (parts.scheme, parts.netloc.lower())
+        if host not in self.sessions:
+            session = requests.Session()
+            session.cookies.set_policy(NoCookiesPolicy())
+            for prefix in ('http://', 'https://'):
+                session.mount(prefix, HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.max_connections, pool_block=True
+                ))
+            self.sessions[host] = [session, 0, time()]
+            self.stats['created'] += 1
+        return self.sessions[host]
+
+
+_session_pool = None
+_session_pool_pid = None
+
+
+def init_session_pool(max_connections=10, idle_timeout=60):
+    """Создает пул сессий текущего процесса с заданными настройками"""
+    global _session_pool, _session_pool_pid
+    _session_pool = SessionPool(max_connections, idle_timeout)
+    _session_pool_pid = os.getpid()
+    return _session_pool
+
+
+def get_session_pool():
+    """
+    Пул сессий текущего процесса. После fork дочерний процесс получает
+    собственный пул, а не копию родительского.
+    """
+    if _session_pool is None or _session_pool_pid != os.getpid():
+        return init_session_pool()
+    return _session_pool
@@ -0,0 +1,26 @@
+# coding: utf-8
+from logging import getLogger
+import sqlite3
+
+logger = getLogger('redirect_checker')
+
+# сколько секунд ждать блокировки файла: пока ждем, стоит весь цикл воркера
+BUSY_TIMEOUT = 0.1
+
+
+def connect_shared_db(path, busy_timeout=BUSY_TIMEOUT):
+    """
+    Соединение с sqlite-файлом, общим для всех воркеров на машине.
+
+    Журнал WAL: чтения не ждут записей других процессов, а записи - чтений;
+    synchronous=NORMAL: транзакция не ждет fsync (при сбое машины теряются
+    только последние записи, а это кэш). Режим журнала хранится в самом файле,
+    поэтому если его сейчас переключает другой процесс, ошибка пропускается.
+    """
+    db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None)
+    try:
+        db.execute('PRAGMA journal_mode=WAL')
+    except sqlite3.OperationalError as e:
+        logger.warning(u'can not switch {} to WAL: {}'.format(path, e))
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
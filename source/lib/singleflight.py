@@ -0,0 +1,176 @@
+# coding: utf-8
+import json
+from logging import getLogger
+import os
+import sqlite3
+from time import time
+
+import gevent
+
+from shared_db import connect_shared_db
+
+logger = getLogger('redirect_checker')
+
+
+class SingleFlight(object):
+    """
+    Совмещение проверок одного урла (singleflight).
+
+    Пока цепочка редиректов урла проверяется одним воркером (владельцем),
+    задачи с тем же подготовленным урлом в других воркерах не идут в сеть,
+    а ждут и берут его результат. Хранится в sqlite-файле, поэтому общий
+    для всех воркеров на машине. Готовый результат виден еще linger секунд,
+    чтобы его успели забрать все ждущие. Если владелец не опубликовал
+    результат за lease секунд (завис или умер), проверку забирает следующий
+    ждущий. Ошибки базы не мешают проверке: урл проверяется без совмещения.
+    """
+
+    evict_every = 100
+    poll_interval = 0.05
+
+    def __init__(self, path, lease=30, linger=5):
+        self.path = path
+        self.lease = lease
+        self.linger = linger
+        self.owner = os.getpid()
+        self.stats = {'owned': 0, 'shared': 0, 'taken_over': 0, 'errors': 0}
+        self.publishes = 0
+
+        self.db = connect_shared_db(path)
+        try:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS flights (url TEXT PRIMARY KEY, owner INTEGER, started REAL, '
+                'result TEXT, finished REAL)'
+            )
+        except sqlite3.Error as e:
+            self._error(e)
+
+    def join(self, url, now=None):
+        """
+        Присоединяется к проверке урла или начинает ее.
+
+        :return: (проверять ли урл самому, результат get_redirect_history
+            или None, если проверка еще идет). Начавший проверку должен
+            вызвать publish() или abandon()
+        """
+        now = now or time()
+        try:
+            # ждущие только читают; блокировка на запись - лишь чтобы начать проверку
+            state, result = self._state(url, now)
+            if state not in ('done', 'running'):
+                self.db.execute('BEGIN IMMEDIATE')
+                try:
+                    state, result = self._state(url, now)
+                    if state not in ('done', 'running'):
+                        self.db.execute(
+                            'INSERT OR REPLACE INTO flights VALUES (?, ?, ?, NULL, NULL)', (url, self.owner, now)
+                        )
+                    self.db.execute('COMMIT')
+                except sqlite3.Error:
+                    self.db.execute('ROLLBACK')
+                    raise
+        except sqlite3.Error as e:
+            self._error(e)
+            return True, None
+
+        if state == 'done':
+            self.stats['shared'] += 1
+            return False, result
+        if state == 'running':
+            return False, None
+        if state == 'stale':
+            self.stats['taken_over'] += 1
+            logger.warning(u'Check of url {} is stale. taken over'.format(url))
+        self.stats['owned'] += 1
+        return True, None
+
+    def _state(self, url, now):
+        """
+        :return: (состояние проверки урла, результат): 'done' - есть свежий результат,
+            'running' - урл проверяется, 'stale' - проверка зависла, 'free' - урл не проверяется
+        """
+        row = self.db.execute('SELECT started, result, finished FROM flights WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return 'free', None
+        started, result, finished = row
+        if result is not None:
+            return ('done', json.loads(result)) if finished > now - self.linger else ('free', None)
+        return ('running' if started > now - self.lease else 'stale'), None
+
+    def publish(self, url, result, now=None):
+        """Сохраняет результат проверки урла для ждущих"""
+        now = now or time()
+        try:
+            self.db.execute(
+                'UPDATE flights SET result = ?, finished = ? WHERE url = ? AND owner = ?',
+                (json.dumps(result), now, url, self.owner)
+            )
+            self.publishes += 1
+            if self.publishes % self.evict_every == 0:
+                self.evict(now)
+        except sqlite3.Error as e:
+            self._error(e)
+
+    def abandon(self, url):
+        """Отказывается от проверки урла: ее начнет следующий ждущий"""
+        try:
+            self.db.execute(
+                'DELETE FROM flights WHERE url = ? AND owner = ? AND result IS NULL', (url, self.owner)
+            )
+        except sqlite3.Error as e:
+            self._error(e)
+
+    def resolve(self, url, check):
+        """
+        Результат проверки урла: свой (check()) или другого воркера.
+        Ждет через gevent.sleep, так что в режиме gevent не блокирует
+        остальные гринлеты процесса.
+        """
+        while True:
+            owned, result = self.join(url)
+            if result is not None:
+                return result
+            if owned:
+                break
+            gevent.sleep(self.poll_interval)
+
+        try:
+            result = check()
+        except Exception:
+            self.abandon(url)
+            raise
+        self.publish(url, result)
+        return result
+
+    def evict(self, now=None):
+        """Удаляет результаты старше linger и зависшие проверки"""
+        now = now or time()
+        self.db.execute(
+            'DELETE FROM flights WHERE (result IS NOT NULL AND finished <= ?) OR (result IS NULL AND started <= ?)',
+            (now - self.linger, now - self.lease)
+        )
+
+    def _error(self, e):
+        self.stats['errors'] += 1
+        logger.error(u'single flight error {}'.format(e))
+
+
+_single_flight = None
+_single_flight_pid = None
+
+
+def init_single_flight(path, lease=30, linger=5):
+    """
+    Открывает совмещение проверок для текущего процесса (path=None - выключено)
+    """
+    global _single_flight, _single_flight_pid
+    _single_flight = SingleFlight(path, lease, linger) if path else None
+    _single_flight_pid = os.getpid()
+    return _single_flight
+
+
+def get_single_flight():
+    """Совмещение проверок текущего процесса или None, если оно не открыто в этом процессе"""
+    if _single_flight_pid != os.getpid():
+        return None
+    return _single_flight
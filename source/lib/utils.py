@@ -7,6 +7,8 @@ import urllib2
 
 from tarantool_queue import tarantool_queue
 
+from queue_connection import get_queue
+
 
 def daemonize():
     """
@@ -102,10 +104,128 @@ def parse_cmd_args(args, app_description=''):
 
 
 def get_tube(host, port, space, name):
-    queue = tarantool_queue.Queue(
-        host=host, port=port, space=space
-    )
-    return queue.tube(name)
+    """
+    Очередь (tube) name. Очереди процесса на одном host:port работают
+    через одно соединение с переподключением (см. get_queue).
+    """
+    return get_queue(host, port, space).tube(name)
+
+
+def take_many(tube, count, timeout):
+    """
+    Берет из очереди до count задач за один запрос (queue.take_many):
+    ждет первую задачу не дольше timeout секунд, остальные берет из уже готовых.
+
+    :param tube: очередь
+    :type tube: tarantool_queue.Tube
+
+    :rtype: list of tarantool_queue.Task
+    """
+    if count <= 0:
+        return []
+    queue = tube.queue
+    response = queue.tnt.call('queue.take_many', (
+        str(queue.space), str(tube.opt['tube']), str(count), str(timeout)
+    ))
+    tasks = [
+        tarantool_queue.Task(queue, space=queue.space, task_id=row[0], tube=row[1], status=row[2], raw_data=row[3])
+        for row in response
+    ]
+    for task in tasks:
+        mark_session(task)
+    return tasks
+
+
+def mark_session(task):
+    """Запоминает сессию соединения, в которой взята задача (см. is_stale_task)"""
+    task.session = getattr(task.queue.tnt, 'session', None)
+
+
+# приоритеты очереди, как в provision/init.lua
+MAX_PRI = 0xFF
+DEFAULT_PRI = 0x7F
+
+
+def task_priority(task):
+    """
+    Приоритет, с которым задача была положена в очередь (queue.put).
+    Сервер хранит его сдвинутым и перевернутым (max_pri - (pri + default.pri)),
+    и так же его возвращает queue.meta; queue.ack_and_put с пустым pri
+    переводит его обратно той же формулой.
+
+    :rtype: int
+    """
+    return MAX_PRI - int(task.meta()['pri']) - DEFAULT_PRI
+
+
+def is_stale_task(task):
+    """
+    Взята ли задача в сессии соединения, которая уже закончилась: при разрыве
+    сервер вернул задачу в очередь, и подтверждать ее или отправлять ее результат
+    нельзя. Задачи без отмеченной сессии (mark_session) не считаются устаревшими.
+    """
+    session = vars(task).get('session')
+    return session is not None and session != getattr(task.queue.tnt, 'session', None)
+
+
+def same_server(tube, other_tube):
+    """Очереди на одном сервере tarantool"""
+    return (tube.queue.host, tube.queue.port) == (other_tube.queue.host, other_tube.queue.port)
+
+
+def ack_and_put(tube, settlements):
+    """
+    Подтверждает взятые из tube задачи и кладет их результаты в очереди
+    того же сервера одним запросом (queue.ack_and_put).
+
+    :param tube: очередь, из которой взяты задачи
+    :type tube: tarantool_queue.Tube
+    :param settlements: список (задача, очередь для результата, данные, опции put);
+        pri=None - приоритет подтверждаемой задачи
+
+    :return: id подтвержденных задач
+    :rtype: set
+    """
+    queue = tube.queue
+    args = [str(queue.space)]
+    for task, put_tube, data, opt in settlements:
+        opt = dict(put_tube.opt, **opt)
+        args.extend((
+            task.task_id,
+            str(put_tube.queue.space),
+            str(opt['tube']),
+            str(opt['delay']),
+            str(opt['ttl']),
+            str(opt['ttr']),
+            '' if opt['pri'] is None else str(opt['pri']),
+            put_tube.serialize(data)
+        ))
+        task.modified = True
+    response = queue.tnt.call('queue.ack_and_put', tuple(args))
+    return set(row[0] for row in response)
+
+
+def settle_many(tube, settlements):
+    """
+    Подтверждает (ack) или хоронит (bury) взятые из tube задачи
+    одним запросом (queue.settle).
+
+    :param tube: очередь, из которой взяты задачи
+    :type tube: tarantool_queue.Tube
+    :param settlements: список (задача, 'ack' или 'bury')
+
+    :return: id задач, к которым применено действие
+    :rtype: set
+    """
+    if not settlements:
+        return set()
+    queue = tube.queue
+    args = [str(queue.space)]
+    for task, action_name in settlements:
+        args.extend((action_name, task.task_id))
+        task.modified = True
+    response = queue.tnt.call('queue.settle', tuple(args))
+    return set(row[0] for row in response)
 
 
 class Config(object):
@@ -115,11 +235,32 @@ class Config(object):
     pass
 
 
-def spawn_workers(num, target, args, parent_pid):
+def spawn_workers(num, target, args, parent_pid, kwargs=None, name=None):
+    """
+    :param name: имя процессов (None - по умолчанию multiprocessing)
+    :return: запущенные процессы
+    """
+    processes = []
     for _ in xrange(num):
-        p = Process(target=target, args=args, kwargs={'parent_pid': parent_pid})
+        p = Process(target=target, args=args, kwargs=dict(kwargs or {}, parent_pid=parent_pid), name=name)
         p.daemon = True
         p.start()
+        processes.append(p)
+    return processes
+
+
+def get_process_memory(pid):
+    """
+    :return: (RSS процесса, часть RSS в разделяемых страницах) в байтах
+        или None, если процесса уже нет
+    """
+    try:
+        with open('/proc/{}/statm'.format(pid)) as f:
+            resident, shared = f.read().split()[1:3]
+    except (IOError, ValueError):
+        return None
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    return int(resident) * page_size, int(shared) * page_size
 
 
 def check_network_status(check_url, timeout):
@@ -1,28 +1,75 @@
 # coding: utf-8
+from copy import copy
+from functools import partial
+import gc
 from logging import getLogger
+from math import ceil
 import os.path
+import signal
+from time import time, sleep
 
+import gevent
+from gevent.monkey import patch_all
+from gevent.pool import Pool
 from tarantool.error import DatabaseError
-from . import to_unicode, get_redirect_history
+from . import to_unicode, get_redirect_history, prepare_url, set_meta_parser, set_curl_performer, \
+    META_PARSER_BS4, REDIRECT_ERROR, REDIRECT_TIMEOUT
+from breaker import init_host_breaker, get_host_breaker
+from curl_pool import init_curl_pool, get_curl_pool
+from engine import RedirectEngine
+from gevent_curl import GeventCurlMulti
+from hop_cache import init_hop_cache, get_hop_cache
+from probe import init_head_prober, get_head_prober
+from resolver import init_dns_cache, get_dns_cache
+from scheduler import init_host_scheduler, get_host_scheduler, get_host
+from singleflight import init_single_flight, get_single_flight
 
-from utils import get_tube
+from utils import get_tube, take_many, same_server, ack_and_put, mark_session, is_stale_task, task_priority
 
 logger = getLogger('redirect_checker')
 
+# режимы воркера: цепочки на RedirectEngine (или по одной задаче) и задачи в гринлетах
+WORKER_MODE_MULTI = 'multi'
+WORKER_MODE_GEVENT = 'gevent'
 
-def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=None):
+# сигнал воркеру доделать начатые задачи и завершиться
+WORKER_STOP_SIGNAL = signal.SIGUSR1
+
+# имя процессов группы воркеров, проверяющих перепроверки
+RECHECK_WORKER_NAME = 'recheck-worker'
+
+# сколько секунд ждать задач, пока в движке есть цепочки: queue.take с нулевым
+# таймаутом ждет задачу бесконечно, поэтому таймаут маленький, но не нулевой
+BUSY_TAKE_TIMEOUT = 0.01
+
+_stop_requested = False
+
+
+def get_task_url(task):
     url = to_unicode(task.data['url'], 'ignore')
     is_recheck = bool(task.data.get('recheck'))
 
     logger.info(u'Task id={} url={} url_id={} is_recheck={}'.format(
         task.task_id, url, task.data["url_id"], is_recheck
     ))
+    return url
 
-    history_types, history_urls, counters = get_redirect_history(
-        url, timeout, max_redirects, user_agent
-    )
+
+def make_task_result(task, history, breaker=None):
+    """
+    Формирует результат задачи по истории редиректов.
+    Если задан breaker (HostBreaker), а хост, на котором оборвалась цепочка,
+    выключен, перепроверка откладывается до его пробы (recheck_delay в данных).
+
+    :return: (нужно ли вернуть задачу во входную очередь на перепроверку, данные)
+    """
+    history_types, history_urls, counters = history
+    is_recheck = bool(task.data.get('recheck'))
     if 'ERROR' in history_types and not is_recheck:
         task.data['recheck'] = True
+        delay = breaker.retry_delay(get_host(history_urls[-1])) if breaker is not None and history_urls else 0
+        if delay:
+            task.data['recheck_delay'] = int(ceil(delay))
         data = task.data
         is_input = True
     else:
@@ -38,36 +85,387 @@ def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=N
     return is_input, data
 
 
-def handle_next_task(config, input_tube, output_tube):
+def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=None, max_body_bytes=None,
+                                   hop_cache=None, prober=None, connect_timeout=None, task_timeout=None,
+                                   breaker=None, flights=None, scheduler=None):
+    """
+    Проверяет урл задачи. Если задан flights (SingleFlight), урл, который
+    сейчас проверяет другая задача, не проверяется второй раз.
+    """
+    url = get_task_url(task)
+    if task.data.get('recheck'):
+        # перепроверка всегда идет в сеть
+        hop_cache = None
+        flights = None
+    check = partial(
+        get_redirect_history,
+        url, timeout, max_redirects, user_agent, max_body_bytes, hop_cache, prober, connect_timeout, task_timeout,
+        breaker, scheduler
+    )
+    history = flights.resolve(prepare_url(url), check) if flights is not None else check()
+    return make_task_result(task, history, breaker)
+
+
+def check_task(config, task):
+    return get_redirect_history_from_task(
+        task,
+        config.HTTP_TIMEOUT,
+        config.MAX_REDIRECTS,
+        config.USER_AGENT,
+        config.MAX_BODY_BYTES,
+        get_hop_cache(),
+        get_head_prober(),
+        config.HTTP_CONNECT_TIMEOUT,
+        config.TASK_TIMEOUT,
+        get_host_breaker(),
+        get_single_flight(),
+        get_host_scheduler()
+    )
+
+
+def get_host_limits(config, workers):
+    """
+    Ограничения одного воркера на запросы к хосту. HOST_MAX_CONCURRENCY и
+    HOST_MAX_RATE заданы на всю машину и делятся поровну между workers
+    воркерами, но одновременный запрос к хосту остается у каждого воркера.
+
+    :return: одновременных запросов, запросов в секунду (None - без ограничения)
+    """
+    concurrency = max(config.HOST_MAX_CONCURRENCY // workers, 1) if config.HOST_MAX_CONCURRENCY else None
+    rate = float(config.HOST_MAX_RATE) / workers if config.HOST_MAX_RATE else None
+    return concurrency, rate
+
+
+def get_recheck_delay(config, data):
+    """
+    :return: через сколько секунд перепроверять задачу: RECHECK_DELAY или
+        позже, если хост задачи выключен дольше (recheck_delay в данных)
+    """
+    return max(data.get('recheck_delay', 0), config.RECHECK_DELAY)
+
+
+def settle_task(config, task, result, input_tube, output_tube, recheck_tube=None):
+    """
+    Отправляет результат задачи в выходную (или при перепроверке в очередь
+    перепроверок, по умолчанию входную) очередь и подтверждает выполнение задачи.
+    """
+    if result:
+        is_input, data = result
+        if is_input:
+            (recheck_tube or input_tube).put(
+                data,
+                delay=get_recheck_delay(config, data),
+                pri=task_priority(task)
+            )
+        else:
+            output_tube.put(data)
+        logger.debug(u'Task id={} data:{}'.format(task.task_id, data))
+    try:
+        task.ack()
+        logger.info(u'Task id={} done'.format(task.task_id))
+    except DatabaseError as e:
+        logger.info('Task ack fail')
+        logger.exception(e)
+
+
+def is_failed_result(result):
+    """
+    :return: закончилась ли проверка ошибкой или таймаутом
+    """
+    if not result:
+        return False
+    is_input, data = result
+    return is_input or REDIRECT_ERROR in data['result'][0] or REDIRECT_TIMEOUT in data['result'][0]
+
+
+def release_failed_tasks(batch):
+    """
+    Сразу возвращает в очередь (queue.release) задачи, проверка которых не удалась:
+    пока сети нет, такой результат ничего не говорит о ссылке.
+
+    :return: остальные задачи
+    """
+    settled = []
+    for task, result in batch:
+        if not is_failed_result(result):
+            settled.append((task, result))
+            continue
+        try:
+            task.release()
+            logger.info(u'Task id={} released'.format(task.task_id))
+        except DatabaseError as e:
+            logger.info('Task release fail')
+            logger.exception(e)
+    return settled
+
+
+def drop_stale_tasks(batch):
+    """
+    Отбрасывает задачи, взятые до переподключения к очереди: сервер уже вернул
+    их в очередь, и их проверит другой воркер. Такие задачи не подтверждаются,
+    их результаты не отправляются.
+
+    :return: остальные задачи
+    """
+    fresh = []
+    for task, result in batch:
+        if is_stale_task(task):
+            # задача уже не наша: не возвращать ее в очередь при сборке объекта Task
+            task.modified = True
+            logger.warning(u'Task id={} was taken before reconnect. dropped'.format(task.task_id))
+        else:
+            fresh.append((task, result))
+    return fresh
+
+
+def settle_tasks(config, finished, input_tube, output_tube, release_failed=False, recheck_tube=None):
+    """
+    Отправляет результаты задач в очереди и подтверждает задачи.
+
+    Если выходная очередь на том же сервере, что и входная, все задачи
+    подтверждаются вместе с отправкой результатов одним запросом.
+    Задачи, взятые до переподключения к входной очереди, отбрасываются
+    (см. drop_stale_tasks).
+
+    :param finished: список (задача, результат make_task_result), очищается
+    :param release_failed: вернуть в очередь задачи, проверка которых не удалась
+    :param recheck_tube: очередь перепроверок на сервере входной (None - входная очередь)
+    """
+    batch = drop_stale_tasks(finished)
+    del finished[:]
+    if release_failed:
+        batch = release_failed_tasks(batch)
+    if not batch:
+        return
+
+    if not same_server(input_tube, output_tube):
+        for task, result in batch:
+            settle_task(config, task, result, input_tube, output_tube, recheck_tube)
+        return
+
+    settlements = []
+    for task, (is_input, data) in batch:
+        if is_input:
+            # pri=None: сервер сам берет приоритет задачи, переводя его так же, как task_priority
+            settlements.append((
+                task, recheck_tube or input_tube, data, {'delay': get_recheck_delay(config, data), 'pri': None}
+            ))
+        else:
+            settlements.append((task, output_tube, data, {}))
+    try:
+        acked = ack_and_put(input_tube, settlements)
+    except DatabaseError as e:
+        logger.info('Task ack fail')
+        logger.exception(e)
+        return
+
+    for task, _, data, _ in settlements:
+        if task.task_id in acked:
+            logger.debug(u'Task id={} data:{}'.format(task.task_id, data))
+            logger.info(u'Task id={} done'.format(task.task_id))
+        else:
+            logger.info(u'Task id={} ack fail'.format(task.task_id))
+
+
+def handle_next_task(config, input_tube, output_tube, recheck_tube=None):
     task = input_tube.take(config.QUEUE_TAKE_TIMEOUT)
     if task:
+        mark_session(task)
         logger.info(u'Starting task id={}.'.format(task.task_id))
-        result = get_redirect_history_from_task(
-            task,
+        result = check_task(config, task)
+        settle_tasks(config, [(task, result)], input_tube, output_tube, recheck_tube=recheck_tube)
+
+
+def handle_tasks_concurrently(config, engine, input_tube, output_tube, finished, intake=True,
+                              release_failed=False, recheck_tube=None):
+    """
+    Добирает задачи на свободные места движка и выполняет одну его итерацию.
+    Задачи, цепочки редиректов которых завершились за итерацию, подтверждаются вместе.
+
+    :param finished: список для завершенных задач, общий для всех итераций
+    :param intake: брать ли новые задачи; если нет, начатые задачи доделываются
+    :param release_failed: вернуть в очередь задачи, проверка которых не удалась
+        (сеть недоступна)
+    :param recheck_tube: очередь перепроверок (None - входная очередь)
+    """
+    if intake:
+        # пока в движке есть цепочки, take почти не ждет задач: ожидание останавливает их запросы
+        take_timeout = config.QUEUE_TAKE_TIMEOUT if engine.is_idle() else BUSY_TAKE_TIMEOUT
+        for task in take_many(input_tube, engine.free_count(), take_timeout):
+            logger.info(u'Starting task id={}.'.format(task.task_id))
+            engine.submit(get_task_url(task), partial(
+                on_task_history, task, finished
+            ), use_cache=not task.data.get('recheck'))
+    elif engine.is_idle():
+        sleep(config.QUEUE_TAKE_TIMEOUT)
+
+    engine.perform(config.QUEUE_TAKE_TIMEOUT)
+    settle_tasks(config, finished, input_tube, output_tube, release_failed=release_failed,
+                 recheck_tube=recheck_tube)
+
+
+def on_task_history(task, finished, history):
+    finished.append((task, make_task_result(task, history, get_host_breaker())))
+
+
+def handle_tasks_in_greenlets(config, pool, input_tube, output_tube, finished, intake=True,
+                              release_failed=False, recheck_tube=None):
+    """
+    Запускает задачи в гринлетах на свободные места пула и подтверждает
+    завершившиеся. С очередями работает только вызывающий (главный) гринлет.
+
+    :param finished: список для завершенных задач, общий для всех гринлетов
+    :param intake, release_failed, recheck_tube: см. handle_tasks_concurrently
+    """
+    if intake:
+        for task in take_many(input_tube, pool.free_count(), config.QUEUE_TAKE_TIMEOUT):
+            logger.info(u'Starting task id={}.'.format(task.task_id))
+            pool.spawn(handle_task_in_greenlet, config, task, finished)
+
+    if pool.full():
+        pool.wait_available()
+    elif intake:
+        # даем гринлетам поработать, даже если take_many вернул задачи сразу
+        gevent.sleep(0)
+    else:
+        gevent.sleep(config.QUEUE_TAKE_TIMEOUT)
+    settle_tasks(config, finished, input_tube, output_tube, release_failed=release_failed,
+                 recheck_tube=recheck_tube)
+
+
+def handle_task_in_greenlet(config, task, finished):
+    try:
+        finished.append((task, check_task(config, task)))
+    except Exception:
+        # неподтвержденная задача вернется в очередь при сборке объекта Task
+        logger.exception(u'Task id={} failed'.format(task.task_id))
+
+
+def request_stop(signum, frame):
+    global _stop_requested
+    _stop_requested = True
+
+
+def is_worker_idle(engine):
+    """
+    :return: нет ли у воркера начатых задач
+    """
+    if isinstance(engine, Pool):
+        return not len(engine)
+    return engine is None or engine.is_idle()
+
+
+def report_worker_stats():
+    """
+    Пишет в лог статистику пула curl-хендлов, кэша переходов и кэша DNS воркера.
+    """
+    logger.info('Curl pool: created={created} reused={reused} evicted={evicted}.'.format(**get_curl_pool().stats))
+    hop_cache = get_hop_cache()
+    if hop_cache is not None:
+        logger.info('Hop cache: hits={hits} misses={misses} errors={errors}.'.format(**hop_cache.stats))
+    dns_cache = get_dns_cache()
+    if dns_cache is not None:
+        logger.info(
+            'DNS cache: hits={hits} misses={misses} negative_hits={negative_hits} prefetches={prefetches} '
+            'resolved={resolved} failed={failed} entries={entries}.'.format(
+                entries=len(dns_cache.entries), **dns_cache.stats
+            )
+        )
+
+
+def get_recheck_config(config):
+    """
+    Настройки воркеров перепроверок: те же, но задачи берутся из
+    RECHECK_QUEUE_TUBE, со своими таймаутами и размером группы.
+    """
+    recheck_config = copy(config)
+    recheck_config.INPUT_QUEUE_TUBE = config.RECHECK_QUEUE_TUBE
+    recheck_config.HTTP_TIMEOUT = config.RECHECK_HTTP_TIMEOUT
+    recheck_config.TASK_TIMEOUT = config.RECHECK_TASK_TIMEOUT
+    recheck_config.WORKER_POOL_SIZE = config.RECHECK_WORKER_POOL_SIZE
+    return recheck_config
+
+
+def prefork_worker(config):
+    """
+    Готовит главный процесс как шаблон воркеров: все, что загружено здесь,
+    воркеры получают при форке готовым (copy-on-write), а не загружают сами.
+    """
+    set_meta_parser(config.META_PARSER)
+    if config.META_PARSER == META_PARSER_BS4:
+        # bs4 импортируется лениво, при первом разборе страницы
+        from bs4 import BeautifulSoup
+        BeautifulSoup('', 'html.parser')
+    # мусор, собранный до форка, не копируется в память каждого воркера
+    gc.collect()
+
+
+def init_worker(config, network_up=None):
+    """
+    Настраивает состояние процесса воркера, общее для всех задач.
+
+    :param network_up: multiprocessing.Event, пока он сброшен, ошибки запросов
+        не выключают хосты
+
+    :return: пул гринлетов в режиме gevent, движок для одновременной
+        проверки задач или None, если задачи проверяются по одной
+    """
+    set_meta_parser(config.META_PARSER)
+    curl_pool = init_curl_pool(config.CURL_POOL_MAX_IDLE, config.CURL_POOL_IDLE_TIMEOUT)
+    hop_cache = init_hop_cache(config.HOP_CACHE_PATH, config.HOP_CACHE_TTL, config.HOP_CACHE_MAX_ENTRIES)
+    prober = init_head_prober(config.HOP_PROBE)
+    breaker = init_host_breaker(
+        config.BREAKER_PATH, config.BREAKER_FAILURE_THRESHOLD, config.BREAKER_BASE_DELAY, config.BREAKER_MAX_DELAY,
+        config.HTTP_TIMEOUT, network_up
+    )
+    flights = init_single_flight(config.SINGLE_FLIGHT_PATH, config.SINGLE_FLIGHT_LEASE, config.SINGLE_FLIGHT_LINGER)
+    dns_cache = init_dns_cache(
+        config.DNS_CACHE_TTL, config.DNS_CACHE_NEGATIVE_TTL, config.DNS_CACHE_MAX_ENTRIES, config.DNS_RESOLVER_THREADS
+    )
+    scheduler = init_host_scheduler(
+        config.WORKER_HOST_MAX_CONCURRENCY, config.WORKER_HOST_MAX_RATE,
+        gevent.sleep if config.WORKER_MODE == WORKER_MODE_GEVENT else sleep
+    )
+
+    if config.WORKER_MODE == WORKER_MODE_GEVENT:
+        # тот же get_redirect_history_from_task, но curl-запросы всех гринлетов
+        # идут через один CurlMulti, а процесс не блокируется на них
+        set_curl_performer(GeventCurlMulti().perform)
+        return Pool(config.WORKER_MAX_IN_FLIGHT)
+
+    if config.WORKER_MAX_IN_FLIGHT > 1:
+        return RedirectEngine(
             config.HTTP_TIMEOUT,
             config.MAX_REDIRECTS,
-            config.USER_AGENT
+            config.USER_AGENT,
+            max_in_flight=config.WORKER_MAX_IN_FLIGHT,
+            curl_pool=curl_pool,
+            max_body_bytes=config.MAX_BODY_BYTES,
+            hop_cache=hop_cache,
+            scheduler=scheduler,
+            prober=prober,
+            connect_timeout=config.HTTP_CONNECT_TIMEOUT,
+            task_timeout=config.TASK_TIMEOUT,
+            dns_cache=dns_cache,
+            breaker=breaker,
+            flights=flights
         )
-        if result:
-            is_input, data = result
-            if is_input:
-                input_tube.put(
-                    data,
-                    delay=config.RECHECK_DELAY,
-                    pri=task.meta()['pri']
-                )
-            else:
-                output_tube.put(data)
-            logger.debug(u'Task id={} data:{}'.format(task.task_id, data))
-        try:
-            task.ack()
-            logger.info(u'Task id={} done'.format(task.task_id))
-        except DatabaseError as e:
-            logger.info('Task ack fail')
-            logger.exception(e)
 
 
-def worker(config, parent_pid):
+def worker(config, parent_pid, ready_queue=None, network_up=None):
+    """
+    :param ready_queue: очередь, в которую воркер сообщает (pid, время),
+        когда подключится к очередям и будет готов брать задачи
+    :param network_up: multiprocessing.Event, пока он сброшен, воркер не берет задачи
+    """
+    signal.signal(WORKER_STOP_SIGNAL, request_stop)
+    # сигнал остановки не должен прерывать запрос к очереди: прерванный запрос
+    # выглядит как обрыв соединения, и сервер возвращает в очередь все задачи воркера
+    signal.siginterrupt(WORKER_STOP_SIGNAL, False)
+    if config.WORKER_MODE == WORKER_MODE_GEVENT:
+        # до подключения к очередям, чтобы их сокеты не блокировали гринлеты
+        patch_all()
+
     input_tube = get_tube(
         host=config.INPUT_QUEUE_HOST,
         port=config.INPUT_QUEUE_PORT,
@@ -94,10 +492,57 @@ def worker(config, parent_pid):
         name=output_tube.opt['tube']
     ))
 
+    recheck_tube = None
+    if config.RECHECK_QUEUE_TUBE and config.RECHECK_QUEUE_TUBE != config.INPUT_QUEUE_TUBE:
+        # перепроверки проверяет отдельная группа воркеров
+        recheck_tube = get_tube(
+            host=config.INPUT_QUEUE_HOST,
+            port=config.INPUT_QUEUE_PORT,
+            space=config.INPUT_QUEUE_SPACE,
+            name=config.RECHECK_QUEUE_TUBE
+        )
+        logger.info(u'Rechecks go to queue name={}'.format(recheck_tube.opt['tube']))
+
     parent_proc = '/proc/{}'.format(parent_pid)
 
+    engine = init_worker(config, network_up)
+    finished = []
+    if ready_queue is not None:
+        ready_queue.put((os.getpid(), time()))
+    stats_at = time() + config.STATS_INTERVAL
+
     # run while parent is alive
     while os.path.exists(parent_proc):
-        handle_next_task(config, input_tube, output_tube)
+        if time() >= stats_at:
+            report_worker_stats()
+            stats_at = time() + config.STATS_INTERVAL
+
+        network_ok = network_up is None or network_up.is_set()
+        if _stop_requested and is_worker_idle(engine):
+            logger.info('Stop requested. exiting')
+            break
+
+        intake = network_ok and not _stop_requested
+        try:
+            if isinstance(engine, Pool):
+                handle_tasks_in_greenlets(config, engine, input_tube, output_tube, finished, intake, not network_ok,
+                                          recheck_tube)
+            elif engine:
+                handle_tasks_concurrently(config, engine, input_tube, output_tube, finished, intake, not network_ok,
+                                          recheck_tube)
+            elif intake:
+                handle_next_task(config, input_tube, output_tube, recheck_tube)
+            else:
+                sleep(config.QUEUE_TAKE_TIMEOUT)
+        except DatabaseError as e:
+            # соединение с очередью переподключается само; начатые задачи доделываются,
+            # но взятые до переподключения сервер уже вернул в очередь, и их результаты
+            # отбрасываются (см. drop_stale_tasks)
+            logger.warning(u'Queue request fail: {}'.format(e))
+            (gevent.sleep if isinstance(engine, Pool) else sleep)(config.QUEUE_TAKE_TIMEOUT)
     else:
         logger.info('Parent is dead. exiting')
+
+    # задачи гринлетов, завершившихся после последнего подтверждения
+    settle_tasks(config, finished, input_tube, output_tube, recheck_tube=recheck_tube)
+    report_worker_stats()
@@ -8,17 +8,22 @@ import signal
 import sys
 from logging.config import dictConfig
 from threading import current_thread
+from time import time
+from urlparse import urlsplit
 
 import gevent
 from gevent import Greenlet
 from gevent import queue as gevent_queue
 from gevent import sleep
+from gevent.lock import DummySemaphore, Semaphore
 from gevent.monkey import patch_all
 from gevent.pool import Pool
 import requests
 import tarantool
 import tarantool_queue
 from source.lib import utils
+from source.lib.callback_lanes import init_callback_lanes, get_callback_lanes
+from source.lib.session_pool import init_session_pool, get_session_pool
 
 SIGNAL_EXIT_CODE_OFFSET = 128
 """Коды выхода рассчитываются как 128 + номер сигнала"""
@@ -43,6 +48,8 @@ def notification_worker(task, task_queue, *args, **kwargs):
     :param args:
     :param kwargs:
     """
+    url = None
+    started = time()
     try:
         current_thread().name = "pusher.worker#{task_id}".format(task_id=task.task_id)
 
@@ -53,7 +60,8 @@ def notification_worker(task, task_queue, *args, **kwargs):
 
         logger.info('Send data to callback url [{url}].'.format(url=url))
 
-        response = requests.post(
+        # keep-alive соединение с хостом колбэка из общего пула
+        response = get_session_pool().post(
             url, data=json.dumps(data), *args, **kwargs
         )
 
@@ -65,31 +73,162 @@ def notification_worker(task, task_queue, *args, **kwargs):
     except requests.RequestException as exc:
         logger.exception(exc)
         task_queue.put((task, 'bury'))
+    finally:
+        # место, занятое под задачу в start_workers
+        get_callback_lanes().leave(url, time() - started)
 
 
-def done_with_processed_tasks(task_queue):
+def get_callback_url(task):
     """
-    Удаляет завешенные задачи.
+    callback_url задачи или None, если данные задачи не словарь
+    или в них нет абсолютного урла колбэка.
+    """
+    data = task.data
+    if not isinstance(data, dict):
+        return None
+    url = data.get('callback_url')
+    if not isinstance(url, basestring) or not urlsplit(url).netloc:
+        return None
+    return url
 
-    :param task_queue: очередь, хранящая кортежи (объект задачи, имя действия)
+
+def get_batch_results(response, count):
     """
-    logger.debug('Send info about finished tasks to queue.')
+    Результаты отправки пачки уведомлений по задачам.
 
-    for _ in xrange(task_queue.qsize()):
-        try:
-            task, action_name = task_queue.get_nowait()
+    Эндпоинт может ответить JSON-массивом той же длины, что и пачка:
+    задачи, которым соответствует ложный элемент, хоронятся. На любой
+    другой ответ, как и при отправке по одной, подтверждаются все задачи.
+
+    :rtype: list of bool
+    """
+    try:
+        results = response.json()
+    except ValueError:
+        results = None
+    if not isinstance(results, list) or len(results) != count:
+        return [True] * count
+    return [bool(result) for result in results]
+
+
+def notification_batch_worker(tasks, task_queue, *args, **kwargs):
+    """
+    Обработчик пачки задач с одним callback_url: отправляет их уведомления
+    одним запросом JSON-массивом.
+
+    :param tasks: задачи пачки
+    :type tasks: list of tarantool_queue.Task
+    :param task_queue: очередь для обработанных задач
+    :type task_queue: gevent.queue.Queue
+    """
+    try:
+        current_thread().name = "pusher.batch_worker#{task_id}".format(task_id=tasks[0].task_id)
+
+        notifications = []
+        for task in tasks:
+            data = task.data.copy()
+            url = data.pop('callback_url')
+            data['id'] = task.task_id
+            notifications.append(data)
+
+        logger.info('Send {count} notifications to callback url [{url}].'.format(count=len(tasks), url=url))
+
+        response = get_session_pool().post(
+            url, data=json.dumps(notifications), *args, **kwargs
+        )
+
+        logger.info('Callback url [{url}] response status code={status_code}.'.format(
+            url=url, status_code=response.status_code
+        ))
+
+        for task, accepted in zip(tasks, get_batch_results(response, len(tasks))):
+            task_queue.put((task, 'ack' if accepted else 'bury'))
+    except requests.RequestException as exc:
+        logger.exception(exc)
+        for task in tasks:
+            task_queue.put((task, 'bury'))
+
+
+def settle_processed_tasks(tube, settlements, queue_lock=None):
+    """
+    Подтверждает или хоронит пачку обработанных задач одним запросом к tarantool.
 
+    :param settlements: список кортежей (объект задачи, имя действия)
+    :param queue_lock: блокировка соединения с tarantool, общего с гринлетом подачи задач
+    :type queue_lock: gevent.lock.Semaphore
+    """
+    if queue_lock is None:
+        queue_lock = DummySemaphore()
+
+    logger.debug('Send info about {count} finished tasks to queue.'.format(count=len(settlements)))
+    try:
+        with queue_lock:
+            settled = utils.settle_many(tube, settlements)
+    except tarantool.DatabaseError as exc:
+        logger.exception(exc)
+        return
+
+    for task, action_name in settlements:
+        if task.task_id in settled:
             logger.debug('{name} task#{task_id}.'.format(
                 name=action_name.capitalize(),
                 task_id=task.task_id
             ))
+        else:
+            logger.warning('Failed to {name} task#{task_id}.'.format(name=action_name, task_id=task.task_id))
 
-            try:
-                getattr(task, action_name)()
-            except tarantool.DatabaseError as exc:
-                logger.exception(exc)
+
+def collect_processed_tasks(task_queue, batch_size, flush_interval):
+    """
+    Собирает пачку обработанных задач: ждет первую не дольше flush_interval
+    секунд, затем добирает остальные, пока в пачке меньше batch_size задач
+    и с получения первой прошло меньше flush_interval секунд.
+
+    :return: список кортежей (объект задачи, имя действия), пустой, если задач не было
+    """
+    try:
+        settlements = [task_queue.get(timeout=flush_interval)]
+    except gevent_queue.Empty:
+        return []
+
+    flush_at = time() + flush_interval
+    while len(settlements) < batch_size:
+        try:
+            settlements.append(task_queue.get(timeout=max(flush_at - time(), 0)))
         except gevent_queue.Empty:
             break
+    return settlements
+
+
+def ack_processed_tasks(config, tube, task_queue, queue_lock=None):
+    """
+    Гринлет подтверждения: забирает обработанные задачи по мере их появления
+    и отправляет в tarantool пачками (см. collect_processed_tasks).
+    """
+    current_thread().name = 'pusher.acker'
+    while run_application:
+        settlements = collect_processed_tasks(task_queue, config.ACK_BATCH_SIZE, config.ACK_FLUSH_INTERVAL)
+        if settlements:
+            settle_processed_tasks(tube, settlements, queue_lock)
+
+
+def done_with_processed_tasks(tube, task_queue, queue_lock=None):
+    """
+    Удаляет завешенные задачи, уже лежащие в task_queue, одним запросом.
+
+    :param task_queue: очередь, хранящая кортежи (объект задачи, имя действия)
+    :param queue_lock: блокировка соединения с tarantool, общего с гринлетом подачи задач
+    :type queue_lock: gevent.lock.Semaphore
+    """
+    settlements = []
+    for _ in xrange(task_queue.qsize()):
+        try:
+            settlements.append(task_queue.get_nowait())
+        except gevent_queue.Empty:
+            break
+
+    if settlements:
+        settle_processed_tasks(tube, settlements, queue_lock)
 
 
 def stop_handler(signum):
@@ -138,13 +277,85 @@ def start_worker_with_task(config, processed_task_queue, task, worker_pool):
     worker.start()
 
 
+def defer_task(config, task, queue_lock=None):
+    """
+    Возвращает задачу в очередь на config.CALLBACK_DEFER_DELAY секунд:
+    квота хоста ее колбэка сейчас занята.
+    """
+    if queue_lock is None:
+        queue_lock = DummySemaphore()
+
+    logger.info('Callback host of task#{task_id} is saturated. Defer task for {delay}s.'.format(
+        task_id=task.task_id, delay=config.CALLBACK_DEFER_DELAY
+    ))
+    try:
+        with queue_lock:
+            task.release(delay=config.CALLBACK_DEFER_DELAY)
+    except tarantool.DatabaseError as exc:
+        logger.exception(exc)
+
+
+def start_batch_worker(config, processed_task_queue, worker_pool, batches, url, batch):
+    """
+    Закрывает пачку задач url и запускает ее обработчик. Ничего не делает,
+    если пачка уже закрыта (по размеру раньше, чем истекло окно).
+
+    :param batches: открытые пачки: callback_url -> (список задач, таймер окна)
+    :type batches: dict
+    """
+    if batches.get(url, (None,))[0] is not batch:
+        return
+    del batches[url]
+
+    logger.info('Start batch worker for {count} tasks to [{url}].'.format(count=len(batch), url=url))
+    worker = Greenlet(
+        notification_batch_worker,
+        batch,
+        processed_task_queue,
+        timeout=config.HTTP_CONNECTION_TIMEOUT,
+        verify=False
+    )
+    worker_pool.add(worker)
+    worker.start()
+
+
+def add_task_to_batch(config, processed_task_queue, task, url, worker_pool, batches):
+    """
+    Кладет задачу в пачку ее callback_url (url, см. get_callback_url), если хост
+    колбэка принимает уведомления пачками (config.CALLBACK_BATCH_HOSTS). Пачка
+    отправляется, когда в ней набирается заданное число задач или истекает окно
+    с ее открытия.
+
+    :param batches: открытые пачки: callback_url -> (список задач, таймер окна)
+    :type batches: dict
+    :return: положена ли задача в пачку
+    :rtype: bool
+    """
+    limits = config.CALLBACK_BATCH_HOSTS.get(urlsplit(url).netloc.lower())
+    if not limits:
+        return False
+    size, window = limits
+
+    if url not in batches:
+        batch = []
+        timer = gevent.spawn_later(
+            window, start_batch_worker, config, processed_task_queue, worker_pool, batches, url, batch
+        )
+        batches[url] = (batch, timer)
+    batch = batches[url][0]
+    batch.append(task)
+    if len(batch) >= size:
+        start_batch_worker(config, processed_task_queue, worker_pool, batches, url, batch)
+    return True
+
+
 def configure_infrastructure(config):
     """
 
     :param config:
     :type config: Config
     :return:
-    :rtype: (gevent_queue.Queue, Tube, gevent.pool.Pool)
+    :rtype: (gevent_queue.Queue, Tube, gevent.pool.Pool, gevent.lock.Semaphore)
     """
     logger.info('Connect to queue server on {host}:{port} space #{space}.'.format(
         host=config.QUEUE_HOST, port=config.QUEUE_PORT, space=config.QUEUE_SPACE
@@ -157,30 +368,122 @@ def configure_infrastructure(config):
         take_timeout=config.QUEUE_TAKE_TIMEOUT
     ))
     tube = queue.tube(config.QUEUE_TUBE)
+    logger.info('Use callback sessions with {count} connections per host, idle timeout={timeout}.'.format(
+        count=config.CALLBACK_MAX_CONNECTIONS, timeout=config.CALLBACK_IDLE_TIMEOUT
+    ))
+    init_session_pool(config.CALLBACK_MAX_CONNECTIONS, config.CALLBACK_IDLE_TIMEOUT)
+    logger.info(
+        'Use callback quotas: {quota} requests per host, {slow_quota} per slow host, '
+        '{slow_lane} for all slow hosts (slower than {slow_latency}s).'.format(
+            quota=config.CALLBACK_HOST_QUOTA, slow_quota=config.CALLBACK_SLOW_HOST_QUOTA,
+            slow_lane=config.CALLBACK_SLOW_LANE_SIZE, slow_latency=config.CALLBACK_SLOW_LATENCY
+        )
+    )
+    init_callback_lanes(
+        config.CALLBACK_HOST_QUOTA, config.CALLBACK_SLOW_HOST_QUOTA,
+        config.CALLBACK_SLOW_LANE_SIZE, config.CALLBACK_SLOW_LATENCY
+    )
     logger.info('Create worker pool[{size}].'.format(size=config.WORKER_POOL_SIZE))
     worker_pool = Pool(config.WORKER_POOL_SIZE)
     processed_task_queue = gevent_queue.Queue()
+    # запросы к tarantool идут из гринлетов подачи и подтверждения через одно соединение
+    queue_lock = Semaphore()
     logger.info('Run main loop. Worker pool size={count}. Sleep time is {sleep}.'.format(
         count=config.WORKER_POOL_SIZE, sleep=config.SLEEP
     ))
-    return processed_task_queue, tube, worker_pool
+    return processed_task_queue, tube, worker_pool, queue_lock
 
 
-def start_workers(config, processed_task_queue, tube, worker_pool):
+def start_workers(config, processed_task_queue, tube, worker_pool, queue_lock=None, batches=None):
+    """
+    Ждет свободного места в пуле, берет задачи на все свободные места
+    и запускает их обработчики. Если передан batches, задачи хостов,
+    принимающих уведомления пачками, собираются в пачки (см. add_task_to_batch).
+    Задачи хостов, квота которых занята, возвращаются в очередь с задержкой,
+    а не ждут места в пуле.
+    """
+    if queue_lock is None:
+        queue_lock = DummySemaphore()
+    worker_pool.wait_available()
     free_workers_count = worker_pool.free_count()
     logger.debug('Pool has {count} free workers.'.format(count=free_workers_count))
-    for number in xrange(free_workers_count):
-        logger.debug('Get task from tube for worker#{number}.'.format(number=number))
 
-        task = tube.take(config.QUEUE_TAKE_TIMEOUT)
+    with queue_lock:
+        tasks = utils.take_many(tube, free_workers_count, config.QUEUE_TAKE_TIMEOUT)
+    logger.debug('Got {count} tasks from tube.'.format(count=len(tasks)))
+    callback_lanes = get_callback_lanes()
+    for number, task in enumerate(tasks):
+        url = get_callback_url(task)
+        if url is None:
+            # задачу без урла колбэка не отправить: хороним ее, как обработчик при ошибке
+            logger.error('Task#{task_id} has no valid callback url. Bury task.'.format(task_id=task.task_id))
+            processed_task_queue.put((task, 'bury'))
+            continue
+        if batches is not None and add_task_to_batch(config, processed_task_queue, task, url, worker_pool, batches):
+            continue
+        if not callback_lanes.enter(url):
+            defer_task(config, task, queue_lock)
+            continue
+        logger.info('Start worker#{number} for task id={task_id}.'.format(
+            task_id=task.task_id, number=number
+        ))
 
-        if task:
-            logger.info('Start worker#{number} for task id={task_id}.'.format(
-                task_id=task.task_id, number=number
-            ))
+        start_worker_with_task(config, processed_task_queue, task, worker_pool)
 
-            start_worker_with_task(config, processed_task_queue, task, worker_pool)
-    done_with_processed_tasks(processed_task_queue)
+
+def feed_workers(config, processed_task_queue, tube, worker_pool, queue_lock=None):
+    """
+    Гринлет подачи задач: как только в пуле освобождается место, берет задачи
+    из очереди (ожидая их не дольше config.QUEUE_TAKE_TIMEOUT за раз) и сразу
+    запускает обработчики. При остановке, в том числе при kill() после ошибки
+    основного цикла, возвращает в очередь задачи недобранных пачек (см. release_batches).
+    """
+    current_thread().name = 'pusher.feeder'
+    batches = {}
+    try:
+        while run_application:
+            start_workers(config, processed_task_queue, tube, worker_pool, queue_lock, batches)
+    finally:
+        release_batches(batches, queue_lock)
+
+
+def release_batches(batches, queue_lock=None):
+    """
+    Отменяет таймеры недобранных пачек и возвращает их задачи в очередь:
+    начатая при остановке отправка может не успеть подтвердиться,
+    и после перезапуска уведомления ушли бы второй раз.
+    """
+    if queue_lock is None:
+        queue_lock = DummySemaphore()
+
+    for url, (batch, timer) in batches.items():
+        del batches[url]
+        timer.kill()
+        logger.info('Release {count} unsent tasks to [{url}].'.format(count=len(batch), url=url))
+        for task in batch:
+            try:
+                with queue_lock:
+                    task.release()
+            except tarantool.DatabaseError as exc:
+                logger.exception(exc)
+
+
+def report_session_stats():
+    """
+    Пишет в лог статистику keep-alive сессий по хостам колбэков.
+    """
+    session_pool = get_session_pool()
+    logger.info('Callback sessions: created={created} evicted={evicted} requests={requests}.'.format(
+        **session_pool.stats
+    ))
+    for (scheme, host), stats in session_pool.host_stats().iteritems():
+        logger.info('Callback host [{scheme}://{host}]: connections={connections} requests={requests}.'.format(
+            scheme=scheme, host=host, **stats
+        ))
+    for host, stats in get_callback_lanes().host_stats().iteritems():
+        logger.info('Callback host [{host}]: lane={lane} active={active} latency={latency:.3f}s.'.format(
+            host=host, **stats
+        ))
 
 
 def main_loop(config):
@@ -194,19 +497,38 @@ def main_loop(config):
      * Открываем соединение с tarantool.queue, использую config.QUEUE_* настройки.
      * Создаем пул обработчиков.
      * Создаем очередь куда обработчики будут помещать выполненные задачи.
-     * Пока количество обработчиков <= config.WORKER_POOL_SIZE, берем задачу из tarantool.queue
-       и запускаем greenlet для ее обработки.
-     * Посылаем уведомления о том, что задачи завершены в tarantool.queue.
-     * Спим config.SLEEP секунд.
+     * Запускаем гринлет подачи задач: как только в пуле есть место, он берет задачи
+       из tarantool.queue и запускает greenlet для обработки каждой.
+     * Запускаем гринлет подтверждения: он посылает уведомления о том, что задачи
+       завершены, в tarantool.queue пачками по мере их обработки.
+     * Раз в config.SLEEP секунд проверяем, что оба гринлета работают.
+     * При остановке дожидаемся гринлета подачи и начатых отправок,
+       затем гринлета подтверждения, и подтверждаем оставшиеся задачи.
     """
-    processed_task_queue, tube, worker_pool = configure_infrastructure(config)
+    processed_task_queue, tube, worker_pool, queue_lock = configure_infrastructure(config)
+    feeder = gevent.spawn(feed_workers, config, processed_task_queue, tube, worker_pool, queue_lock)
+    acker = gevent.spawn(ack_processed_tasks, config, tube, processed_task_queue, queue_lock)
 
-    while run_application:
-        start_workers(config, processed_task_queue, tube, worker_pool)
-
-        sleep(config.SLEEP)
-    else:
-        logger.info('Stop application loop.')
+    try:
+        while run_application:
+            for greenlet in (feeder, acker):
+                if greenlet.ready():
+                    # исключение гринлета подачи или подтверждения - ошибка основного цикла
+                    greenlet.get()
+            logger.debug('Callback sessions stats: {stats}.'.format(stats=get_session_pool().stats))
+
+            sleep(config.SLEEP)
+        else:
+            logger.info('Stop application loop.')
+            # отправленные уведомления должны успеть подтвердиться до выхода
+            feeder.join(timeout=config.HTTP_CONNECTION_TIMEOUT)
+            worker_pool.join(timeout=config.HTTP_CONNECTION_TIMEOUT)
+            acker.join()
+            done_with_processed_tasks(tube, processed_task_queue, queue_lock)
+            report_session_stats()
+    finally:
+        feeder.kill()
+        acker.kill()
 
 
 def install_signal_handlers():
@@ -2,12 +2,19 @@
 # coding: utf-8
 import logging
 import os
+import signal
 import sys
 from logging.config import dictConfig
-from multiprocessing import active_children
-from time import sleep
+from multiprocessing import active_children, cpu_count
+from multiprocessing.queues import SimpleQueue
+from time import sleep, time
 
-from lib.worker import worker
+from tarantool.error import DatabaseError
+
+from lib.autoscale import PoolAutoscaler
+from lib.health import NetworkHealth, HEALTH_PROCESS_NAME
+from lib.worker import worker, prefork_worker, get_recheck_config, get_host_limits, WORKER_STOP_SIGNAL, \
+    RECHECK_WORKER_NAME
 from source.lib import utils
 
 logger = logging.getLogger('redirect_checker')
@@ -15,33 +22,211 @@ logger = logging.getLogger('redirect_checker')
 run_application = True
 
 
-def main_loop_iteration(config, parent_pid):
-    if utils.check_network_status(config.CHECK_URL, config.HTTP_TIMEOUT):
-        required_workers_count = config.WORKER_POOL_SIZE - len(
-            active_children())
-        if required_workers_count > 0:
-            logger.info(
-                'Spawning {} workers'.format(required_workers_count))
-            utils.spawn_workers(
-                num=required_workers_count,
-                target=worker,
-                args=(config,),
-                parent_pid=parent_pid
-            )
+def get_worker_pool_size(config):
+    return config.WORKER_POOL_SIZE or cpu_count()
+
+
+def get_workers(stopping=(), recheck=False):
+    """
+    :param stopping: pid воркеров, которые уже завершаются и не считаются
+    :param recheck: воркеры перепроверок, а не свежих задач
+    """
+    return [
+        c for c in active_children()
+        if c.name != HEALTH_PROCESS_NAME and (c.name == RECHECK_WORKER_NAME) == recheck and c.pid not in stopping
+    ]
+
+
+def stop_workers(workers, stopping):
+    """
+    Просит воркеров доделать начатые задачи и завершиться
+    """
+    for c in workers:
+        logger.info(u'Stopping worker pid={}'.format(c.pid))
+        os.kill(c.pid, WORKER_STOP_SIGNAL)
+        stopping.add(c.pid)
+
+
+def spawn_worker_group(config, parent_pid, num, spawn_times=None, ready_queue=None, health=None, name=None):
+    """
+    Запускает num воркеров с настройками config
+
+    :param name: имя процессов группы (None - воркеры свежих задач)
+    """
+    logger.info(
+        'Spawning {} workers'.format(num))
+    kwargs = {}
+    if ready_queue is not None:
+        kwargs['ready_queue'] = ready_queue
+    if health is not None:
+        kwargs['network_up'] = health.up
+    processes = utils.spawn_workers(
+        num=num,
+        target=worker,
+        args=(config,),
+        parent_pid=parent_pid,
+        kwargs=kwargs or None,
+        name=name
+    )
+    if spawn_times is not None:
+        now = time()
+        for p in processes:
+            spawn_times[p.pid] = now
+
+
+def main_loop_iteration(config, parent_pid, spawn_times=None, ready_queue=None, health=None, autoscaler=None,
+                        recheck_config=None, stopping=None):
+    """
+    :param spawn_times: pid -> время запуска воркеров, которые еще не сообщили о готовности
+    :param ready_queue: очередь, в которую воркеры сообщают о готовности (None - не сообщают)
+    :param health: фоновая проверка сети; без нее сеть проверяется здесь же,
+        и при недоступности воркеры останавливаются
+    :param autoscaler: размер пула по очередям (None - всегда WORKER_POOL_SIZE)
+    :param recheck_config: настройки группы воркеров перепроверок (None - перепроверки
+        возвращаются во входную очередь)
+    :param stopping: pid воркеров, которых попросили завершиться; сохраняется между итерациями
+    """
+    if stopping is None:
+        stopping = set()
+    if health is not None:
+        health.ensure_running(parent_pid)
+        network_up = health.is_up()
     else:
+        network_up = utils.check_network_status(config.CHECK_URL, config.HTTP_TIMEOUT)
+
+    if network_up:
+        stopping.intersection_update(c.pid for c in active_children())
+        if autoscaler is not None:
+            pool_size = autoscaler.refresh()
+        else:
+            pool_size = get_worker_pool_size(config)
+        workers = get_workers(stopping)
+
+        required_workers_count = pool_size - len(workers)
+        if required_workers_count < 0:
+            stop_workers(workers[required_workers_count:], stopping)
+        elif required_workers_count > 0:
+            spawn_worker_group(config, parent_pid, required_workers_count, spawn_times, ready_queue, health)
+
+        if recheck_config is not None:
+            # группа перепроверок постоянного размера и не зависит от очереди свежих задач
+            required_workers_count = recheck_config.WORKER_POOL_SIZE - len(get_workers(recheck=True))
+            if required_workers_count > 0:
+                spawn_worker_group(recheck_config, parent_pid, required_workers_count, spawn_times, ready_queue,
+                                   health, RECHECK_WORKER_NAME)
+    elif health is None:
         logger.critical('Network is down. stopping workers')
-        for c in active_children():
+        for c in get_workers() + get_workers(recheck=True):
             c.terminate()
 
+    if ready_queue is not None:
+        report_ready_workers(ready_queue, spawn_times)
+    if recheck_config is not None:
+        report_lanes(config, recheck_config)
+
+
+def report_lanes(config, recheck_config):
+    """
+    Пишет в лог число воркеров и задачи в очередях обеих групп: свежих задач и перепроверок
+    """
+    for lane, lane_config in (('fresh', config), ('recheck', recheck_config)):
+        tube = utils.get_tube(lane_config.INPUT_QUEUE_HOST, lane_config.INPUT_QUEUE_PORT,
+                              lane_config.INPUT_QUEUE_SPACE, lane_config.INPUT_QUEUE_TUBE)
+        try:
+            tasks = tube.statistics().get('tasks', {})
+        except DatabaseError as e:
+            logger.warning(u'Queue statistics fail: {}'.format(e))
+            continue
+        logger.info(u'Lane {}: workers={} ready={} delayed={} taken={}'.format(
+            lane, len(get_workers(recheck=lane_config is recheck_config)),
+            tasks.get('ready', 0), tasks.get('delayed', 0), tasks.get('taken', 0)
+        ))
+
+
+def report_ready_workers(ready_queue, spawn_times):
+    """
+    Пишет в лог, за сколько запустились готовые воркеры и сколько памяти они занимают
+    """
+    while not ready_queue.empty():
+        pid, ready_at = ready_queue.get()
+        spawned_at = spawn_times.pop(pid, ready_at)
+        memory = utils.get_process_memory(pid)
+        if memory is None:
+            continue
+        logger.info(u'Worker pid={} ready in {:.3f}s. rss={}KB shared={}KB'.format(
+            pid, ready_at - spawned_at, memory[0] // 1024, memory[1] // 1024
+        ))
+
+    # воркеры, умершие до готовности
+    alive = set(c.pid for c in active_children())
+    for pid in spawn_times.keys():
+        if pid not in alive:
+            del spawn_times[pid]
+
+
+def handle_sigchld(signum, frame):
+    # ничего не делает: сигнал только прерывает сон главного цикла
+    pass
+
 
 def main_loop(config):
     logger.info(
         u'Run main loop. Worker pool size={}. Sleep time is {}.'.format(
-            config.WORKER_POOL_SIZE, config.SLEEP
+            get_worker_pool_size(config), config.SLEEP
         ))
     parent_pid = os.getpid()
+    recheck_config = None
+    if config.RECHECK_QUEUE_TUBE:
+        recheck_config = get_recheck_config(config)
+        logger.info(u'Rechecks go to {}. recheck worker pool size={}'.format(
+            config.RECHECK_QUEUE_TUBE, recheck_config.WORKER_POOL_SIZE
+        ))
+    # ограничения на хост делятся между всеми воркерами машины при наибольшем размере пула
+    workers = config.WORKER_POOL_MAX if config.WORKER_AUTOSCALE else get_worker_pool_size(config)
+    if recheck_config is not None:
+        workers += recheck_config.WORKER_POOL_SIZE
+    for lane_config in filter(None, (config, recheck_config)):
+        lane_config.WORKER_HOST_MAX_CONCURRENCY, lane_config.WORKER_HOST_MAX_RATE = get_host_limits(config, workers)
+    logger.info(u'Host limits of one worker: concurrency={} rate={}'.format(*get_host_limits(config, workers)))
+    health = None
+    if config.NETWORK_CHECK_URLS:
+        health = NetworkHealth(
+            config.NETWORK_CHECK_URLS,
+            config.HTTP_TIMEOUT,
+            config.NETWORK_CHECK_INTERVAL,
+            config.NETWORK_FAIL_THRESHOLD,
+            config.NETWORK_RECOVER_THRESHOLD
+        )
+
+    autoscaler = None
+    if config.WORKER_AUTOSCALE:
+        autoscaler = PoolAutoscaler(
+            utils.get_tube(config.INPUT_QUEUE_HOST, config.INPUT_QUEUE_PORT,
+                           config.INPUT_QUEUE_SPACE, config.INPUT_QUEUE_TUBE),
+            utils.get_tube(config.OUTPUT_QUEUE_HOST, config.OUTPUT_QUEUE_PORT,
+                           config.OUTPUT_QUEUE_SPACE, config.OUTPUT_QUEUE_TUBE),
+            config.WORKER_POOL_MIN,
+            config.WORKER_POOL_MAX,
+            size=get_worker_pool_size(config),
+            backlog_per_worker=config.AUTOSCALE_BACKLOG_PER_WORKER,
+            idle_take_ratio=config.AUTOSCALE_IDLE_TAKE_RATIO,
+            max_cpu=config.AUTOSCALE_MAX_CPU,
+            max_output_backlog=config.AUTOSCALE_MAX_OUTPUT_BACKLOG
+        )
+
+    spawn_times, ready_queue = None, None
+    if config.WORKER_PREFORK:
+        prefork_worker(config)
+        # сон главного цикла прерывается выходом воркера, и пул пополняется сразу;
+        # остальные системные вызовы сигнал не прерывает
+        signal.signal(signal.SIGCHLD, handle_sigchld)
+        signal.siginterrupt(signal.SIGCHLD, False)
+        spawn_times, ready_queue = {}, SimpleQueue()
+
+    stopping = set()
     while run_application:
-        main_loop_iteration(config, parent_pid)
+        main_loop_iteration(config, parent_pid, spawn_times, ready_queue, health, autoscaler, recheck_config,
+                            stopping)
 
         sleep(config.SLEEP)
 
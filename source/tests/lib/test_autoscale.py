@@ -0,0 +1,73 @@
+import tempfile
+import unittest
+import mock
+from tarantool.error import NetworkError
+from source.lib import autoscale
+
+
+def make_stats(ready=0, take=0, take_timeout=0):
+    return {'take': str(take), 'take_timeout': str(take_timeout), 'tasks': {'ready': str(ready)}}
+
+
+class AutoscaleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.input_tube = mock.Mock()
+        self.output_tube = mock.Mock()
+        self.autoscaler = autoscale.PoolAutoscaler(
+            self.input_tube, self.output_tube, 2, 10, size=4, backlog_per_worker=100, idle_take_ratio=0.5,
+            max_cpu=0.9, max_output_backlog=1000
+        )
+
+    def test_initial_size_clamped(self):
+        self.assertEqual(autoscale.PoolAutoscaler(None, None, 2, 10, size=50).size, 10)
+        self.assertEqual(autoscale.PoolAutoscaler(None, None, 2, 10).size, 2)
+
+    def test_grows_to_backlog(self):
+        self.assertEqual(self.autoscaler.update(make_stats(ready=750), make_stats()), 8)
+        self.assertEqual(self.autoscaler.update(make_stats(ready=5000), make_stats()), 10)
+
+    def test_grows_at_least_by_one(self):
+        self.assertEqual(self.autoscaler.update(make_stats(ready=401)), 5)
+
+    def test_keeps_size_on_high_cpu(self):
+        self.assertEqual(self.autoscaler.update(make_stats(ready=750), cpu=0.95), 4)
+
+    def test_keeps_size_on_output_backlog(self):
+        self.assertEqual(self.autoscaler.update(make_stats(ready=750), make_stats(ready=1000)), 4)
+
+    def test_shrinks_by_one_when_takes_idle(self):
+        self.autoscaler.update(make_stats(take=100, take_timeout=10))
+
+        self.assertEqual(self.autoscaler.update(make_stats(take=110, take_timeout=40)), 3)
+        self.assertEqual(self.autoscaler.update(make_stats(take=111, take_timeout=80)), 2)
+        self.assertEqual(self.autoscaler.update(make_stats(take=111, take_timeout=120)), 2)
+
+    def test_keeps_size_when_busy(self):
+        self.autoscaler.update(make_stats(take=100, take_timeout=10))
+
+        self.assertEqual(self.autoscaler.update(make_stats(take=200, take_timeout=20)), 4)
+
+    def test_idle_ratio_ignores_counter_reset(self):
+        self.autoscaler.idle_ratio(make_stats(take=100, take_timeout=10))
+
+        self.assertIsNone(self.autoscaler.idle_ratio(make_stats(take=1, take_timeout=5)))
+
+    def test_refresh_reads_statistics(self):
+        self.input_tube.statistics = mock.Mock(return_value=make_stats(ready=750))
+        self.output_tube.statistics = mock.Mock(return_value=make_stats())
+
+        with mock.patch('source.lib.autoscale.read_cpu_times', mock.Mock(side_effect=[(50, 100), (60, 200)])):
+            self.assertEqual(self.autoscaler.refresh(), 8)
+            self.assertEqual(self.autoscaler.sample_cpu(), 0.1)
+
+    def test_refresh_statistics_fail(self):
+        self.input_tube.statistics = mock.Mock(side_effect=NetworkError(Exception('down')))
+
+        self.assertEqual(self.autoscaler.refresh(), 4)
+
+    def test_read_cpu_times(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write('cpu  10 2 3 80 5 0 0 0 0 0\ncpu0 1 2 3 4 5 6 7 8 9 10\n')
+            f.flush()
+
+            self.assertEqual(autoscale.read_cpu_times(f.name), (15, 100))
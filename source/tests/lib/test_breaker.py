@@ -0,0 +1,133 @@
+import unittest
+import mock
+from source.lib import breaker
+
+
+class BreakerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.breaker = breaker.HostBreaker(':memory:', failure_threshold=2, base_delay=10, max_delay=30,
+                                           probe_timeout=5)
+
+    def record_failures(self, host, times, now=100):
+        for _ in range(times):
+            self.breaker.record(host, False, now)
+
+    def test_unknown_host_allowed(self):
+        self.assertEqual(self.breaker.check('mail.ru', 100), 0)
+
+    def test_failures_below_threshold_allowed(self):
+        self.record_failures('mail.ru', 1)
+
+        self.assertEqual(self.breaker.check('mail.ru', 100), 0)
+
+    def test_open_after_threshold(self):
+        self.record_failures('mail.ru', 2)
+
+        self.assertEqual(self.breaker.check('mail.ru', 104), 6)
+        self.assertEqual(self.breaker.stats['opened'], 1)
+        self.assertEqual(self.breaker.stats['rejected'], 1)
+
+    def test_failures_ignored_while_network_down(self):
+        network_up = mock.Mock()
+        network_up.is_set = mock.Mock(return_value=False)
+        self.breaker.network_up = network_up
+
+        self.record_failures('mail.ru', 3)
+        network_up.is_set.return_value = True
+        self.record_failures('mail.ru', 1)
+
+        self.assertEqual(self.breaker.check('mail.ru', 100), 0)
+        self.assertEqual(self.breaker.stats['opened'], 0)
+
+    def test_single_probe_after_delay(self):
+        self.record_failures('mail.ru', 2)
+        other = breaker.HostBreaker(':memory:', failure_threshold=2, probe_timeout=5)
+        other.db = self.breaker.db
+
+        self.assertEqual(self.breaker.check('mail.ru', 110), 0)
+        self.assertEqual(other.check('mail.ru', 110), 5)
+        self.assertEqual(self.breaker.stats['probes'], 1)
+
+    def test_failed_probe_doubles_delay(self):
+        self.record_failures('mail.ru', 2)
+        self.breaker.check('mail.ru', 110)
+        self.record_failures('mail.ru', 1, now=110)
+
+        self.assertEqual(self.breaker.retry_delay('mail.ru', 110), 20)
+
+    def test_delay_limited(self):
+        self.assertEqual(self.breaker.delay(10), 30)
+
+    def test_success_closes(self):
+        self.record_failures('mail.ru', 2)
+        self.breaker.record('mail.ru', True, 110)
+
+        self.assertEqual(self.breaker.check('mail.ru', 110), 0)
+        self.assertEqual(self.breaker.retry_delay('mail.ru', 110), 0)
+        self.assertEqual(self.breaker.stats['closed'], 1)
+
+    def test_success_of_healthy_host_not_written(self):
+        self.breaker.db = mock.Mock()
+
+        self.breaker.record('mail.ru', True, 100)
+
+        self.assertFalse(self.breaker.db.execute.called)
+
+    def test_empty_host_ignored(self):
+        self.record_failures('', 3)
+
+        self.assertEqual(self.breaker.check('', 100), 0)
+        self.assertEqual(self.breaker.stats['opened'], 0)
+
+    def test_evict_forgets_old_hosts(self):
+        self.record_failures('mail.ru', 2)
+
+        self.breaker.evict(200)
+
+        self.assertEqual(self.breaker.retry_delay('mail.ru', 200), 0)
+
+    def test_db_error_allows(self):
+        self.breaker.db = mock.Mock()
+        self.breaker.db.execute = mock.Mock(side_effect=breaker.sqlite3.Error)
+
+        self.assertEqual(self.breaker.check('mail.ru', 100), 0)
+        self.assertEqual(self.breaker.stats['errors'], 1)
+
+    def test_locked_file_fails_open(self):
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = directory + '/breaker.db'
+            host_breaker = breaker.HostBreaker(path, failure_threshold=1)
+            self.assertEqual(host_breaker.db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            locker = breaker.sqlite3.connect(path, isolation_level=None)
+            locker.execute('BEGIN EXCLUSIVE')
+
+            host_breaker.record('mail.ru', False, 100)
+            self.assertEqual(host_breaker.check('mail.ru', 101), 0)
+            self.assertGreaterEqual(host_breaker.stats['errors'], 1)
+
+            locker.execute('ROLLBACK')
+            locker.close()
+            host_breaker.db.close()
+        finally:
+            shutil.rmtree(directory)
+
+    @mock.patch('source.lib.breaker.connect_shared_db')
+    def test_locked_file_on_init_is_not_fatal(self, connect_shared_db_m):
+        connect_shared_db_m.return_value.execute.side_effect = breaker.sqlite3.OperationalError('database is locked')
+
+        host_breaker = breaker.HostBreaker('breaker.db')
+
+        self.assertEqual(host_breaker.check('mail.ru', 100), 0)
+        self.assertEqual(host_breaker.stats['errors'], 2)
+
+    def test_get_host_breaker_other_process(self):
+        breaker.init_host_breaker(':memory:')
+
+        with mock.patch('os.getpid', mock.Mock(return_value=-1)):
+            self.assertIsNone(breaker.get_host_breaker())
+        self.assertIsNotNone(breaker.get_host_breaker())
+        breaker.init_host_breaker(None)
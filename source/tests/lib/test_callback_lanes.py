@@ -0,0 +1,77 @@
+import os
+import unittest
+import mock
+from source.lib import callback_lanes
+
+
+class CallbackLanesTestCase(unittest.TestCase):
+    def test_fast_host_quota(self):
+        lanes = callback_lanes.CallbackLanes(host_quota=2)
+
+        self.assertTrue(lanes.enter('http://partner.ru/a'))
+        self.assertTrue(lanes.enter('http://Partner.ru/b'))
+        self.assertFalse(lanes.enter('http://partner.ru/c'))
+        self.assertTrue(lanes.enter('http://other.ru/'))
+        self.assertEqual(lanes.stats, {'entered': 3, 'deferred': 1})
+
+    def test_leave_frees_place(self):
+        lanes = callback_lanes.CallbackLanes(host_quota=1)
+        lanes.enter('http://partner.ru/')
+
+        lanes.leave('http://partner.ru/', 0.1)
+
+        self.assertEqual(lanes.active, {})
+        self.assertTrue(lanes.enter('http://partner.ru/'))
+
+    def test_leave_without_enter(self):
+        lanes = callback_lanes.CallbackLanes()
+
+        lanes.leave('http://partner.ru/', 0.1)
+        lanes.leave(None, 0.1)
+
+        self.assertEqual(lanes.active, {})
+
+    def test_url_without_host_not_counted(self):
+        lanes = callback_lanes.CallbackLanes(host_quota=1)
+
+        for _ in xrange(3):
+            self.assertTrue(lanes.enter('partner.ru/callback'))
+            lanes.leave('partner.ru/callback', 0.1)
+        self.assertTrue(lanes.enter(None))
+
+        self.assertEqual(lanes.active, {})
+
+    def test_slow_host_quota(self):
+        lanes = callback_lanes.CallbackLanes(host_quota=5, slow_host_quota=1, slow_latency=5)
+        lanes.enter('http://slow.ru/')
+        lanes.leave('http://slow.ru/', 30)
+
+        self.assertTrue(lanes.enter('http://slow.ru/'))
+        self.assertFalse(lanes.enter('http://slow.ru/'))
+        self.assertEqual(lanes.host_stats()['slow.ru'], {'lane': 'slow', 'active': 1, 'latency': 30})
+
+    def test_slow_lane_size(self):
+        lanes = callback_lanes.CallbackLanes(slow_host_quota=1, slow_lane_size=2, slow_latency=5)
+        for host in ('a.ru', 'b.ru', 'c.ru'):
+            lanes.leave('http://{}/'.format(host), 30)
+
+        self.assertTrue(lanes.enter('http://a.ru/'))
+        self.assertTrue(lanes.enter('http://b.ru/'))
+        self.assertFalse(lanes.enter('http://c.ru/'))
+        self.assertTrue(lanes.enter('http://fast.ru/'))
+
+    def test_latency_smoothing(self):
+        lanes = callback_lanes.CallbackLanes(slow_latency=5)
+        lanes.leave('http://partner.ru/', 30)
+
+        for _ in xrange(10):
+            lanes.leave('http://partner.ru/', 0.1)
+
+        self.assertFalse(lanes.is_slow('partner.ru'))
+
+    def test_get_callback_lanes_per_process(self):
+        lanes = callback_lanes.init_callback_lanes(host_quota=7)
+
+        self.assertIs(callback_lanes.get_callback_lanes(), lanes)
+        with mock.patch('source.lib.callback_lanes.os.getpid', mock.Mock(return_value=os.getpid() + 1)):
+            self.assertIsNot(callback_lanes.get_callback_lanes(), lanes)
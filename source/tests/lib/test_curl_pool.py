@@ -0,0 +1,63 @@
+import unittest
+import mock
+from source.lib import curl_pool
+
+
+class CurlPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.curl_patcher = mock.patch('source.lib.curl_pool.pycurl.Curl', mock.Mock(side_effect=lambda: mock.Mock()))
+        self.curl_patcher.start()
+
+    def tearDown(self):
+        self.curl_patcher.stop()
+
+    def test_acquire_creates_shared_handle(self):
+        pool = curl_pool.CurlPool()
+
+        curl = pool.acquire()
+
+        curl.setopt.assert_called_with(curl_pool.pycurl.SHARE, pool.share)
+        self.assertEqual(pool.stats['created'], 1)
+
+    def test_release_and_acquire_reuses_last_handle(self):
+        pool = curl_pool.CurlPool()
+        first = pool.acquire()
+        second = pool.acquire()
+
+        pool.release(first)
+        pool.release(second)
+
+        self.assertIs(pool.acquire(), second)
+        self.assertTrue(second.reset.called, 'handle options not reset on release')
+        self.assertEqual(pool.stats['reused'], 1)
+
+    def test_release_over_max_idle_evicts_oldest(self):
+        pool = curl_pool.CurlPool(max_idle=1)
+        first = pool.acquire()
+        second = pool.acquire()
+
+        pool.release(first)
+        pool.release(second)
+
+        self.assertTrue(first.close.called, 'oldest idle handle not closed')
+        self.assertFalse(second.close.called)
+        self.assertEqual(pool.stats['evicted'], 1)
+
+    def test_acquire_evicts_expired_handles(self):
+        pool = curl_pool.CurlPool(idle_timeout=10)
+        curl = pool.acquire()
+
+        with mock.patch('source.lib.curl_pool.time', mock.Mock(return_value=100)):
+            pool.release(curl)
+        with mock.patch('source.lib.curl_pool.time', mock.Mock(return_value=111)):
+            new_curl = pool.acquire()
+
+        self.assertIsNot(new_curl, curl)
+        self.assertTrue(curl.close.called, 'expired handle not closed')
+
+    def test_get_curl_pool_per_process(self):
+        with mock.patch('os.getpid', mock.Mock(return_value=1)):
+            pool = curl_pool.get_curl_pool()
+            self.assertIs(curl_pool.get_curl_pool(), pool)
+        with mock.patch('os.getpid', mock.Mock(return_value=2)):
+            self.assertIsNot(curl_pool.get_curl_pool(), pool)
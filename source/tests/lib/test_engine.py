@@ -0,0 +1,420 @@
+from itertools import count
+import unittest
+import mock
+import pycurl
+from source.lib import engine, probe, scheduler
+
+
+class EngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.multi = mock.Mock()
+        self.multi.perform = mock.Mock(return_value=(0, 0))
+        self.multi.timeout = mock.Mock(return_value=-1)
+        self.multi_patcher = mock.patch('source.lib.engine.pycurl.CurlMulti', mock.Mock(return_value=self.multi))
+        self.multi_patcher.start()
+        self.curl_pool = mock.Mock()
+        self.curl_pool.acquire = mock.Mock(side_effect=lambda: mock.Mock())
+
+    def tearDown(self):
+        self.multi_patcher.stop()
+
+    def test_submit_ignored_domain_calls_back_immediately(self):
+        callback = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool)
+
+        e.submit('http://odnoklassniki.ru/', callback)
+
+        callback.assert_called_once_with(([], ['http://odnoklassniki.ru/'], []))
+        self.assertTrue(e.is_idle())
+
+    def test_free_count(self):
+        e = engine.RedirectEngine(10, max_in_flight=3, curl_pool=self.curl_pool)
+
+        e.submit('http://mail.ru/a', mock.Mock())
+        e.submit('http://mail.ru/b', mock.Mock())
+
+        self.assertEqual(e.free_count(), 1)
+
+    def test_perform_respects_max_in_flight(self):
+        self.multi.info_read = mock.Mock(return_value=(0, [], []))
+        e = engine.RedirectEngine(10, max_in_flight=2, curl_pool=self.curl_pool)
+
+        for i in xrange(5):
+            e.submit('http://mail.ru/{}'.format(i), mock.Mock())
+        e.perform(0)
+
+        self.assertEqual(len(e.in_flight), 2)
+        self.assertEqual(len(e.pending), 3)
+        self.assertEqual(self.multi.add_handle.call_count, 2)
+
+    @mock.patch('source.lib.engine.read_curl_response')
+    def test_perform_advances_chain_hop_by_hop(self, read_curl_response_m):
+        curls = [mock.Mock(), mock.Mock()]
+        self.curl_pool.acquire.side_effect = curls
+        read_curl_response_m.side_effect = [
+            ('', u'http://mail.ru/b'),
+            ('<html></html>', None),
+        ]
+        self.multi.info_read = mock.Mock(side_effect=[
+            (0, [curls[0]], []),
+            (0, [curls[1]], []),
+        ])
+        callback = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool)
+
+        e.submit('http://mail.ru/a', callback)
+        self.assertEqual(e.perform(0), 0, 'chain finished after first hop')
+        self.assertEqual(e.perform(0), 1, 'chain not finished after last hop')
+
+        callback.assert_called_once_with((
+            ['http_status'], ['http://mail.ru/a', 'http://mail.ru/b'], []
+        ))
+        self.assertTrue(e.is_idle())
+
+    def test_perform_error_finishes_chain(self):
+        curl = mock.Mock()
+        self.curl_pool.acquire.side_effect = [curl]
+        self.multi.info_read = mock.Mock(return_value=(0, [], [(curl, pycurl.E_COULDNT_CONNECT, 'refused')]))
+        callback = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool)
+
+        e.submit('http://mail.ru/a', callback)
+        e.perform(0)
+
+        history_types, history_urls, counters = callback.call_args[0][0]
+        self.assertEqual(history_types, ['ERROR'])
+        self.curl_pool.release.assert_called_once_with(curl)
+
+    @mock.patch('source.lib.engine.read_curl_response', mock.Mock(return_value=('', u'http://[bad/')))
+    @mock.patch('source.lib.engine.process_response')
+    def test_malformed_redirect_finishes_only_its_chain(self, process_response_m):
+        curls = [mock.Mock(), mock.Mock()]
+        self.curl_pool.acquire.side_effect = curls
+        process_response_m.side_effect = [ValueError('Invalid IPv6 URL'), (None, None, '<html></html>')]
+        self.multi.info_read = mock.Mock(return_value=(0, curls, []))
+        bad_callback, good_callback = mock.Mock(), mock.Mock()
+        breaker = mock.Mock()
+        breaker.check = mock.Mock(return_value=0)
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, breaker=breaker)
+
+        e.submit('http://mail.ru/bad', bad_callback)
+        e.submit('http://mail.ru/good', good_callback)
+        self.assertEqual(e.perform(0), 2)
+
+        self.assertEqual(bad_callback.call_args[0][0][0], ['ERROR'])
+        self.assertEqual(good_callback.call_args[0][0][0], [])
+        self.assertTrue(e.is_idle())
+        self.assertEqual(breaker.record.call_args_list, [mock.call('mail.ru', True)] * 2,
+                         'malformed url counted as host failure')
+
+    @mock.patch('source.lib.engine.setup_curl', mock.Mock(side_effect=ValueError))
+    def test_setup_error_finishes_chain(self):
+        callback = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool)
+
+        e.submit('http://mail.ru/a', callback)
+        e.perform(0)
+
+        self.assertEqual(callback.call_args[0][0][0], ['ERROR'])
+        self.assertFalse(self.multi.add_handle.called)
+        self.assertTrue(self.curl_pool.release.called, 'curl handle not returned to pool')
+
+    def test_failing_host_skipped(self):
+        breaker = mock.Mock()
+        breaker.check = mock.Mock(return_value=30)
+        callback = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, breaker=breaker)
+
+        e.submit('http://mail.ru/a', callback)
+        e.perform(0)
+
+        callback.assert_called_once_with((['ERROR'], ['http://mail.ru/a', 'http://mail.ru/a'], []))
+        self.assertFalse(self.multi.add_handle.called)
+        self.assertEqual(breaker.check.call_args[0][0], 'mail.ru')
+
+    def test_same_url_checked_once(self):
+        flights = mock.Mock()
+        flights.join = mock.Mock(return_value=(True, None))
+        callbacks = [mock.Mock(), mock.Mock()]
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, flights=flights)
+
+        for callback in callbacks:
+            e.submit('http://mail.ru/a', callback)
+
+        self.assertEqual(len(e.pending), 1)
+        self.assertEqual(flights.join.call_count, 1)
+        result = (['ERROR'], ['http://mail.ru/a', 'http://mail.ru/a'], [])
+        history, land = e.pending[0]
+        land(result)
+        for callback in callbacks:
+            callback.assert_called_once_with(result)
+        flights.publish.assert_called_once_with('http://mail.ru/a', result)
+        self.assertEqual(e.owned, {})
+
+    def test_recheck_not_shared(self):
+        flights = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, flights=flights)
+
+        e.submit('http://mail.ru/a', mock.Mock(), use_cache=False)
+
+        self.assertFalse(flights.join.called)
+        self.assertEqual(len(e.pending), 1)
+
+    def test_result_of_other_worker(self):
+        result = [[], ['http://mail.ru/a'], []]
+        flights = mock.Mock()
+        flights.join = mock.Mock(side_effect=[(False, None), (False, None), (False, result)])
+        callback = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, flights=flights)
+
+        e.submit('http://mail.ru/a', callback)
+        self.assertFalse(e.is_idle())
+        clock = mock.Mock(side_effect=count(100))
+        with mock.patch('source.lib.engine.sleep'), mock.patch('source.lib.engine.time', clock):
+            self.assertEqual(e.perform(0), 0)
+            self.assertEqual(e.perform(0), 1)
+
+        callback.assert_called_once_with(result)
+        self.assertTrue(e.is_idle())
+        self.assertFalse(self.multi.add_handle.called)
+
+    @mock.patch('source.lib.engine.sleep', mock.Mock())
+    def test_other_worker_results_polled_on_timer(self):
+        flights = mock.Mock()
+        flights.join = mock.Mock(return_value=(False, None))
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, flights=flights)
+        e.submit('http://mail.ru/a', mock.Mock())
+
+        with mock.patch('source.lib.engine.time', mock.Mock(return_value=100)):
+            e.perform(0)
+            e.perform(0)
+        self.assertEqual(flights.join.call_count, 2, 'polled on every perform')
+        with mock.patch('source.lib.engine.time', mock.Mock(return_value=100 + e.flight_poll_interval)):
+            e.perform(0)
+        self.assertEqual(flights.join.call_count, 3)
+
+    def test_abandoned_check_taken_over(self):
+        self.multi.info_read = mock.Mock(return_value=(0, [], []))
+        flights = mock.Mock()
+        flights.join = mock.Mock(side_effect=[(False, None), (True, None)])
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, flights=flights)
+
+        e.submit('http://mail.ru/a', mock.Mock())
+        e.perform(0)
+
+        self.assertEqual(e.waiting, {})
+        self.assertEqual(len(e.owned['http://mail.ru/a']), 1)
+        self.assertEqual(self.multi.add_handle.call_count, 1)
+
+    def test_perform_error_recorded_by_breaker(self):
+        curl = mock.Mock()
+        self.curl_pool.acquire.side_effect = [curl]
+        self.multi.info_read = mock.Mock(return_value=(0, [], [(curl, pycurl.E_COULDNT_CONNECT, 'refused')]))
+        breaker = mock.Mock()
+        breaker.check = mock.Mock(return_value=0)
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, breaker=breaker)
+
+        e.submit('http://mail.ru/a', mock.Mock())
+        e.perform(0)
+
+        breaker.record.assert_called_once_with('mail.ru', False)
+
+    @mock.patch('source.lib.engine.ResponseBuffer')
+    @mock.patch('source.lib.engine.read_curl_response', mock.Mock(return_value=('', None)))
+    def test_perform_aborted_transfer_is_not_error(self, response_buffer_m):
+        response_buffer_m.return_value.aborted = True
+        response_buffer_m.return_value.counters = mock.Mock(return_value=[])
+        curl = mock.Mock()
+        self.curl_pool.acquire.side_effect = [curl]
+        self.multi.info_read = mock.Mock(return_value=(0, [], [(curl, pycurl.E_WRITE_ERROR, 'Failed writing body')]))
+        callback = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool)
+
+        e.submit('http://mail.ru/a', callback)
+        e.perform(0)
+
+        callback.assert_called_once_with(([], ['http://mail.ru/a'], []))
+
+    @mock.patch('source.lib.engine.ResponseBuffer')
+    @mock.patch('source.lib.engine.read_curl_response', mock.Mock(return_value=('<html></html>', None)))
+    @mock.patch('source.lib.get_counters')
+    def test_perform_reuses_counters_found_while_loading(self, get_counters_m, response_buffer_m):
+        response_buffer_m.return_value.aborted = False
+        response_buffer_m.return_value.counters = mock.Mock(return_value=['YA_METRICA'])
+        curl = mock.Mock()
+        self.curl_pool.acquire.side_effect = [curl]
+        self.multi.info_read = mock.Mock(return_value=(0, [curl], []))
+        callback = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool)
+
+        e.submit('http://mail.ru/a', callback)
+        e.perform(0)
+
+        callback.assert_called_once_with(([], ['http://mail.ru/a'], ['YA_METRICA']))
+        self.assertFalse(get_counters_m.called)
+
+    def test_cached_chain_skips_network(self):
+        hop_cache = mock.Mock()
+        hop_cache.get = mock.Mock(return_value=(None, None, ['YA_METRICA']))
+        callback = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, hop_cache=hop_cache)
+
+        e.submit('http://mail.ru/a', callback)
+        e.perform(0)
+
+        callback.assert_called_once_with(([], ['http://mail.ru/a'], ['YA_METRICA']))
+        self.assertFalse(self.curl_pool.acquire.called)
+
+    def test_submit_without_cache(self):
+        hop_cache = mock.Mock()
+        self.multi.info_read = mock.Mock(return_value=(0, [], []))
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, hop_cache=hop_cache)
+
+        e.submit('http://mail.ru/a', mock.Mock(), use_cache=False)
+        e.perform(0)
+
+        self.assertFalse(hop_cache.get.called)
+        self.assertEqual(len(e.in_flight), 1)
+
+    def test_perform_defers_throttled_host(self):
+        self.multi.info_read = mock.Mock(return_value=(0, [], []))
+        e = engine.RedirectEngine(
+            10, max_in_flight=10, curl_pool=self.curl_pool, scheduler=scheduler.HostScheduler(max_concurrency=1)
+        )
+
+        e.submit('http://mail.ru/a', mock.Mock())
+        e.submit('http://mail.ru/b', mock.Mock())
+        e.submit('http://ya.ru/', mock.Mock())
+        e.perform(0)
+
+        self.assertEqual(sorted(h.next_url for h, _, _, _, _ in e.in_flight.values()),
+                         ['http://mail.ru/a', 'http://ya.ru/'])
+        self.assertEqual([h.next_url for h, _ in e.pending], ['http://mail.ru/b'])
+        self.assertEqual(e.throttled, 1)
+        self.assertEqual(e.free_count(), 8)
+
+    @mock.patch('source.lib.engine.read_curl_response', mock.Mock(return_value=('<html></html>', None)))
+    def test_finish_releases_host(self):
+        curl = mock.Mock()
+        self.curl_pool.acquire.side_effect = [curl, mock.Mock()]
+        self.multi.info_read = mock.Mock(side_effect=[(0, [], []), (0, [curl], [])])
+        e = engine.RedirectEngine(
+            10, curl_pool=self.curl_pool, scheduler=scheduler.HostScheduler(max_concurrency=1)
+        )
+
+        e.submit('http://mail.ru/a', mock.Mock())
+        e.submit('http://mail.ru/b', mock.Mock())
+        e.perform(0)
+        e.perform(0)
+
+        self.assertEqual([h.next_url for h, _, _, _, _ in e.in_flight.values()], ['http://mail.ru/b'])
+        self.assertEqual(e.throttled, 0)
+
+    @mock.patch('source.lib.engine.sleep')
+    @mock.patch('source.lib.engine.time', mock.Mock(return_value=100.0))
+    def test_perform_sleeps_until_rate_allows(self, sleep_m):
+        s = scheduler.HostScheduler(max_rate=4)
+        s.start('mail.ru', 100.0)
+        s.finish('mail.ru', 100.0)
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, scheduler=s)
+
+        e.submit('http://mail.ru/a', mock.Mock())
+
+        self.assertEqual(e.perform(1.0), 0)
+        sleep_m.assert_called_once_with(0.25)
+        self.assertFalse(self.multi.select.called)
+
+    @mock.patch('source.lib.engine.read_head_response', mock.Mock(return_value=(302, None, u'http://mail.ru/b')))
+    @mock.patch('source.lib.engine.read_curl_response', mock.Mock(return_value=('<html></html>', None)))
+    def test_head_redirect_then_get_for_body(self):
+        curls = [mock.Mock(), mock.Mock(), mock.Mock()]
+        self.curl_pool.acquire.side_effect = curls
+        self.multi.info_read = mock.Mock(side_effect=[(0, [curl], []) for curl in curls])
+        prober = probe.HeadProber()
+        prober.check_head = mock.Mock(side_effect=[('', u'http://mail.ru/b'), None])
+        callback = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, prober=prober)
+
+        e.submit('http://mail.ru/a', callback)
+        for _ in xrange(3):
+            e.perform(0)
+
+        curls[0].setopt.assert_any_call(curls[0].NOBODY, True)
+        curls[1].setopt.assert_any_call(curls[1].NOBODY, True)
+        self.assertNotIn(mock.call(curls[2].NOBODY, True), curls[2].setopt.call_args_list)
+        callback.assert_called_once_with((['http_status'], ['http://mail.ru/a', 'http://mail.ru/b'], []))
+
+    def test_head_unreachable_host_is_error(self):
+        curl = mock.Mock()
+        self.curl_pool.acquire.side_effect = [curl]
+        self.multi.info_read = mock.Mock(return_value=(0, [], [(curl, pycurl.E_COULDNT_CONNECT, 'refused')]))
+        callback = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, prober=probe.HeadProber())
+
+        e.submit('http://mail.ru/a', callback)
+        e.perform(0)
+
+        callback.assert_called_once_with((['ERROR'], ['http://mail.ru/a', 'http://mail.ru/a'], []))
+        self.assertTrue(e.is_idle())
+
+    @mock.patch('source.lib.engine.time', mock.Mock(side_effect=[0, 0, 20]))
+    def test_expired_chain_is_cut_before_next_hop(self):
+        callback = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, task_timeout=10)
+        e.submit('http://mail.ru/a', callback)
+
+        e.perform(0)
+
+        callback.assert_called_once_with((['TIMEOUT'], ['http://mail.ru/a', 'http://mail.ru/a'], []))
+        self.assertFalse(self.curl_pool.acquire.called)
+
+    def test_hop_timeouts_use_remaining_budget(self):
+        self.multi.info_read = mock.Mock(return_value=(0, [], []))
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, connect_timeout=1, task_timeout=10)
+
+        with mock.patch('source.lib.engine.time', mock.Mock(return_value=100)):
+            e.submit('http://mail.ru/a', mock.Mock())
+        with mock.patch('source.lib.engine.time', mock.Mock(return_value=105)),\
+                mock.patch('source.lib.engine.setup_curl') as setup_curl_m:
+            e.perform(0)
+
+        self.assertEqual(setup_curl_m.call_args[0][2], 5)
+        self.assertEqual(setup_curl_m.call_args[0][6], 1)
+
+    def test_error_after_deadline_is_timeout(self):
+        curl = mock.Mock()
+        self.curl_pool.acquire.side_effect = [curl]
+        self.multi.info_read = mock.Mock(side_effect=[
+            (0, [], []),
+            (0, [], [(curl, pycurl.E_OPERATION_TIMEDOUT, 'timeout')]),
+        ])
+        callback = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, task_timeout=10)
+
+        with mock.patch('source.lib.engine.time', mock.Mock(return_value=100)):
+            e.submit('http://mail.ru/a', callback)
+            e.perform(0)
+        self.assertFalse(callback.called)
+
+        with mock.patch('source.lib.engine.time', mock.Mock(return_value=110)):
+            e.perform(0)
+
+        callback.assert_called_once_with((['TIMEOUT'], ['http://mail.ru/a', 'http://mail.ru/a'], []))
+
+    def test_perform_select_limited_by_curl_timeout(self):
+        self.multi.info_read = mock.Mock(return_value=(0, [], []))
+        self.multi.timeout = mock.Mock(return_value=0)
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool)
+        e.submit('http://mail.ru/a', mock.Mock())
+
+        e.perform(1.0)
+
+        self.multi.select.assert_called_once_with(0)
+
+    def test_submit_prefetches_host(self):
+        dns_cache = mock.Mock()
+        e = engine.RedirectEngine(10, curl_pool=self.curl_pool, dns_cache=dns_cache)
+
+        e.submit('http://mail.ru/a', mock.Mock())
+
+        dns_cache.prefetch.assert_called_once_with('http://mail.ru/a')
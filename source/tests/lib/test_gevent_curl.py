@@ -0,0 +1,74 @@
+import unittest
+import gevent
+import mock
+import pycurl
+from source.lib import gevent_curl
+
+
+class GeventCurlTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = mock.Mock()
+        with mock.patch('source.lib.gevent_curl.get_hub', mock.Mock(return_value=mock.Mock(loop=self.loop))):
+            self.gcurl = gevent_curl.GeventCurlMulti()
+        self.gcurl.multi = mock.Mock()
+        self.gcurl.multi.socket_action = mock.Mock(return_value=(0, 0))
+        self.gcurl.multi.info_read = mock.Mock(return_value=(0, [], []))
+
+    def test_on_socket_watches_fd(self):
+        self.gcurl._on_socket(pycurl.POLL_INOUT, 5, self.gcurl.multi, None)
+
+        self.loop.io.assert_called_once_with(5, gevent_curl.GEVENT_READ | gevent_curl.GEVENT_WRITE)
+        self.loop.io.return_value.start.assert_called_once_with(self.gcurl._on_io, 5, pass_events=True)
+        self.assertEqual(self.gcurl.watchers[5], self.loop.io.return_value)
+
+    def test_on_socket_remove_stops_watcher(self):
+        self.gcurl._on_socket(pycurl.POLL_IN, 5, self.gcurl.multi, None)
+        watcher = self.loop.io.return_value
+
+        self.gcurl._on_socket(pycurl.POLL_REMOVE, 5, self.gcurl.multi, None)
+
+        watcher.stop.assert_called_once_with()
+        self.assertEqual(self.gcurl.watchers, {})
+
+    def test_on_timer(self):
+        self.gcurl._on_timer(200)
+
+        self.loop.timer.assert_called_once_with(0.2)
+        self.loop.timer.return_value.start.assert_called_once_with(
+            self.gcurl._socket_action, pycurl.SOCKET_TIMEOUT, 0
+        )
+
+        self.gcurl._on_timer(-1)
+
+        self.loop.timer.return_value.stop.assert_called_once_with()
+        self.assertIsNone(self.gcurl.timer)
+
+    def test_on_io_maps_events(self):
+        self.gcurl._on_io(gevent_curl.GEVENT_READ, 5)
+
+        self.gcurl.multi.socket_action.assert_called_once_with(5, pycurl.CSELECT_IN)
+
+    def test_socket_action_finishes_requests(self):
+        ok_curl, err_curl = mock.Mock(), mock.Mock()
+        ok_result, err_result = mock.Mock(), mock.Mock()
+        self.gcurl.results = {ok_curl: ok_result, err_curl: err_result}
+        self.gcurl.multi.info_read = mock.Mock(return_value=(0, [ok_curl], [(err_curl, 7, 'refused')]))
+
+        self.gcurl._socket_action(pycurl.SOCKET_TIMEOUT, 0)
+
+        ok_result.set.assert_called_once_with()
+        self.assertEqual(err_result.set_exception.call_args[0][0].args, (7, 'refused'))
+        self.assertEqual(self.gcurl.multi.remove_handle.call_count, 2)
+        self.assertEqual(self.gcurl.results, {})
+
+    def test_perform_raises_curl_error(self):
+        curl = mock.Mock()
+        self.gcurl.multi.add_handle = mock.Mock(side_effect=lambda c: gevent.spawn(
+            self.gcurl._finish, c, pycurl.error(28, 'timeout')
+        ))
+
+        with self.assertRaises(pycurl.error):
+            self.gcurl.perform(curl)
+
+        self.loop.run_callback.assert_called_once_with(self.gcurl._kick)
+        self.gcurl.multi.remove_handle.assert_called_once_with(curl)
@@ -0,0 +1,52 @@
+import unittest
+import mock
+from source.lib import health
+
+
+class HealthTestCase(unittest.TestCase):
+    def setUp(self):
+        self.health = health.NetworkHealth(['http://a', 'http://b'], 1, fail_threshold=3, recover_threshold=2)
+
+    def test_single_failure_keeps_network_up(self):
+        self.health.record(False)
+        self.health.record(True)
+        self.health.record(False)
+        self.health.record(False)
+
+        self.assertTrue(self.health.is_up())
+
+    def test_consecutive_failures_pause(self):
+        for _ in xrange(3):
+            self.health.record(False)
+
+        self.assertFalse(self.health.is_up())
+
+    def test_recovery_needs_consecutive_successes(self):
+        for _ in xrange(3):
+            self.health.record(False)
+
+        self.health.record(True)
+        self.assertFalse(self.health.is_up())
+        self.health.record(True)
+        self.assertTrue(self.health.is_up())
+
+    def test_probe_any_target(self):
+        with mock.patch('source.lib.health.check_network_status', mock.Mock(side_effect=[False, True])) as check_m:
+            self.assertTrue(self.health.probe())
+        self.assertEqual(check_m.call_count, 2)
+
+        with mock.patch('source.lib.health.check_network_status', mock.Mock(return_value=False)):
+            self.assertFalse(self.health.probe())
+
+    @mock.patch('source.lib.health.Process')
+    def test_ensure_running_restarts_dead_process(self, process_m):
+        self.health.ensure_running(42)
+        process_m.return_value.is_alive = mock.Mock(return_value=True)
+        self.health.ensure_running(42)
+
+        self.assertEqual(process_m.call_count, 1)
+        process_m.assert_called_once_with(target=self.health.run, args=(42,), name=health.HEALTH_PROCESS_NAME)
+
+        process_m.return_value.is_alive = mock.Mock(return_value=False)
+        self.health.ensure_running(42)
+        self.assertEqual(process_m.call_count, 2)
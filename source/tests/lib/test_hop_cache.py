@@ -0,0 +1,104 @@
+import unittest
+import mock
+from source.lib import hop_cache
+
+
+class HopCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = hop_cache.HopCache(':memory:', ttl=60, max_entries=2)
+
+    def test_get_miss(self):
+        self.assertIsNone(self.cache.get('http://mail.ru/'))
+        self.assertEqual(self.cache.stats['misses'], 1)
+
+    def test_put_get_redirect(self):
+        self.cache.put('http://mail.ru/', 'http://mail.ru/a', 'http_status', '')
+
+        self.assertEqual(self.cache.get('http://mail.ru/'), ('http://mail.ru/a', 'http_status', None))
+        self.assertEqual(self.cache.stats['hits'], 1)
+
+    def test_put_get_final_page_counters(self):
+        self.cache.put('http://mail.ru/', None, None, '<script src="//mc.yandex.ru/metrika/watch.js">')
+
+        self.assertEqual(self.cache.get('http://mail.ru/'), (None, None, ['YA_METRICA']))
+
+    def test_put_error_not_cached(self):
+        self.cache.put('http://mail.ru/', 'http://mail.ru/', 'ERROR', None)
+
+        self.assertIsNone(self.cache.get('http://mail.ru/'))
+
+    def test_get_expired(self):
+        with mock.patch('source.lib.hop_cache.time', mock.Mock(return_value=100)):
+            self.cache.put('http://mail.ru/', 'http://mail.ru/a', 'http_status', '')
+        with mock.patch('source.lib.hop_cache.time', mock.Mock(return_value=161)):
+            self.assertIsNone(self.cache.get('http://mail.ru/'))
+
+    def test_evict_least_recently_used(self):
+        for i, now in enumerate([100, 101, 102]):
+            with mock.patch('source.lib.hop_cache.time', mock.Mock(return_value=now)):
+                self.cache.put('http://mail.ru/{}'.format(i), 'http://mail.ru/a', 'http_status', '')
+        with mock.patch('source.lib.hop_cache.time', mock.Mock(return_value=103)):
+            self.cache.get('http://mail.ru/0')
+            self.cache.evict()
+
+            self.assertIsNotNone(self.cache.get('http://mail.ru/0'))
+            self.assertIsNone(self.cache.get('http://mail.ru/1'))
+            self.assertIsNotNone(self.cache.get('http://mail.ru/2'))
+
+    def test_db_error_is_miss(self):
+        self.cache.db = mock.Mock()
+        self.cache.db.execute = mock.Mock(side_effect=hop_cache.sqlite3.OperationalError('database is locked'))
+
+        self.assertIsNone(self.cache.get('http://mail.ru/'))
+        self.cache.put('http://mail.ru/', None, None, '')
+        self.assertEqual(self.cache.stats['errors'], 2)
+
+    def test_hit_does_not_write_until_flush(self):
+        with mock.patch('source.lib.hop_cache.time', mock.Mock(return_value=100)):
+            self.cache.put('http://mail.ru/', 'http://mail.ru/a', 'http_status', '')
+        with mock.patch('source.lib.hop_cache.time', mock.Mock(return_value=105)):
+            self.cache.get('http://mail.ru/')
+
+        accessed = lambda: self.cache.db.execute('SELECT accessed FROM hops').fetchone()[0]
+        self.assertEqual(accessed(), 100)
+        self.cache.flush_touched()
+        self.assertEqual(accessed(), 105)
+        self.assertEqual(self.cache.touched, {})
+
+    def test_hits_flushed_in_batches(self):
+        self.cache.touch_every = 2
+        self.cache.put('http://mail.ru/', 'http://mail.ru/a', 'http_status', '')
+        self.cache.put('http://mail.ru/a', None, None, '')
+        self.cache.flush_touched = mock.Mock()
+
+        self.cache.get('http://mail.ru/')
+        self.cache.get('http://mail.ru/')
+        self.assertFalse(self.cache.flush_touched.called, 'same url counted twice')
+        self.cache.get('http://mail.ru/a')
+        self.assertEqual(self.cache.flush_touched.call_count, 1)
+
+    def test_shared_file_uses_wal(self):
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        try:
+            cache = hop_cache.HopCache(directory + '/hops.db')
+            self.assertEqual(cache.db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(cache.db.execute('PRAGMA synchronous').fetchone()[0], 1)
+            cache.db.close()
+        finally:
+            shutil.rmtree(directory)
+
+    @mock.patch('source.lib.hop_cache.connect_shared_db')
+    def test_locked_file_on_init_is_not_fatal(self, connect_shared_db_m):
+        connect_shared_db_m.return_value.execute.side_effect = hop_cache.sqlite3.OperationalError('database is locked')
+
+        cache = hop_cache.HopCache('hops.db')
+
+        self.assertIsNone(cache.get('http://mail.ru/'))
+        self.assertEqual(cache.stats['errors'], 2)
+
+    def test_init_hop_cache_disabled(self):
+        self.assertIsNone(hop_cache.init_hop_cache(None))
+        self.assertIsNone(hop_cache.get_hop_cache())
@@ -1,7 +1,9 @@
 import unittest
 import mock
 import rstr
+import pycurl
 from source import lib
+from source.lib.curl_pool import CurlPool
 
 
 class InitTestCase(unittest.TestCase):
@@ -79,6 +81,41 @@ class InitTestCase(unittest.TestCase):
             [],
             'No counters exist in  this page')
 
+    def test_get_counters_case_insensitive(self):
+        page = '<script src="//MC.Yandex.RU/metrika/watch.js"></script>'
+
+        self.assertEqual(lib.get_counters(page), ['YA_METRICA'])
+
+    def test_counter_scanner_split_between_chunks(self):
+        scanner = lib.CounterScanner()
+        page = '<html>' + 'x' * 100 + '<script src="//www.google-analytics.com/ga.js"></script>'
+        split = page.index('analytics')
+
+        scanner.feed(page[:split])
+        self.assertEqual(scanner.counters(), [])
+        scanner.feed(page[split:])
+
+        self.assertEqual(scanner.counters(), ['GOOGLE_ANALYTICS'])
+
+    def test_counter_scanner_done(self):
+        scanner = lib.CounterScanner()
+
+        for counter_name, counter_url in lib.COUNTER_URLS:
+            self.assertFalse(scanner.done)
+            scanner.feed(counter_url)
+
+        self.assertTrue(scanner.done)
+        self.assertEqual(scanner.counters(), [counter_name for counter_name, _ in lib.COUNTER_URLS])
+
+    def test_response_buffer_aborts_when_all_counters_found(self):
+        buff = lib.ResponseBuffer('http://mail.ru/')
+        buff.write('<html><head></head><body>')
+
+        for _, counter_url in lib.COUNTER_URLS[:-1]:
+            self.assertIsNone(buff.write(counter_url))
+        self.assertEqual(buff.write(lib.COUNTER_URLS[-1][1]), 0)
+        self.assertTrue(buff.aborted)
+
     def _actual_test_make_pycurl_request(self, redirect_url, resp_test, url, useragent, curl_mock=mock.MagicMock(), string_io_mock=mock.MagicMock()):
         string_io_mock.getvalue = mock.Mock(return_value=resp_test)
 
@@ -89,10 +126,22 @@ class InitTestCase(unittest.TestCase):
             with mock.patch('source.lib.to_unicode', mock.Mock(return_value=redirect_url)):
                 with mock.patch('source.lib.StringIO', mock.Mock(return_value=string_io_mock)):
                     with mock.patch('pycurl.Curl', mock.Mock(return_value=curl_mock)):
-                        resp, redirect = lib.make_pycurl_request(url, 60, useragent)
+                        with mock.patch('source.lib.get_curl_pool', mock.Mock(return_value=CurlPool())):
+                            resp, redirect = lib.make_pycurl_request(url, 60, useragent)
         self.assertEqual(resp, resp_test, 'Wrong response')
         self.assertEqual(redirect, redirect_url, 'Wrong redirect url')
 
+    def test_perform_curl_with_performer(self):
+        curl, performer = mock.Mock(), mock.Mock()
+        lib.set_curl_performer(performer)
+        try:
+            lib.perform_curl(curl)
+        finally:
+            lib.set_curl_performer(None)
+
+        performer.assert_called_once_with(curl)
+        self.assertFalse(curl.perform.called)
+
     @mock.patch('source.lib.prepare_url', mock.Mock())
     def test_make_pycurl_request(self):
         url = 'http://test_url.net'
@@ -122,6 +171,97 @@ class InitTestCase(unittest.TestCase):
 
         self._actual_test_make_pycurl_request(redirect_url, resp_test, url, useragent)
 
+    @mock.patch('source.lib.prepare_url', mock.Mock())
+    def test_make_pycurl_request_releases_curl_on_error(self):
+        curl_pool = mock.Mock()
+        curl_pool.acquire.return_value.perform = mock.Mock(side_effect=lib.pycurl.error)
+
+        with mock.patch('source.lib.get_curl_pool', mock.Mock(return_value=curl_pool)):
+            self.assertRaises(lib.pycurl.error, lib.make_pycurl_request, 'http://test_url.net', 60)
+
+        curl_pool.release.assert_called_once_with(curl_pool.acquire.return_value)
+
+    @mock.patch('source.lib.prepare_url', mock.Mock())
+    def test_make_pycurl_request_aborted_by_buffer(self):
+        curl_pool = mock.Mock()
+        curl = curl_pool.acquire.return_value
+        curl.getinfo = mock.Mock(return_value=None)
+
+        def perform():
+            buff.write('<html><head><meta http-equiv="refresh" content="0; url=a.html"></head><body>')
+            raise lib.pycurl.error(lib.pycurl.E_WRITE_ERROR, 'Failed writing body')
+
+        def response_buffer(*args):
+            return buff
+
+        buff = lib.ResponseBuffer('http://mail.ru/')
+        curl.perform = mock.Mock(side_effect=perform)
+
+        with mock.patch('source.lib.get_curl_pool', mock.Mock(return_value=curl_pool)):
+            with mock.patch('source.lib.ResponseBuffer', mock.Mock(side_effect=response_buffer)):
+                content, redirect_url = lib.make_pycurl_request('http://mail.ru/', 60)
+
+        self.assertTrue(content.startswith('<html>'), 'content of aborted transfer lost')
+        self.assertIsNone(redirect_url)
+
+    def test_response_buffer_aborts_not_html(self):
+        buff = lib.ResponseBuffer('http://mail.ru/')
+        buff.header('HTTP/1.1 200 OK\r\n')
+        buff.header('Content-Type: application/vnd.android.package-archive\r\n')
+
+        self.assertEqual(buff.write('PK\x03\x04'), 0)
+        self.assertTrue(buff.aborted)
+        self.assertEqual(buff.getvalue(), '')
+
+    def test_response_buffer_accepts_html(self):
+        buff = lib.ResponseBuffer('http://mail.ru/')
+        buff.header('Content-Type: text/html; charset=utf-8\r\n')
+
+        self.assertIsNone(buff.write(self.get_default_html()))
+        self.assertFalse(buff.aborted)
+        self.assertEqual(buff.getvalue(), self.get_default_html())
+
+    def test_response_buffer_max_body_bytes(self):
+        buff = lib.ResponseBuffer('http://mail.ru/', max_body_bytes=10)
+
+        self.assertIsNone(buff.write('a' * 6))
+        self.assertEqual(buff.write('b' * 6), 0)
+        self.assertTrue(buff.aborted)
+        self.assertEqual(buff.getvalue(), 'aaaaaabbbb')
+
+    def test_response_buffer_aborts_on_meta_in_head(self):
+        buff = lib.ResponseBuffer('http://mail.ru/')
+        page = self.get_redirect_html('page.html')
+        head_end = page.index('</head>')
+
+        self.assertIsNone(buff.write(page[:head_end]))
+        self.assertEqual(buff.write(page[head_end:]), 0)
+        self.assertTrue(buff.aborted)
+
+    def test_response_buffer_waits_for_script_end(self):
+        buff = lib.ResponseBuffer('http://mail.ru/')
+
+        self.assertIsNone(buff.write("<head><script>document.write('</head>"))
+        self.assertFalse(buff.head_checked)
+        self.assertEqual(buff.write('\')</script><meta http-equiv="refresh" content="0;url=a.html"></head>'), 0)
+        self.assertTrue(buff.aborted)
+
+    def test_response_buffer_counters_without_head(self):
+        buff = lib.ResponseBuffer('http://mail.ru/')
+
+        buff.write('<script src="//mc.yandex.ru/metrika/watch.js"></script>')
+
+        self.assertFalse(buff.head_checked)
+        self.assertEqual(buff.counters(), ['YA_METRICA'])
+
+    def test_response_buffer_no_meta_in_head(self):
+        buff = lib.ResponseBuffer('http://mail.ru/')
+        page = self.get_default_html()
+
+        self.assertIsNone(buff.write(page))
+        self.assertTrue(buff.head_checked)
+        self.assertFalse(buff.aborted)
+
     def test_fix_market_url_good(self):
         web_url = 'http://play.google.com/store/apps/'
         market_url = 'market://'
@@ -194,6 +334,68 @@ class InitTestCase(unittest.TestCase):
 
         self.assertEquals(url, None, 'such bad html should be parsed')
 
+    def test_check_for_meta_not_first_meta(self):
+        content = """
+            <html>
+                <head>
+                    <meta charset="utf-8">
+                    <meta name="viewport" content="width=device-width">
+                    <META HTTP-EQUIV='Refresh' CONTENT='0; URL=/next?a=1&amp;b=2'>
+                </head>
+            </html>"""
+
+        url = lib.check_for_meta(content, 'http://mail.ru/dir/page.html')
+
+        self.assertEqual(url, 'http://mail.ru/next?a=1&b=2')
+
+    def test_check_for_meta_skips_comments_and_body(self):
+        content = """
+            <html>
+                <head>
+                    <!-- <meta http-equiv="refresh" content="0; url=commented.html"> -->
+                    <script>document.write('<meta http-equiv="refresh" content="0; url=script.html">')</script>
+                </head>
+                <body>
+                    <meta http-equiv="refresh" content="0; url=body.html">
+                </body>
+            </html>"""
+
+        self.assertIsNone(lib.check_for_meta(content, 'http://mail.ru/'))
+
+    def test_check_for_meta_head_end_inside_script(self):
+        content = """
+            <html>
+                <head>
+                    <script>document.write('</head><body>')</script>
+                    <meta http-equiv="refresh" content="0; url=next.html">
+                </head>
+            </html>"""
+
+        self.assertEqual(lib.check_for_meta(content, 'http://mail.ru/'), 'http://mail.ru/next.html')
+
+    def test_find_head_end_unclosed_script(self):
+        self.assertIsNone(lib.find_head_end("<head><script>document.write('</head>"))
+        self.assertEqual(lib.find_head_end('<head></head><body>'), len('<head></head>'))
+
+    def test_check_for_meta_without_head(self):
+        content = '<meta http-equiv=refresh content="0;url=a.html">'
+
+        self.assertEqual(lib.check_for_meta(content, 'http://mail.ru/'), 'http://mail.ru/a.html')
+
+    def test_check_for_meta_bs4(self):
+        content = self.get_redirect_html('page.html')
+
+        lib.set_meta_parser(lib.META_PARSER_BS4)
+        try:
+            url = lib.check_for_meta(content, 'http://mail.ru/')
+        finally:
+            lib.set_meta_parser(lib.META_PARSER_HEAD)
+
+        self.assertEqual(url, 'http://mail.ru/page.html')
+
+    def test_set_meta_parser_unknown(self):
+        self.assertRaises(ValueError, lib.set_meta_parser, 'lxml')
+
     def test_get_url_http(self):
         url = 'http://mail.ru'
         timeout = 10
@@ -270,6 +472,82 @@ class InitTestCase(unittest.TestCase):
 
             self.assertEquals(redirect_type, 'ERROR', 'ValueError not handled')
 
+    @mock.patch('source.lib.make_pycurl_request', mock.Mock(return_value=('', u'http://[bad/')))
+    def test_get_url_malformed_redirect(self):
+        redirect_url, redirect_type, content = lib.get_url('http://mail.ru', 10)
+
+        self.assertEqual(redirect_type, 'ERROR')
+        self.assertEqual(redirect_url, 'http://mail.ru')
+
+    def test_get_url_head_redirect(self):
+        prober = mock.Mock()
+        prober.check_head = mock.Mock(return_value=('', u'http://mail.ru/a'))
+
+        with mock.patch('source.lib.make_head_request', mock.Mock(return_value=(302, None, u'http://mail.ru/a'))),\
+                mock.patch('source.lib.make_pycurl_request') as make_pycurl_request_m:
+            redirect_url, redirect_type, content = lib.get_url('http://mail.ru/', 10, prober=prober)
+
+        self.assertEqual((redirect_url, redirect_type, content), (u'http://mail.ru/a', lib.REDIRECT_HTTP, ''))
+        prober.check_head.assert_called_once_with('http://mail.ru/', (302, None, u'http://mail.ru/a'), None)
+        self.assertFalse(make_pycurl_request_m.called)
+
+    def test_get_url_head_needs_body(self):
+        prober = mock.Mock()
+        prober.check_head = mock.Mock(return_value=None)
+        error = pycurl.error(pycurl.E_GOT_NOTHING, '')
+
+        with mock.patch('source.lib.make_head_request', mock.Mock(side_effect=error)),\
+                mock.patch('source.lib.make_pycurl_request', mock.Mock(return_value=('', u'http://mail.ru/a'))):
+            redirect_url, redirect_type, content = lib.get_url('http://mail.ru/', 10, prober=prober)
+
+        self.assertEqual(redirect_url, u'http://mail.ru/a')
+        prober.check_head.assert_called_once_with('http://mail.ru/', None, error)
+
+    @mock.patch('source.lib.time', mock.Mock(return_value=98))
+    def test_get_url_get_after_head_cut_by_deadline(self):
+        prober = mock.Mock()
+        prober.check_head = mock.Mock(return_value=None)
+
+        with mock.patch('source.lib.make_head_request', mock.Mock(return_value=(200, 'text/html', None))),\
+                mock.patch('source.lib.make_pycurl_request', mock.Mock(return_value=('', None))) as get_m:
+            lib.get_url('http://mail.ru/', 10, prober=prober, connect_timeout=5, deadline=100)
+
+        self.assertEqual(get_m.call_args[0][1], 2)
+        self.assertEqual(get_m.call_args[0][4], 2)
+
+    @mock.patch('source.lib.time', mock.Mock(return_value=100))
+    def test_get_url_no_time_left_after_head(self):
+        prober = mock.Mock()
+        prober.check_head = mock.Mock(return_value=None)
+
+        with mock.patch('source.lib.make_head_request', mock.Mock(return_value=(200, 'text/html', None))),\
+                mock.patch('source.lib.make_pycurl_request') as get_m:
+            hop = lib.get_url('http://mail.ru/', 10, prober=prober, deadline=100)
+
+        self.assertEqual(hop, ('http://mail.ru/', 'TIMEOUT', None))
+        self.assertFalse(get_m.called)
+
+    def test_get_url_head_disabled_for_host(self):
+        prober = mock.Mock()
+        prober.use_head = mock.Mock(return_value=False)
+
+        with mock.patch('source.lib.make_head_request') as make_head_request_m,\
+                mock.patch('source.lib.make_pycurl_request', mock.Mock(return_value=('', None))):
+            lib.get_url('http://mail.ru/', 10, prober=prober)
+
+        self.assertFalse(make_head_request_m.called)
+
+    def test_get_url_head_unreachable(self):
+        prober = mock.Mock()
+        prober.check_head = mock.Mock(side_effect=pycurl.error(pycurl.E_COULDNT_CONNECT, ''))
+
+        with mock.patch('source.lib.make_head_request', mock.Mock(return_value=None)),\
+                mock.patch('source.lib.make_pycurl_request') as make_pycurl_request_m:
+            redirect_url, redirect_type, content = lib.get_url('http://mail.ru/', 10, prober=prober)
+
+        self.assertEqual(redirect_type, 'ERROR')
+        self.assertFalse(make_pycurl_request_m.called)
+
     def test_get_redirect_history(self):
         expected_history_types = ['meta_tag', 'meta_tag']
         expected_history_urls = ['http://mail.ru/', 'http://mail.ru/a.html', 'http://mail.ru/b.html']
@@ -289,6 +567,99 @@ class InitTestCase(unittest.TestCase):
             self.assertEquals(history_types, expected_history_types, 'history_types not match')
             self.assertEquals(counters, expected_counters, 'counters not match')
 
+    def test_get_redirect_history_follows_hop_cache(self):
+        hop_cache = mock.Mock()
+        hop_cache.get = mock.Mock(side_effect=[
+            ('http://mail.ru/a.html', 'http_status', None),
+            None,
+            (None, None, ['YA_METRICA']),
+        ])
+
+        with mock.patch('source.lib.get_url', mock.Mock(return_value=('http://mail.ru/b.html', 'meta_tag', ''))) as get_url_m:
+            history = lib.get_redirect_history('http://mail.ru/', timeout=10, hop_cache=hop_cache)
+
+        self.assertEqual(history, (
+            ['http_status', 'meta_tag'],
+            ['http://mail.ru/', 'http://mail.ru/a.html', 'http://mail.ru/b.html'],
+            ['YA_METRICA']
+        ))
+        self.assertEqual(get_url_m.call_count, 1)
+        hop_cache.put.assert_called_once_with('http://mail.ru/a.html', 'http://mail.ru/b.html', 'meta_tag', '', None)
+
+    def test_hop_timeouts_without_deadline(self):
+        history = lib.RedirectHistory('http://mail.ru/')
+
+        self.assertEqual(history.hop_timeouts(3, 1), (3, 1))
+
+    def test_hop_timeouts_cut_by_deadline(self):
+        history = lib.RedirectHistory('http://mail.ru/', deadline=100)
+
+        self.assertEqual(history.hop_timeouts(3, 1, now=90), (3, 1))
+        self.assertEqual(history.hop_timeouts(3, 1, now=99.5), (0.5, 0.5))
+        self.assertEqual(history.hop_timeouts(3, None, now=98), (2, 2))
+        self.assertIsNone(history.hop_timeouts(3, 1, now=100))
+
+    @mock.patch('source.lib.time', mock.Mock(side_effect=[0, 1, 11]))
+    def test_get_redirect_history_task_timeout(self):
+        with mock.patch('source.lib.get_url', mock.Mock(return_value=('http://mail.ru/a', 'http_status', ''))) as get_url_m:
+            history = lib.get_redirect_history('http://mail.ru/', timeout=3, connect_timeout=1, task_timeout=10)
+
+        self.assertEqual(history, (
+            ['http_status', 'TIMEOUT'],
+            ['http://mail.ru/', 'http://mail.ru/a', 'http://mail.ru/a'],
+            []
+        ))
+        self.assertEqual(get_url_m.call_count, 1)
+        self.assertEqual(get_url_m.call_args[1]['timeout'], 3)
+        self.assertEqual(get_url_m.call_args[1]['connect_timeout'], 1)
+
+    @mock.patch('source.lib.time', mock.Mock(side_effect=[0, 8, 10]))
+    def test_get_redirect_history_hop_cut_by_task_timeout(self):
+        with mock.patch('source.lib.get_url', mock.Mock(return_value=('http://mail.ru/', 'ERROR', None))) as get_url_m:
+            history = lib.get_redirect_history('http://mail.ru/', timeout=3, task_timeout=10)
+
+        self.assertEqual(history, (['TIMEOUT'], ['http://mail.ru/', 'http://mail.ru/'], []))
+        self.assertEqual(get_url_m.call_args[1]['timeout'], 2)
+
+    @mock.patch('source.lib.time', mock.Mock(side_effect=[0, 8]))
+    def test_get_redirect_history_timeout_after_head(self):
+        breaker = mock.Mock()
+        breaker.check = mock.Mock(return_value=False)
+
+        with mock.patch('source.lib.get_url', mock.Mock(return_value=('http://mail.ru/', 'TIMEOUT', None))) as get_url_m:
+            history = lib.get_redirect_history('http://mail.ru/', timeout=3, task_timeout=10, breaker=breaker)
+
+        self.assertEqual(history, (['TIMEOUT'], ['http://mail.ru/', 'http://mail.ru/'], []))
+        self.assertEqual(get_url_m.call_args[1]['deadline'], 10)
+        self.assertFalse(breaker.record.called)
+
+    def test_setup_curl_injects_cached_address(self):
+        curl = mock.Mock()
+        dns_cache = mock.Mock()
+        dns_cache.curl_resolve = mock.Mock(return_value=['mail.ru:80:1.2.3.4'])
+
+        lib.setup_curl(curl, u'http://mail.ru/', 1, lib.ResponseBuffer('http://mail.ru/'), dns_cache=dns_cache)
+
+        dns_cache.curl_resolve.assert_called_once_with('http://mail.ru/')
+        curl.setopt.assert_any_call(curl.RESOLVE, ['mail.ru:80:1.2.3.4'])
+
+    def test_response_buffer_prefetches_location(self):
+        dns_cache = mock.Mock()
+        buff = lib.ResponseBuffer(u'http://mail.ru/a', dns_cache=dns_cache)
+
+        buff.header('HTTP/1.1 302 Found\r\n')
+        buff.header('Location: //ya.ru/b\r\n')
+
+        dns_cache.prefetch.assert_called_once_with(u'http://ya.ru/b')
+
+    def test_setup_curl_timeouts(self):
+        curl = mock.Mock()
+
+        lib.setup_curl(curl, 'http://mail.ru/', 0.5, lib.ResponseBuffer('http://mail.ru/'), connect_timeout=0.0001)
+
+        curl.setopt.assert_any_call(curl.TIMEOUT_MS, 500)
+        curl.setopt.assert_any_call(curl.CONNECTTIMEOUT_MS, 1)
+
     def test_get_redirect_history_max_redirects(self):
         expected_history_types = ['meta_tag', 'meta_tag']
         expected_history_urls = ['http://mail.ru/', 'http://mail.ru/a.html', 'http://mail.ru/b.html']
@@ -326,6 +697,63 @@ class InitTestCase(unittest.TestCase):
             # 2 means 1 source url + 1 redirect from it
             self.assertEquals(len(history_urls), 2, 'continued redirecting after ERROR type')
 
+    def test_get_redirect_history_failing_host(self):
+        breaker = mock.Mock()
+        breaker.check = mock.Mock(return_value=30)
+
+        with mock.patch('source.lib.get_url') as get_url_m:
+            history_types, history_urls, counters = lib.get_redirect_history('http://mail.ru/', timeout=10,
+                                                                             breaker=breaker)
+
+        self.assertEqual((history_types, history_urls), (['ERROR'], ['http://mail.ru/', 'http://mail.ru/']))
+        self.assertFalse(get_url_m.called)
+        breaker.check.assert_called_once_with('mail.ru')
+
+    def test_get_redirect_history_records_hops(self):
+        breaker = mock.Mock()
+        breaker.check = mock.Mock(return_value=0)
+
+        with mock.patch('source.lib.get_url', mock.Mock(side_effect=[
+            ('http://vk.com/', 'http_status', ''),
+            ('http://vk.com/', 'ERROR', None)
+        ])):
+            lib.get_redirect_history('http://mail.ru/', timeout=10, breaker=breaker)
+
+        self.assertEqual(breaker.record.call_args_list, [mock.call('mail.ru', True), mock.call('vk.com', False)])
+
+    def test_get_redirect_history_waits_for_host(self):
+        scheduler = mock.Mock()
+        scheduler.acquire = mock.Mock(return_value=True)
+
+        with mock.patch('source.lib.get_url', mock.Mock(return_value=(None, None, ''))):
+            lib.get_redirect_history('http://mail.ru/', timeout=10, scheduler=scheduler)
+
+        scheduler.acquire.assert_called_once_with('mail.ru', None)
+        self.assertEqual(scheduler.finish.call_args[0][0], 'mail.ru')
+
+    @mock.patch('source.lib.time', mock.Mock(return_value=0))
+    def test_get_redirect_history_host_wait_timeout(self):
+        scheduler = mock.Mock()
+        scheduler.acquire = mock.Mock(return_value=False)
+
+        with mock.patch('source.lib.get_url') as get_url_m:
+            history = lib.get_redirect_history('http://mail.ru/', timeout=3, task_timeout=10, scheduler=scheduler)
+
+        self.assertEqual(history, (['TIMEOUT'], ['http://mail.ru/', 'http://mail.ru/'], []))
+        scheduler.acquire.assert_called_once_with('mail.ru', 10)
+        self.assertFalse(get_url_m.called)
+        self.assertFalse(scheduler.finish.called)
+
+    def test_get_redirect_history_malformed_redirect_not_host_failure(self):
+        breaker = mock.Mock()
+        breaker.check = mock.Mock(return_value=0)
+
+        with mock.patch('source.lib.get_url', mock.Mock(return_value=('http://mail.ru/', 'ERROR', ''))):
+            history_types, _, _ = lib.get_redirect_history('http://mail.ru/', timeout=10, breaker=breaker)
+
+        self.assertEqual(history_types, ['ERROR'])
+        breaker.record.assert_called_once_with('mail.ru', True)
+
     def test_get_redirect_history_ok(self):
         expected_history_types = ['meta_tag', 'meta_tag']
         expected_history_urls = ['http://odnoklassniki.ru/', 'http://mail.ru/a.html', 'http://mail.ru/b.html']
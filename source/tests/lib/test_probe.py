@@ -0,0 +1,85 @@
+import unittest
+import mock
+import pycurl
+from source.lib import probe
+
+
+class ProbeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.prober = probe.HeadProber(max_hosts=2)
+
+    def test_redirect_without_body(self):
+        result = self.prober.check_head('http://mail.ru/', (302, 'text/html', u'http://mail.ru/a'))
+
+        self.assertEqual(result, ('', u'http://mail.ru/a'))
+
+    def test_not_html_without_body(self):
+        result = self.prober.check_head('http://mail.ru/', (200, 'image/png', None))
+
+        self.assertEqual(result, ('', None))
+
+    def test_html_needs_body(self):
+        self.assertIsNone(self.prober.check_head('http://mail.ru/', (200, 'text/html', None)))
+        self.assertIsNone(self.prober.check_head('http://mail.ru/', (200, None, None)))
+        self.assertEqual(self.prober.stats['need_body'], 2)
+        self.assertTrue(self.prober.use_head('http://mail.ru/'))
+
+    def test_bad_status_falls_back_to_get(self):
+        self.assertIsNone(self.prober.check_head('http://mail.ru/a', (405, 'text/html', None)))
+
+        self.assertFalse(self.prober.use_head('http://mail.ru/b'))
+        self.assertTrue(self.prober.use_head('http://ya.ru/'))
+        self.assertEqual(self.prober.stats['fallback'], 1)
+
+    def test_other_bad_status_not_remembered(self):
+        self.assertIsNone(self.prober.check_head('http://mail.ru/a', (404, 'text/html', None)))
+        self.assertIsNone(self.prober.check_head('http://mail.ru/a', (503, 'text/html', None)))
+
+        self.assertTrue(self.prober.use_head('http://mail.ru/b'))
+        self.assertEqual(self.prober.stats['fallback'], 2)
+
+    def test_other_error_not_remembered(self):
+        error = pycurl.error(pycurl.E_SSL_CONNECT_ERROR, 'SSL connect error')
+
+        self.assertIsNone(self.prober.check_head('http://mail.ru/', error=error))
+        self.assertTrue(self.prober.use_head('http://mail.ru/'))
+
+    def test_timeout_raises(self):
+        error = pycurl.error(pycurl.E_OPERATION_TIMEDOUT, 'Operation timed out')
+
+        self.assertRaises(pycurl.error, self.prober.check_head, 'http://mail.ru/', error=error)
+        self.assertTrue(self.prober.use_head('http://mail.ru/'))
+        self.assertEqual(self.prober.stats['fallback'], 0)
+
+    def test_error_falls_back_to_get(self):
+        error = pycurl.error(pycurl.E_GOT_NOTHING, 'Empty reply from server')
+
+        self.assertIsNone(self.prober.check_head('http://mail.ru/', error=error))
+        self.assertFalse(self.prober.use_head('http://mail.ru/'))
+
+    def test_unreachable_host_raises(self):
+        error = pycurl.error(pycurl.E_COULDNT_CONNECT, 'Connection refused')
+
+        self.assertRaises(pycurl.error, self.prober.check_head, 'http://mail.ru/', error=error)
+        self.assertTrue(self.prober.use_head('http://mail.ru/'))
+
+    def test_remembered_hosts_limit(self):
+        for host in ('a.ru', 'b.ru', 'c.ru'):
+            self.prober.check_head('http://{}/'.format(host), (501, None, None))
+
+        self.assertEqual(self.prober.no_head_hosts.keys(), ['b.ru', 'c.ru'])
+
+    def test_init_head_prober(self):
+        self.assertIsInstance(probe.init_head_prober(probe.PROBE_HEAD), probe.HeadProber)
+        self.assertEqual(probe.get_head_prober(), probe._head_prober)
+        self.assertIsNone(probe.init_head_prober(probe.PROBE_GET))
+        self.assertIsNone(probe.get_head_prober())
+
+    def test_init_head_prober_unknown(self):
+        self.assertRaises(ValueError, probe.init_head_prober, 'options')
+
+    @mock.patch('os.getpid', mock.Mock(return_value=-1))
+    def test_get_head_prober_other_process(self):
+        probe._head_prober_pid = 1
+
+        self.assertIsNone(probe.get_head_prober())
@@ -0,0 +1,86 @@
+import socket
+import unittest
+import mock
+from tarantool.error import NetworkError
+from source.lib import queue_connection
+
+
+class QueueConnectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.connection = queue_connection.QueueConnection('localhost', 33013, backoff=1, max_backoff=3)
+
+    def tearDown(self):
+        queue_connection._registry_pid = None
+
+    def test_get_queue_shares_connection(self):
+        queue1 = queue_connection.get_queue('localhost', 33013, 0)
+        queue2 = queue_connection.get_queue('localhost', 33013, 1)
+
+        self.assertIs(queue_connection.get_queue('localhost', 33013, 0), queue1)
+        self.assertIsNot(queue1, queue2)
+        self.assertIs(queue1.tnt, queue2.tnt)
+        self.assertIsNot(queue_connection.get_queue('otherhost', 33013, 0).tnt, queue1.tnt)
+
+    def test_get_queue_new_process(self):
+        queue = queue_connection.get_queue('localhost', 33013, 0)
+
+        with mock.patch('os.getpid', mock.Mock(return_value=-1)):
+            self.assertIsNot(queue_connection.get_queue('localhost', 33013, 0), queue)
+
+    @mock.patch('source.lib.queue_connection.time')
+    def test_reconnect_backoff(self, time_m):
+        self.connection.connect = mock.Mock(side_effect=NetworkError(socket.error(111, 'refused')))
+
+        time_m.return_value = 100
+        self.assertRaises(NetworkError, self.connection._opt_reconnect)
+        self.assertEqual(self.connection.retry_at, 101)
+
+        time_m.return_value = 100.5
+        self.assertRaises(NetworkError, self.connection._opt_reconnect)
+        self.assertEqual(self.connection.connect.call_count, 1)
+
+        time_m.return_value = 101
+        self.assertRaises(NetworkError, self.connection._opt_reconnect)
+        self.assertEqual(self.connection.retry_at, 103)
+
+        time_m.return_value = 103
+        self.assertRaises(NetworkError, self.connection._opt_reconnect)
+        self.assertEqual(self.connection.retry_at, 106)
+
+    def test_reconnect_starts_new_session(self):
+        self.connection.connect = mock.Mock()
+
+        self.connection._opt_reconnect()
+        self.assertEqual(self.connection.session, 1)
+        self.connection._opt_reconnect()
+        self.assertEqual(self.connection.session, 2)
+
+    def test_failed_reconnect_keeps_session(self):
+        self.connection.connect = mock.Mock(side_effect=NetworkError(socket.error(111, 'refused')))
+
+        self.assertRaises(NetworkError, self.connection._opt_reconnect)
+        self.assertEqual(self.connection.session, 0)
+
+    def test_reconnect_resets_failures(self):
+        self.connection.failures = 3
+        self.connection.connect = mock.Mock()
+
+        self.connection._opt_reconnect()
+
+        self.assertEqual(self.connection.failures, 0)
+
+    def test_is_alive(self):
+        self.connection._socket, peer = socket.socketpair()
+        self.connection.connected = True
+        self.assertTrue(self.connection.is_alive())
+
+        peer.close()
+        self.assertFalse(self.connection.is_alive())
+        self.connection._socket.close()
+
+    @mock.patch('tarantool.Connection._send_request', mock.Mock(side_effect=socket.timeout('timed out')))
+    def test_send_request_network_error(self):
+        self.connection.connected = True
+
+        self.assertRaises(NetworkError, self.connection._send_request, mock.Mock())
+        self.assertFalse(self.connection.connected)
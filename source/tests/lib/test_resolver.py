@@ -0,0 +1,108 @@
+import time
+import unittest
+import mock
+import pycurl
+from source.lib import resolver
+
+
+class ResolverTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = resolver.DnsCache(ttl=60, negative_ttl=10, max_entries=2, threads=0)
+
+    def test_split_host_port(self):
+        self.assertEqual(resolver.split_host_port('http://Mail.ru/a'), ('mail.ru', 80))
+        self.assertEqual(resolver.split_host_port('https://mail.ru:8443/'), ('mail.ru', 8443))
+        self.assertIsNone(resolver.split_host_port('http://127.0.0.1/'))
+        self.assertIsNone(resolver.split_host_port('http://[::1]:8080/'))
+        self.assertIsNone(resolver.split_host_port('ftp://mail.ru/'))
+        self.assertIsNone(resolver.split_host_port('/relative'))
+
+    def test_prefetch_queues_host_once(self):
+        self.cache.prefetch('http://mail.ru/a')
+        self.cache.prefetch('http://mail.ru/b')
+
+        self.assertEqual(self.cache.queue.qsize(), 1)
+        self.assertEqual(self.cache.queue.get(), 'mail.ru')
+        self.assertEqual(self.cache.stats['prefetches'], 1)
+
+    def test_prefetch_skips_cached_host(self):
+        self.cache._store('mail.ru', ('1.2.3.4',))
+
+        self.cache.prefetch('http://mail.ru/')
+
+        self.assertTrue(self.cache.queue.empty())
+
+    def test_curl_resolve_unknown_host_prefetches(self):
+        self.assertEqual(self.cache.curl_resolve('http://mail.ru/'), [])
+        self.assertEqual(self.cache.queue.get(), 'mail.ru')
+        self.assertEqual(self.cache.stats['misses'], 1)
+
+    def test_curl_resolve_cached_address(self):
+        self.cache._store('mail.ru', ('1.2.3.4',))
+        self.cache._store('ya.ru', ('2a02:6b8::2:242',))
+
+        self.assertEqual(self.cache.curl_resolve('https://mail.ru/'), [resolver.RESOLVE_PREFIX + 'mail.ru:443:1.2.3.4'])
+        self.assertEqual(self.cache.curl_resolve('http://ya.ru/'), [resolver.RESOLVE_PREFIX + 'ya.ru:80:[2a02:6b8::2:242]'])
+        self.assertEqual(self.cache.stats['hits'], 2)
+
+    @mock.patch('source.lib.resolver.RESOLVE_MULTIPLE', True)
+    def test_curl_resolve_all_addresses(self):
+        self.cache._store('mail.ru', ('1.2.3.4', '2a02:6b8::2:242', '5.6.7.8'))
+
+        self.assertEqual(self.cache.curl_resolve('http://mail.ru/'), [
+            resolver.RESOLVE_PREFIX + 'mail.ru:80:1.2.3.4,[2a02:6b8::2:242],5.6.7.8'
+        ])
+
+    @mock.patch('source.lib.resolver.RESOLVE_MULTIPLE', False)
+    def test_curl_resolve_first_address_on_old_curl(self):
+        self.cache._store('mail.ru', ('1.2.3.4', '5.6.7.8'))
+
+        self.assertEqual(self.cache.curl_resolve('http://mail.ru/'), [resolver.RESOLVE_PREFIX + 'mail.ru:80:1.2.3.4'])
+
+    def test_curl_resolve_negative(self):
+        self.cache._store('mail.ru', None)
+
+        with self.assertRaises(pycurl.error) as cm:
+            self.cache.curl_resolve('http://mail.ru/')
+        self.assertEqual(cm.exception.args[0], pycurl.E_COULDNT_RESOLVE_HOST)
+        self.assertEqual(self.cache.stats['negative_hits'], 1)
+        self.assertEqual(self.cache.stats['failed'], 1)
+
+    def test_lookup_expired(self):
+        self.cache._store('mail.ru', ('1.2.3.4',), now=100)
+        self.cache._store('ya.ru', None, now=100)
+
+        self.assertEqual(self.cache.lookup('mail.ru', now=159), (True, ('1.2.3.4',)))
+        self.assertEqual(self.cache.lookup('mail.ru', now=160), (False, None))
+        self.assertEqual(self.cache.lookup('ya.ru', now=111), (False, None))
+
+    def test_max_entries(self):
+        for host in ('a.ru', 'b.ru', 'c.ru'):
+            self.cache._store(host, ('1.2.3.4',))
+
+        self.assertEqual(self.cache.entries.keys(), ['b.ru', 'c.ru'])
+
+    @mock.patch('socket.getaddrinfo', mock.Mock(return_value=[
+        (2, 1, 6, '', ('1.2.3.4', 0)), (10, 1, 6, '', ('::1', 0, 0, 0)), (2, 1, 6, '', ('1.2.3.4', 0))
+    ]))
+    def test_background_resolve(self):
+        cache = resolver.DnsCache(threads=1)
+
+        cache.prefetch('http://mail.ru/')
+        for _ in xrange(100):
+            if cache.stats['resolved']:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(cache.lookup('mail.ru'), (True, ('1.2.3.4', '::1')))
+        self.assertEqual(cache.resolving, set())
+
+    def test_init_dns_cache_disabled(self):
+        self.assertIsNone(resolver.init_dns_cache(threads=0))
+        self.assertIsNone(resolver.get_dns_cache())
+
+    @mock.patch('os.getpid', mock.Mock(return_value=-1))
+    def test_get_dns_cache_other_process(self):
+        resolver._dns_cache_pid = 1
+
+        self.assertIsNone(resolver.get_dns_cache())
@@ -0,0 +1,86 @@
+import os
+import unittest
+import mock
+from source.lib import scheduler
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def test_get_host(self):
+        self.assertEqual(scheduler.get_host(u'http://Mail.RU:8080/a?b'), u'mail.ru')
+
+    def test_get_host_bad_url(self):
+        self.assertEqual(scheduler.get_host(u'http://[mail.ru/'), '')
+
+    def test_unlimited(self):
+        s = scheduler.HostScheduler()
+
+        for _ in xrange(10):
+            self.assertTrue(s.can_start('mail.ru', 0))
+            s.start('mail.ru', 0)
+
+    def test_max_concurrency(self):
+        s = scheduler.HostScheduler(max_concurrency=2)
+
+        s.start('mail.ru', 0)
+        s.start('mail.ru', 0)
+
+        self.assertFalse(s.can_start('mail.ru', 0))
+        self.assertTrue(s.can_start('ya.ru', 0))
+        s.finish('mail.ru', 1)
+        self.assertTrue(s.can_start('mail.ru', 1))
+
+    def test_max_rate(self):
+        s = scheduler.HostScheduler(max_rate=2)
+
+        s.start('mail.ru', 10)
+
+        self.assertFalse(s.can_start('mail.ru', 10.2))
+        self.assertAlmostEqual(s.delay('mail.ru', 10.2), 0.3)
+        self.assertTrue(s.can_start('mail.ru', 10.5))
+        self.assertEqual(s.delay('ya.ru', 10.2), 0)
+
+    def test_can_start_does_not_track_checked_hosts(self):
+        s = scheduler.HostScheduler(max_concurrency=2)
+
+        s.can_start('mail.ru', 0)
+
+        self.assertEqual(s.active, {})
+
+    @mock.patch('source.lib.scheduler.time', mock.Mock(side_effect=[10, 10.2, 10.5]))
+    def test_acquire_waits_for_rate(self):
+        sleep = mock.Mock()
+        s = scheduler.HostScheduler(max_rate=2, sleep=sleep)
+        s.start('mail.ru', 10)
+
+        self.assertTrue(s.acquire('mail.ru'))
+
+        self.assertEqual(len(sleep.call_args_list), 2)
+        self.assertAlmostEqual(sleep.call_args_list[1][0][0], 0.3)
+        self.assertEqual(s.active, {'mail.ru': 2})
+
+    @mock.patch('source.lib.scheduler.time', mock.Mock(side_effect=[0, 0.5, 1]))
+    def test_acquire_gives_up_at_deadline(self):
+        sleep = mock.Mock()
+        s = scheduler.HostScheduler(max_concurrency=1, sleep=sleep)
+        s.start('mail.ru', 0)
+
+        self.assertFalse(s.acquire('mail.ru', deadline=1))
+
+        self.assertEqual(sleep.call_args_list, [mock.call(s.poll_interval)] * 2)
+        self.assertEqual(s.active, {'mail.ru': 1})
+
+    def test_get_host_scheduler_per_process(self):
+        s = scheduler.init_host_scheduler(max_concurrency=3)
+
+        self.assertIs(scheduler.get_host_scheduler(), s)
+        with mock.patch('source.lib.scheduler.os.getpid', mock.Mock(return_value=os.getpid() + 1)):
+            self.assertIsNone(scheduler.get_host_scheduler())
+
+    def test_finish_forgets_idle_host(self):
+        s = scheduler.HostScheduler(max_concurrency=2, max_rate=2)
+
+        s.start('mail.ru', 10)
+        s.finish('mail.ru', 11)
+
+        self.assertEqual(dict(s.active), {})
+        self.assertEqual(s.next_start, {})
@@ -0,0 +1,110 @@
+from StringIO import StringIO
+import httplib
+import unittest
+import urllib2
+import mock
+from source.lib import session_pool
+
+
+class SessionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.session_patcher = mock.patch(
+            'source.lib.session_pool.requests.Session', mock.Mock(side_effect=lambda: mock.Mock())
+        )
+        self.session_patcher.start()
+
+    def tearDown(self):
+        self.session_patcher.stop()
+
+    def test_post_reuses_session_of_host(self):
+        pool = session_pool.SessionPool()
+
+        pool.post('http://partner.ru/a', data='1')
+        pool.post('http://Partner.ru/b', data='2')
+
+        session = pool.sessions[('http', 'partner.ru')][0]
+        self.assertEqual(session.post.call_args_list, [
+            mock.call('http://partner.ru/a', data='1'), mock.call('http://Partner.ru/b', data='2')
+        ])
+        self.assertEqual(pool.stats, {'created': 1, 'requests': 2, 'evicted': 0})
+
+    def test_session_does_not_keep_cookies(self):
+        self.session_patcher.stop()
+        pool = session_pool.SessionPool()
+        session = pool._get_entry('http://partner.ru/')[0]
+        self.session_patcher.start()
+        response = mock.Mock()
+        response.info.return_value = httplib.HTTPMessage(StringIO('Set-Cookie: sid=tenant1; Path=/\r\n\r\n'))
+        request = urllib2.Request('http://partner.ru/callback')
+
+        session.cookies.extract_cookies(response, request)
+        session.cookies.add_cookie_header(request)
+
+        self.assertEqual(len(session.cookies), 0)
+        self.assertFalse(request.has_header('Cookie'))
+
+    def test_session_per_host(self):
+        pool = session_pool.SessionPool()
+
+        pool.post('http://partner.ru/')
+        pool.post('https://partner.ru/')
+        pool.post('http://other.ru/')
+
+        self.assertEqual(len(pool.sessions), 3)
+
+    @mock.patch('source.lib.session_pool.HTTPAdapter')
+    def test_connections_per_host_bounded(self, adapter_m):
+        pool = session_pool.SessionPool(max_connections=3)
+
+        pool.post('http://partner.ru/')
+
+        adapter_m.assert_called_with(pool_connections=1, pool_maxsize=3, pool_block=True)
+        self.assertEqual(pool.sessions[('http', 'partner.ru')][0].mount.call_count, 2)
+
+    def test_evict_idle(self):
+        pool = session_pool.SessionPool(idle_timeout=60)
+        with mock.patch('source.lib.session_pool.time', mock.Mock(return_value=100)):
+            pool.post('http://partner.ru/')
+        session = pool.sessions[('http', 'partner.ru')][0]
+
+        pool.evict_idle(161)
+
+        self.assertEqual(pool.sessions, {})
+        self.assertTrue(session.close.called)
+        self.assertEqual(pool.stats['evicted'], 1)
+
+    def test_evict_idle_keeps_active_session(self):
+        pool = session_pool.SessionPool(idle_timeout=60)
+        pool.sessions[('http', 'partner.ru')] = [mock.Mock(), 1, 100]
+
+        pool.evict_idle(161)
+
+        self.assertEqual(len(pool.sessions), 1)
+
+    def test_post_error_releases_session(self):
+        pool = session_pool.SessionPool()
+        pool.post('http://partner.ru/')
+        pool.sessions[('http', 'partner.ru')][0].post = mock.Mock(side_effect=session_pool.requests.RequestException)
+
+        self.assertRaises(session_pool.requests.RequestException, pool.post, 'http://partner.ru/')
+        self.assertEqual(pool.sessions[('http', 'partner.ru')][1], 0)
+
+    def test_host_stats(self):
+        pool = session_pool.SessionPool()
+        connection_pool = mock.Mock(num_connections=2, num_requests=10)
+        adapter = mock.Mock()
+        adapter.poolmanager.pools = {'key': connection_pool}
+        session = mock.Mock()
+        session.adapters = {'http://': adapter}
+        pool.sessions[('http', 'partner.ru')] = [session, 1, 100]
+
+        self.assertEqual(pool.host_stats(), {
+            ('http', 'partner.ru'): {'active': 1, 'connections': 2, 'requests': 10}
+        })
+
+    def test_get_session_pool_per_process(self):
+        with mock.patch('os.getpid', mock.Mock(return_value=1)):
+            pool = session_pool.get_session_pool()
+            self.assertIs(session_pool.get_session_pool(), pool)
+        with mock.patch('os.getpid', mock.Mock(return_value=2)):
+            self.assertIsNot(session_pool.get_session_pool(), pool)
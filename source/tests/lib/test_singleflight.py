@@ -0,0 +1,111 @@
+import unittest
+import mock
+from source.lib import singleflight
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        self.flights = singleflight.SingleFlight(':memory:', lease=30, linger=5)
+        self.other = singleflight.SingleFlight(':memory:', lease=30, linger=5)
+        self.other.db = self.flights.db
+        self.other.owner = self.flights.owner + 1
+
+    def test_first_join_owns(self):
+        self.assertEqual(self.flights.join('http://mail.ru/', 100), (True, None))
+        self.assertEqual(self.flights.stats['owned'], 1)
+
+    def test_join_running_waits(self):
+        self.flights.join('http://mail.ru/', 100)
+
+        self.assertEqual(self.other.join('http://mail.ru/', 101), (False, None))
+
+    def test_waiting_join_does_not_lock(self):
+        self.flights.join('http://mail.ru/', 100)
+        self.other.db = mock.Mock(wraps=self.flights.db)
+
+        self.assertEqual(self.other.join('http://mail.ru/', 101), (False, None))
+        self.assertNotIn(mock.call('BEGIN IMMEDIATE'), self.other.db.execute.call_args_list)
+
+    def test_join_published_shares(self):
+        self.flights.join('http://mail.ru/', 100)
+        self.flights.publish('http://mail.ru/', (['http_status'], ['http://mail.ru/', 'http://mail.ru/a'], []), 101)
+
+        self.assertEqual(
+            self.other.join('http://mail.ru/', 102),
+            (False, [['http_status'], ['http://mail.ru/', 'http://mail.ru/a'], []])
+        )
+        self.assertEqual(self.other.stats['shared'], 1)
+
+    def test_old_result_not_shared(self):
+        self.flights.join('http://mail.ru/', 100)
+        self.flights.publish('http://mail.ru/', ([], ['http://mail.ru/'], []), 101)
+
+        self.assertEqual(self.other.join('http://mail.ru/', 107), (True, None))
+
+    def test_stale_check_taken_over(self):
+        self.flights.join('http://mail.ru/', 100)
+
+        self.assertEqual(self.other.join('http://mail.ru/', 131), (True, None))
+        self.assertEqual(self.other.stats['taken_over'], 1)
+
+    def test_publish_of_taken_over_check_ignored(self):
+        self.flights.join('http://mail.ru/', 100)
+        self.other.join('http://mail.ru/', 131)
+        self.flights.publish('http://mail.ru/', ([], ['http://mail.ru/'], []), 132)
+
+        self.assertEqual(self.flights.join('http://mail.ru/', 133), (False, None))
+
+    def test_abandon_lets_next_check(self):
+        self.flights.join('http://mail.ru/', 100)
+        self.flights.abandon('http://mail.ru/')
+
+        self.assertEqual(self.other.join('http://mail.ru/', 101), (True, None))
+
+    def test_resolve_checks_and_publishes(self):
+        check = mock.Mock(return_value=([], ['http://mail.ru/'], []))
+
+        self.assertEqual(self.flights.resolve('http://mail.ru/', check), ([], ['http://mail.ru/'], []))
+        self.assertEqual(self.other.join('http://mail.ru/')[1], [[], ['http://mail.ru/'], []])
+
+    @mock.patch('source.lib.singleflight.gevent.sleep')
+    def test_resolve_waits_for_other(self, sleep_m):
+        self.other.join('http://mail.ru/')
+        sleep_m.side_effect = lambda _: self.other.publish('http://mail.ru/', ([], ['http://mail.ru/'], []))
+        check = mock.Mock()
+
+        self.assertEqual(self.flights.resolve('http://mail.ru/', check), [[], ['http://mail.ru/'], []])
+        self.assertFalse(check.called)
+        self.assertEqual(sleep_m.call_count, 1)
+
+    def test_resolve_abandons_on_error(self):
+        check = mock.Mock(side_effect=ValueError)
+
+        self.assertRaises(ValueError, self.flights.resolve, 'http://mail.ru/', check)
+        self.assertEqual(self.other.join('http://mail.ru/'), (True, None))
+
+    def test_evict(self):
+        self.flights.join('http://mail.ru/a', 100)
+        self.flights.join('http://mail.ru/b', 100)
+        self.flights.publish('http://mail.ru/b', ([], ['http://mail.ru/b'], []), 100)
+
+        self.flights.evict(131)
+
+        self.assertEqual(self.flights.db.execute('SELECT count(*) FROM flights').fetchone()[0], 0)
+
+    def test_db_error_checks_alone(self):
+        self.flights.db = mock.Mock()
+        self.flights.db.execute = mock.Mock(side_effect=singleflight.sqlite3.Error)
+
+        self.assertEqual(self.flights.join('http://mail.ru/'), (True, None))
+        self.assertEqual(self.flights.stats['errors'], 1)
+
+    @mock.patch('source.lib.singleflight.connect_shared_db')
+    def test_locked_file_on_init_is_not_fatal(self, connect_shared_db_m):
+        connect_shared_db_m.return_value.execute.side_effect = singleflight.sqlite3.OperationalError(
+            'database is locked'
+        )
+
+        flights = singleflight.SingleFlight('flights.db')
+
+        self.assertEqual(flights.join('http://mail.ru/'), (True, None))
+        self.assertEqual(flights.stats['errors'], 2)
@@ -119,6 +119,24 @@ class UtilsTestCase(unittest.TestCase):
         self.assertTrue(process_mock.called)
         self.assertEqual(process_mock.call_count, num)
 
+    @mock.patch('source.lib.utils.Process')
+    def test_spawn_workers_kwargs(self, process_mock):
+        processes = utils.spawn_workers(1, 'target', ('config',), 42, {'ready_queue': 'queue'})
+
+        process_mock.assert_called_once_with(
+            target='target', args=('config',), kwargs={'ready_queue': 'queue', 'parent_pid': 42}, name=None
+        )
+        self.assertEqual(processes, [process_mock.return_value])
+
+    def test_get_process_memory(self):
+        with mock.patch('source.lib.utils.open', mock.mock_open(read_data='100 10 4 1 0 5 0'), create=True):
+            with mock.patch('os.sysconf', mock.Mock(return_value=4096)):
+                self.assertEqual(utils.get_process_memory(1), (10 * 4096, 4 * 4096))
+
+    def test_get_process_memory_no_process(self):
+        with mock.patch('source.lib.utils.open', mock.Mock(side_effect=IOError), create=True):
+            self.assertIsNone(utils.get_process_memory(1))
+
     def test_prepare_daemon_pid(self):
         args = Args()
         args.daemon = True
@@ -165,3 +183,106 @@ class UtilsTestCase(unittest.TestCase):
 
 
 
+
+    def test_take_many(self):
+        tube = mock.Mock()
+        tube.queue.space = 0
+        tube.opt = {'tube': 'url.queue'}
+        tube.queue.tnt.call = mock.Mock(return_value=[
+            ('id1', 'url.queue', 'taken', 'data1'),
+            ('id2', 'url.queue', 'taken', 'data2'),
+        ])
+
+        tasks = utils.take_many(tube, 5, 0.1)
+
+        tube.queue.tnt.call.assert_called_once_with('queue.take_many', ('0', 'url.queue', '5', '0.1'))
+        self.assertEqual([task.task_id for task in tasks], ['id1', 'id2'])
+        self.assertEqual(tasks[0].raw_data, 'data1')
+        for task in tasks:
+            task.modified = True
+
+    def test_take_many_marks_session(self):
+        tube = mock.Mock()
+        tube.queue.space = 0
+        tube.opt = {'tube': 'url.queue'}
+        tube.queue.tnt.session = 3
+        tube.queue.tnt.call = mock.Mock(return_value=[('id1', 'url.queue', 'taken', 'data1')])
+
+        task, = utils.take_many(tube, 5, 0.1)
+
+        self.assertEqual(task.session, 3)
+        self.assertFalse(utils.is_stale_task(task))
+        tube.queue.tnt.session = 4
+        self.assertTrue(utils.is_stale_task(task))
+        task.modified = True
+
+    def test_is_stale_task_without_session(self):
+        task = mock.Mock()
+        task.queue.tnt.session = 4
+
+        self.assertFalse(utils.is_stale_task(task))
+
+    def test_task_priority(self):
+        task = mock.Mock()
+        for pri in (-127, 0, 10, 128):
+            task.meta.return_value = {'pri': str(utils.MAX_PRI - (pri + utils.DEFAULT_PRI))}
+
+            self.assertEqual(utils.task_priority(task), pri)
+
+    def test_take_many_no_room(self):
+        tube = mock.Mock()
+
+        self.assertEqual(utils.take_many(tube, 0, 0.1), [])
+        self.assertFalse(tube.queue.tnt.call.called)
+
+    def test_same_server(self):
+        tube, other_tube = mock.Mock(), mock.Mock()
+        tube.queue.host, tube.queue.port = 'localhost', 33013
+        other_tube.queue.host, other_tube.queue.port = 'localhost', 33013
+
+        self.assertTrue(utils.same_server(tube, other_tube))
+        other_tube.queue.port = 33014
+        self.assertFalse(utils.same_server(tube, other_tube))
+
+    def test_ack_and_put(self):
+        tube = mock.Mock()
+        tube.queue.space = 0
+        tube.opt = {'tube': 'url.queue', 'delay': 0, 'ttl': 0, 'ttr': 0, 'pri': 0}
+        tube.serialize = mock.Mock(side_effect=lambda data: 'in:' + data)
+        out_tube = mock.Mock()
+        out_tube.queue.space = 1
+        out_tube.opt = {'tube': 'out.queue', 'delay': 0, 'ttl': 10, 'ttr': 0, 'pri': 5}
+        out_tube.serialize = mock.Mock(side_effect=lambda data: 'out:' + data)
+        tube.queue.tnt.call = mock.Mock(return_value=[('id1',)])
+        task1, task2 = mock.Mock(task_id='id1'), mock.Mock(task_id='id2')
+
+        acked = utils.ack_and_put(tube, [
+            (task1, out_tube, 'result', {}),
+            (task2, tube, 'recheck', {'delay': 300, 'pri': None}),
+        ])
+
+        tube.queue.tnt.call.assert_called_once_with('queue.ack_and_put', (
+            '0',
+            'id1', '1', 'out.queue', '0', '10', '0', '5', 'out:result',
+            'id2', '0', 'url.queue', '300', '0', '0', '', 'in:recheck',
+        ))
+        self.assertEqual(acked, {'id1'})
+        self.assertTrue(task1.modified and task2.modified)
+
+    def test_settle_many(self):
+        tube = mock.Mock()
+        tube.queue.space = 0
+        tube.queue.tnt.call = mock.Mock(return_value=[('id1',)])
+        task1, task2 = mock.Mock(task_id='id1'), mock.Mock(task_id='id2')
+
+        settled = utils.settle_many(tube, [(task1, 'ack'), (task2, 'bury')])
+
+        tube.queue.tnt.call.assert_called_once_with('queue.settle', ('0', 'ack', 'id1', 'bury', 'id2'))
+        self.assertEqual(settled, {'id1'})
+        self.assertTrue(task1.modified and task2.modified)
+
+    def test_settle_many_empty(self):
+        tube = mock.Mock()
+
+        self.assertEqual(utils.settle_many(tube, []), set())
+        self.assertFalse(tube.queue.tnt.call.called)
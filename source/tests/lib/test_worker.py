@@ -1,6 +1,8 @@
 import unittest
 import mock
+from tarantool.error import DatabaseError
 import source.lib.worker as worker
+from source.lib.utils import Config
 
 
 class WorkerTestCase(unittest.TestCase):
@@ -8,13 +10,14 @@ class WorkerTestCase(unittest.TestCase):
         pass
 
     def tearDown(self):
-        pass
+        worker._stop_requested = False
 
     @mock.patch('source.lib.worker.get_tube')
+    @mock.patch('source.lib.worker.init_worker', mock.Mock(return_value=None))
     @mock.patch('os.path.exists', mock.Mock(side_effect=[True, False]))
     @mock.patch('source.lib.worker.handle_next_task')
     def test_worker_stops_on_parent_dead(self, handle_next_task_mock, get_tube_mock):
-        config = mock.Mock()
+        config = mock.Mock(STATS_INTERVAL=60)
         parent_pid = 10
 
         with mock.patch.dict(get_tube_mock.opt, {}):
@@ -56,7 +59,7 @@ class WorkerTestCase(unittest.TestCase):
         output_tube = mock.Mock()
 
         task = mock.Mock()
-        task.meta = mock.Mock(return_value={'pri': 'pri'})
+        task.meta = mock.Mock(return_value={'pri': '128'})
 
         input_tube.take = mock.Mock(return_value=task)
 
@@ -70,7 +73,7 @@ class WorkerTestCase(unittest.TestCase):
         output_tube = mock.Mock()
 
         task = mock.Mock()
-        task.meta = mock.Mock(return_value={'pri': 'pri'})
+        task.meta = mock.Mock(return_value={'pri': '128'})
 
         input_tube.take = mock.Mock(return_value=task)
 
@@ -89,7 +92,7 @@ class WorkerTestCase(unittest.TestCase):
 
         task = mock.Mock()
         task.ack = mock.Mock(side_effect=worker.DatabaseError)
-        task.meta = mock.Mock(return_value={'pri': 'pri'})
+        task.meta = mock.Mock(return_value={'pri': '128'})
 
         input_tube.take = mock.Mock(return_value=task)
 
@@ -125,4 +128,617 @@ class WorkerTestCase(unittest.TestCase):
 
         is_input, data = worker.get_redirect_history_from_task(task, 10)
 
-        self.assertFalse('suspicious' in data, 'suspicious is too suspicious')
\ No newline at end of file
+        self.assertFalse('suspicious' in data, 'suspicious is too suspicious')
+
+    @mock.patch('source.lib.worker.get_tube', mock.MagicMock())
+    @mock.patch('source.lib.worker.init_worker')
+    @mock.patch('os.path.exists', mock.Mock(side_effect=[True, False]))
+    @mock.patch('source.lib.worker.handle_next_task')
+    @mock.patch('source.lib.worker.handle_tasks_concurrently')
+    def test_worker_uses_engine(self, handle_tasks_concurrently_m, handle_next_task_m, init_worker_m):
+        worker.worker(mock.Mock(STATS_INTERVAL=60), 10)
+
+        self.assertEqual(handle_tasks_concurrently_m.call_count, 1)
+        self.assertEqual(handle_tasks_concurrently_m.call_args[0][1], init_worker_m.return_value)
+        self.assertFalse(handle_next_task_m.called)
+
+    @mock.patch('source.lib.worker.set_meta_parser')
+    @mock.patch('source.lib.worker.init_curl_pool')
+    @mock.patch('source.lib.worker.init_hop_cache')
+    @mock.patch('source.lib.worker.init_head_prober', mock.Mock())
+    @mock.patch('source.lib.worker.init_dns_cache', mock.Mock())
+    @mock.patch('source.lib.worker.init_host_breaker')
+    @mock.patch('source.lib.worker.init_single_flight')
+    @mock.patch('source.lib.worker.init_host_scheduler')
+    @mock.patch('source.lib.worker.RedirectEngine')
+    def test_init_worker(self, engine_m, scheduler_m, init_single_flight_m, init_host_breaker_m, init_hop_cache_m,
+                         init_curl_pool_m, set_meta_parser_m):
+        config = mock.Mock()
+        config.WORKER_MAX_IN_FLIGHT = 50
+
+        engine = worker.init_worker(config, 'network_up')
+
+        self.assertEqual(engine, engine_m.return_value)
+        self.assertEqual(engine_m.call_args[1]['max_in_flight'], 50)
+        self.assertEqual(engine_m.call_args[1]['curl_pool'], init_curl_pool_m.return_value)
+        self.assertEqual(engine_m.call_args[1]['hop_cache'], init_hop_cache_m.return_value)
+        self.assertEqual(engine_m.call_args[1]['scheduler'], scheduler_m.return_value)
+        self.assertEqual(engine_m.call_args[1]['breaker'], init_host_breaker_m.return_value)
+        self.assertEqual(engine_m.call_args[1]['flights'], init_single_flight_m.return_value)
+        scheduler_m.assert_called_once_with(
+            config.WORKER_HOST_MAX_CONCURRENCY, config.WORKER_HOST_MAX_RATE, worker.sleep
+        )
+        set_meta_parser_m.assert_called_once_with(config.META_PARSER)
+        init_host_breaker_m.assert_called_once_with(
+            config.BREAKER_PATH, config.BREAKER_FAILURE_THRESHOLD, config.BREAKER_BASE_DELAY, config.BREAKER_MAX_DELAY,
+            config.HTTP_TIMEOUT, 'network_up'
+        )
+
+    @mock.patch('source.lib.worker.set_meta_parser', mock.Mock())
+    @mock.patch('source.lib.worker.init_curl_pool', mock.Mock())
+    @mock.patch('source.lib.worker.init_hop_cache', mock.Mock())
+    @mock.patch('source.lib.worker.init_head_prober', mock.Mock())
+    @mock.patch('source.lib.worker.init_dns_cache', mock.Mock())
+    @mock.patch('source.lib.worker.init_host_breaker', mock.Mock())
+    @mock.patch('source.lib.worker.init_single_flight', mock.Mock())
+    @mock.patch('source.lib.worker.init_host_scheduler', mock.Mock())
+    def test_init_worker_without_engine(self):
+        config = mock.Mock()
+        config.WORKER_MAX_IN_FLIGHT = 1
+
+        self.assertIsNone(worker.init_worker(config))
+
+    @mock.patch('source.lib.worker.take_many', mock.Mock(return_value=[mock.MagicMock(), mock.MagicMock()]))
+    def test_handle_tasks_concurrently_fills_free_slots(self):
+        config = mock.Mock()
+        engine = mock.Mock()
+        engine.free_count = mock.Mock(return_value=3)
+        input_tube = mock.Mock()
+
+        worker.handle_tasks_concurrently(config, engine, input_tube, mock.Mock(), [])
+
+        self.assertEqual(engine.submit.call_count, 2)
+        worker.take_many.assert_called_once_with(input_tube, 3, config.QUEUE_TAKE_TIMEOUT)
+        engine.perform.assert_called_once_with(config.QUEUE_TAKE_TIMEOUT)
+
+    @mock.patch('source.lib.worker.settle_tasks', mock.Mock())
+    @mock.patch('source.lib.worker.take_many', mock.Mock(return_value=[]))
+    def test_handle_tasks_concurrently_does_not_wait_for_tasks_when_busy(self):
+        config = mock.Mock()
+        engine = mock.Mock()
+        engine.free_count = mock.Mock(return_value=3)
+        engine.is_idle = mock.Mock(return_value=False)
+
+        worker.handle_tasks_concurrently(config, engine, 'input_tube', mock.Mock(), [])
+
+        worker.take_many.assert_called_once_with('input_tube', 3, worker.BUSY_TAKE_TIMEOUT)
+        self.assertGreater(worker.BUSY_TAKE_TIMEOUT, 0)
+        engine.perform.assert_called_once_with(config.QUEUE_TAKE_TIMEOUT)
+
+    def test_on_task_history_collects_result(self):
+        task = mock.Mock()
+        task.data = {'url': 'url', 'url_id': 'url_id'}
+        finished = []
+
+        worker.on_task_history(task, finished, ([], ['url'], []))
+
+        self.assertEqual(finished, [(task, (False, {
+            'url_id': 'url_id', 'result': [[], ['url'], []], 'check_type': 'normal'
+        }))])
+
+    @mock.patch('source.lib.worker.settle_tasks')
+    @mock.patch('source.lib.worker.take_many', mock.Mock(return_value=[]))
+    def test_handle_tasks_concurrently_settles_finished(self, settle_tasks_m):
+        config = mock.Mock()
+        engine = mock.Mock()
+        finished = [(mock.Mock(), (False, {}))]
+
+        worker.handle_tasks_concurrently(config, engine, 'input_tube', 'output_tube', finished)
+
+        settle_tasks_m.assert_called_once_with(config, finished, 'input_tube', 'output_tube', release_failed=False,
+                                               recheck_tube=None)
+
+    @mock.patch('source.lib.worker.settle_tasks')
+    @mock.patch('source.lib.worker.take_many')
+    @mock.patch('source.lib.worker.sleep')
+    def test_handle_tasks_concurrently_paused(self, sleep_m, take_many_m, settle_tasks_m):
+        config = mock.Mock()
+        engine = mock.Mock()
+        engine.is_idle = mock.Mock(return_value=True)
+
+        worker.handle_tasks_concurrently(config, engine, 'input_tube', 'output_tube', [], intake=False,
+                                         release_failed=True)
+
+        self.assertFalse(take_many_m.called)
+        self.assertFalse(engine.submit.called)
+        sleep_m.assert_called_once_with(config.QUEUE_TAKE_TIMEOUT)
+        self.assertTrue(settle_tasks_m.call_args[1]['release_failed'])
+
+    @mock.patch('source.lib.worker.set_meta_parser', mock.Mock())
+    @mock.patch('source.lib.worker.init_curl_pool', mock.Mock())
+    @mock.patch('source.lib.worker.init_hop_cache', mock.Mock())
+    @mock.patch('source.lib.worker.init_head_prober', mock.Mock())
+    @mock.patch('source.lib.worker.init_dns_cache', mock.Mock())
+    @mock.patch('source.lib.worker.init_host_breaker', mock.Mock())
+    @mock.patch('source.lib.worker.init_single_flight', mock.Mock())
+    @mock.patch('source.lib.worker.init_host_scheduler')
+    @mock.patch('source.lib.worker.set_curl_performer')
+    @mock.patch('source.lib.worker.GeventCurlMulti')
+    @mock.patch('source.lib.worker.Pool')
+    def test_init_worker_gevent(self, pool_m, gevent_curl_m, set_curl_performer_m, init_host_scheduler_m):
+        config = mock.Mock()
+        config.WORKER_MODE = worker.WORKER_MODE_GEVENT
+        config.WORKER_MAX_IN_FLIGHT = 300
+
+        self.assertEqual(worker.init_worker(config), pool_m.return_value)
+        pool_m.assert_called_once_with(300)
+        set_curl_performer_m.assert_called_once_with(gevent_curl_m.return_value.perform)
+        self.assertEqual(init_host_scheduler_m.call_args[0][2], worker.gevent.sleep)
+
+    def test_get_host_limits(self):
+        config = mock.Mock(HOST_MAX_CONCURRENCY=40, HOST_MAX_RATE=100)
+
+        self.assertEqual(worker.get_host_limits(config, 42), (1, 100.0 / 42))
+        self.assertEqual(worker.get_host_limits(config, 10), (4, 10.0))
+        config.HOST_MAX_CONCURRENCY = config.HOST_MAX_RATE = None
+        self.assertEqual(worker.get_host_limits(config, 10), (None, None))
+
+    @mock.patch('source.lib.worker.get_redirect_history')
+    @mock.patch('source.lib.worker.get_host_scheduler')
+    def test_check_task_uses_host_scheduler(self, get_host_scheduler_m, get_redirect_history_m):
+        get_redirect_history_m.return_value = ([], ['http://mail.ru/'], [])
+        task = mock.Mock(data={'url': 'http://mail.ru/', 'url_id': 1})
+
+        worker.check_task(mock.Mock(), task)
+
+        self.assertEqual(get_redirect_history_m.call_args[0][-1], get_host_scheduler_m.return_value)
+
+    @mock.patch('source.lib.worker.get_tube', mock.MagicMock())
+    @mock.patch('source.lib.worker.init_worker', mock.Mock(return_value=worker.Pool(1)))
+    @mock.patch('os.path.exists', mock.Mock(side_effect=[True, False]))
+    @mock.patch('source.lib.worker.patch_all')
+    @mock.patch('source.lib.worker.handle_tasks_in_greenlets')
+    def test_worker_gevent(self, handle_tasks_in_greenlets_m, patch_all_m):
+        config = mock.Mock(STATS_INTERVAL=60)
+        config.WORKER_MODE = worker.WORKER_MODE_GEVENT
+
+        worker.worker(config, 10)
+
+        patch_all_m.assert_called_once_with()
+        self.assertEqual(handle_tasks_in_greenlets_m.call_count, 1)
+
+    @mock.patch('source.lib.worker.settle_tasks')
+    @mock.patch('source.lib.worker.check_task', mock.Mock(return_value=(False, {})))
+    def test_handle_tasks_in_greenlets(self, settle_tasks_m):
+        config = mock.Mock()
+        config.QUEUE_TAKE_TIMEOUT = 0
+        pool = worker.Pool(2)
+        tasks = [mock.MagicMock(), mock.MagicMock(), mock.MagicMock()]
+        finished = []
+
+        with mock.patch('source.lib.worker.take_many', mock.Mock(return_value=tasks[:2])) as take_many_m:
+            worker.handle_tasks_in_greenlets(config, pool, 'input_tube', 'output_tube', finished)
+
+        take_many_m.assert_called_once_with('input_tube', 2, 0)
+        pool.join()
+        self.assertEqual(finished, [(tasks[0], (False, {})), (tasks[1], (False, {}))])
+        settle_tasks_m.assert_called_once_with(config, finished, 'input_tube', 'output_tube', release_failed=False,
+                                               recheck_tube=None)
+
+    @mock.patch('source.lib.worker.check_task', mock.Mock(side_effect=ValueError))
+    def test_handle_task_in_greenlet_error(self):
+        finished = []
+
+        worker.handle_task_in_greenlet(mock.Mock(), mock.MagicMock(), finished)
+
+        self.assertEqual(finished, [])
+
+    @mock.patch('source.lib.worker.get_tube', mock.MagicMock())
+    @mock.patch('source.lib.worker.init_worker', mock.Mock(return_value=None))
+    @mock.patch('os.path.exists', mock.Mock(return_value=False))
+    @mock.patch('os.getpid', mock.Mock(return_value=7))
+    @mock.patch('source.lib.worker.time', mock.Mock(return_value=100))
+    def test_worker_reports_ready(self):
+        ready_queue = mock.Mock()
+
+        worker.worker(mock.Mock(STATS_INTERVAL=60), 10, ready_queue)
+
+        ready_queue.put.assert_called_once_with((7, 100))
+
+    @mock.patch('source.lib.worker.set_meta_parser')
+    @mock.patch('source.lib.worker.gc')
+    def test_prefork_worker(self, gc_m, set_meta_parser_m):
+        config = mock.Mock()
+        config.META_PARSER = 'bs4'
+
+        worker.prefork_worker(config)
+
+        set_meta_parser_m.assert_called_once_with('bs4')
+        gc_m.collect.assert_called_once_with()
+
+    @mock.patch('source.lib.worker.get_tube', mock.MagicMock())
+    @mock.patch('source.lib.worker.init_worker', mock.Mock(return_value=None))
+    @mock.patch('os.path.exists', mock.Mock(side_effect=[True, False]))
+    @mock.patch('source.lib.worker.handle_next_task')
+    @mock.patch('source.lib.worker.sleep')
+    def test_worker_paused(self, sleep_m, handle_next_task_m):
+        config = mock.Mock(STATS_INTERVAL=60)
+        network_up = mock.Mock()
+        network_up.is_set = mock.Mock(return_value=False)
+
+        worker.worker(config, 10, network_up=network_up)
+
+        self.assertFalse(handle_next_task_m.called)
+        sleep_m.assert_called_once_with(config.QUEUE_TAKE_TIMEOUT)
+
+    @mock.patch('source.lib.worker.get_tube', mock.MagicMock())
+    @mock.patch('source.lib.worker.init_worker')
+    @mock.patch('os.path.exists', mock.Mock(return_value=True))
+    @mock.patch('source.lib.worker.handle_tasks_concurrently')
+    @mock.patch('source.lib.worker.settle_tasks')
+    def test_worker_stop_drains_engine(self, settle_tasks_m, handle_tasks_concurrently_m, init_worker_m):
+        engine = init_worker_m.return_value
+        engine.is_idle = mock.Mock(side_effect=[False, True])
+        worker.request_stop(worker.WORKER_STOP_SIGNAL, None)
+
+        worker.worker(mock.Mock(STATS_INTERVAL=60), 10)
+
+        self.assertEqual(handle_tasks_concurrently_m.call_count, 1)
+        self.assertFalse(handle_tasks_concurrently_m.call_args[0][5], 'intake is not stopped')
+        self.assertEqual(settle_tasks_m.call_count, 1)
+
+    @mock.patch('source.lib.worker.get_tube', mock.MagicMock())
+    @mock.patch('source.lib.worker.init_worker', mock.Mock(return_value=None))
+    @mock.patch('source.lib.worker.settle_tasks', mock.Mock())
+    @mock.patch('os.path.exists', mock.Mock(return_value=True))
+    @mock.patch('source.lib.worker.handle_next_task')
+    def test_worker_stop_signal_does_not_interrupt_take(self, handle_next_task_m):
+        import os
+        import signal
+        import socket
+        import threading
+
+        reader, writer = socket.socketpair()
+        received = []
+
+        def blocking_take(*args):
+            threading.Timer(0.05, os.kill, (os.getpid(), worker.WORKER_STOP_SIGNAL)).start()
+            threading.Timer(0.2, writer.send, ('task',)).start()
+            received.append(reader.recv(4))
+        handle_next_task_m.side_effect = blocking_take
+
+        previous_handler = signal.getsignal(worker.WORKER_STOP_SIGNAL)
+        try:
+            worker.worker(mock.Mock(STATS_INTERVAL=60), 10)
+        finally:
+            signal.signal(worker.WORKER_STOP_SIGNAL, previous_handler)
+            reader.close()
+            writer.close()
+
+        self.assertEqual(received, ['task'])
+        self.assertEqual(handle_next_task_m.call_count, 1)
+        self.assertTrue(worker._stop_requested)
+
+    def test_is_worker_idle(self):
+        pool = worker.Pool(2)
+        self.assertTrue(worker.is_worker_idle(pool))
+        pool.spawn(worker.gevent.sleep, 0)
+        self.assertFalse(worker.is_worker_idle(pool))
+        pool.join()
+
+        self.assertTrue(worker.is_worker_idle(None))
+
+    @mock.patch('source.lib.worker.get_tube', mock.MagicMock())
+    @mock.patch('source.lib.worker.init_worker', mock.Mock(return_value=None))
+    @mock.patch('os.path.exists', mock.Mock(side_effect=[True, True, False]))
+    @mock.patch('source.lib.worker.handle_next_task', mock.Mock(side_effect=[worker.DatabaseError, None]))
+    @mock.patch('source.lib.worker.sleep')
+    def test_worker_survives_queue_error(self, sleep_m):
+        config = mock.Mock(STATS_INTERVAL=60)
+
+        worker.worker(config, 10)
+
+        self.assertEqual(worker.handle_next_task.call_count, 2)
+        sleep_m.assert_called_once_with(config.QUEUE_TAKE_TIMEOUT)
+
+    @mock.patch('source.lib.worker.get_tube', mock.MagicMock())
+    @mock.patch('source.lib.worker.init_worker', mock.Mock(return_value=None))
+    @mock.patch('os.path.exists', mock.Mock(side_effect=[True, True, True, False]))
+    @mock.patch('source.lib.worker.handle_next_task', mock.Mock())
+    @mock.patch('source.lib.worker.time', mock.Mock(side_effect=[0, 30, 60, 60, 90]))
+    @mock.patch('source.lib.worker.report_worker_stats')
+    def test_worker_reports_stats_periodically(self, report_worker_stats_m):
+        worker.worker(mock.Mock(STATS_INTERVAL=60), 10)
+
+        self.assertEqual(report_worker_stats_m.call_count, 2, 'reported once in loop and once on exit')
+
+    @mock.patch('source.lib.worker.get_dns_cache')
+    @mock.patch('source.lib.worker.get_hop_cache')
+    @mock.patch('source.lib.worker.get_curl_pool')
+    @mock.patch('source.lib.worker.logger')
+    def test_report_worker_stats(self, logger_m, get_curl_pool_m, get_hop_cache_m, get_dns_cache_m):
+        get_curl_pool_m.return_value.stats = {'created': 1, 'reused': 2, 'evicted': 3}
+        get_hop_cache_m.return_value.stats = {'hits': 4, 'misses': 5, 'errors': 6}
+        get_dns_cache_m.return_value.stats = {
+            'hits': 7, 'misses': 8, 'negative_hits': 9, 'prefetches': 10, 'resolved': 11, 'failed': 12
+        }
+        get_dns_cache_m.return_value.entries = {'mail.ru': None}
+
+        worker.report_worker_stats()
+
+        logger_m.info.assert_any_call('Curl pool: created=1 reused=2 evicted=3.')
+        logger_m.info.assert_any_call('Hop cache: hits=4 misses=5 errors=6.')
+        logger_m.info.assert_any_call(
+            'DNS cache: hits=7 misses=8 negative_hits=9 prefetches=10 resolved=11 failed=12 entries=1.'
+        )
+
+    @mock.patch('source.lib.worker.get_dns_cache', mock.Mock(return_value=None))
+    @mock.patch('source.lib.worker.get_hop_cache', mock.Mock(return_value=None))
+    @mock.patch('source.lib.worker.get_curl_pool')
+    @mock.patch('source.lib.worker.logger')
+    def test_report_worker_stats_without_caches(self, logger_m, get_curl_pool_m):
+        get_curl_pool_m.return_value.stats = {'created': 1, 'reused': 2, 'evicted': 3}
+
+        worker.report_worker_stats()
+
+        self.assertEqual(logger_m.info.call_count, 1)
+
+    def test_is_failed_result(self):
+        self.assertTrue(worker.is_failed_result((True, {})))
+        self.assertTrue(worker.is_failed_result((False, {'result': [['http_status', 'TIMEOUT'], [], []]})))
+        self.assertTrue(worker.is_failed_result((False, {'result': [['ERROR'], [], []]})))
+        self.assertFalse(worker.is_failed_result((False, {'result': [['http_status'], [], []]})))
+        self.assertFalse(worker.is_failed_result(None))
+
+    @mock.patch('source.lib.worker.ack_and_put')
+    def test_settle_tasks_releases_failed(self, ack_and_put_m):
+        input_tube, output_tube = self.get_same_server_tubes()
+        failed, done = mock.Mock(task_id='1'), mock.Mock(task_id='2')
+        done_result = (False, {'url_id': 2, 'result': [['http_status'], [], []]})
+        finished = [(failed, (True, {'url': 'url', 'recheck': True})), (done, done_result)]
+
+        worker.settle_tasks(mock.Mock(), finished, input_tube, output_tube, release_failed=True)
+
+        failed.release.assert_called_once_with()
+        self.assertFalse(done.release.called)
+        self.assertEqual(ack_and_put_m.call_args[0][1], [(done, output_tube, done_result[1], {})])
+
+    @mock.patch('source.lib.worker.ack_and_put')
+    def test_settle_tasks_release_fail(self, ack_and_put_m):
+        task = mock.Mock(task_id='1')
+        task.release = mock.Mock(side_effect=DatabaseError)
+
+        try:
+            worker.settle_tasks(mock.Mock(), [(task, (True, {}))], *self.get_same_server_tubes(), release_failed=True)
+        except DatabaseError:
+            self.fail('DatabaseError not caught in settle_tasks()')
+        self.assertFalse(ack_and_put_m.called)
+
+    def get_same_server_tubes(self):
+        input_tube = mock.Mock()
+        input_tube.queue.host, input_tube.queue.port = 'localhost', 33013
+        output_tube = mock.Mock()
+        output_tube.queue.host, output_tube.queue.port = 'localhost', 33013
+        return input_tube, output_tube
+
+    @mock.patch('source.lib.worker.ack_and_put')
+    def test_settle_tasks_in_one_call(self, ack_and_put_m):
+        config = mock.Mock()
+        input_tube, output_tube = self.get_same_server_tubes()
+        task1, task2 = mock.Mock(task_id='1'), mock.Mock(task_id='2')
+        finished = [(task1, (False, {'url_id': 1})), (task2, (True, {'url': 'url', 'recheck': True}))]
+        ack_and_put_m.return_value = {'1', '2'}
+
+        worker.settle_tasks(config, finished, input_tube, output_tube)
+
+        ack_and_put_m.assert_called_once_with(input_tube, [
+            (task1, output_tube, {'url_id': 1}, {}),
+            (task2, input_tube, {'url': 'url', 'recheck': True}, {'delay': config.RECHECK_DELAY, 'pri': None}),
+        ])
+        self.assertEqual(finished, [])
+        self.assertFalse(task1.ack.called)
+        self.assertFalse(output_tube.put.called)
+
+    @mock.patch('source.lib.worker.ack_and_put')
+    def test_settle_tasks_drops_tasks_taken_before_reconnect(self, ack_and_put_m):
+        input_tube, output_tube = self.get_same_server_tubes()
+        stale, fresh = mock.Mock(task_id='1', session=1), mock.Mock(task_id='2', session=2)
+        for task in (stale, fresh):
+            task.queue.tnt.session = 2
+        finished = [(stale, (False, {'url_id': 1})), (fresh, (False, {'url_id': 2}))]
+
+        worker.settle_tasks(mock.Mock(), finished, input_tube, output_tube)
+
+        ack_and_put_m.assert_called_once_with(input_tube, [(fresh, output_tube, {'url_id': 2}, {})])
+        self.assertTrue(stale.modified)
+        self.assertFalse(stale.ack.called or stale.release.called)
+
+    @mock.patch('source.lib.worker.ack_and_put')
+    def test_settle_tasks_recheck_tube(self, ack_and_put_m):
+        config = mock.Mock(RECHECK_DELAY=300)
+        input_tube, output_tube = self.get_same_server_tubes()
+        recheck_tube = mock.Mock()
+        task = mock.Mock(task_id='1')
+
+        worker.settle_tasks(config, [(task, (True, {'recheck': True}))], input_tube, output_tube,
+                            recheck_tube=recheck_tube)
+
+        ack_and_put_m.assert_called_once_with(input_tube, [
+            (task, recheck_tube, {'recheck': True}, {'delay': 300, 'pri': None})
+        ])
+
+    def test_settle_task_recheck_tube(self):
+        config = mock.Mock(RECHECK_DELAY=300)
+        input_tube, recheck_tube = mock.Mock(), mock.Mock()
+        task = mock.Mock()
+        task.meta = mock.Mock(return_value={'pri': '125'})
+
+        worker.settle_task(config, task, (True, {}), input_tube, mock.Mock(), recheck_tube)
+
+        recheck_tube.put.assert_called_once_with({}, delay=300, pri=3)
+        self.assertFalse(input_tube.put.called)
+        self.assertTrue(task.ack.called)
+
+    def test_get_recheck_config(self):
+        config = Config()
+        config.INPUT_QUEUE_TUBE = 'url.queue'
+        config.RECHECK_QUEUE_TUBE = 'url_recheck.queue'
+        config.HTTP_TIMEOUT = 3
+        config.RECHECK_HTTP_TIMEOUT = 10
+        config.RECHECK_TASK_TIMEOUT = 60
+        config.RECHECK_WORKER_POOL_SIZE = 2
+        config.MAX_REDIRECTS = 30
+
+        recheck_config = worker.get_recheck_config(config)
+
+        self.assertEqual(recheck_config.INPUT_QUEUE_TUBE, 'url_recheck.queue')
+        self.assertEqual(recheck_config.HTTP_TIMEOUT, 10)
+        self.assertEqual(recheck_config.TASK_TIMEOUT, 60)
+        self.assertEqual(recheck_config.WORKER_POOL_SIZE, 2)
+        self.assertEqual(recheck_config.MAX_REDIRECTS, 30)
+        self.assertEqual((config.INPUT_QUEUE_TUBE, config.HTTP_TIMEOUT), ('url.queue', 3))
+
+    @mock.patch('source.lib.worker.get_tube')
+    @mock.patch('source.lib.worker.init_worker', mock.Mock(return_value=None))
+    @mock.patch('os.path.exists', mock.Mock(side_effect=[True, False]))
+    @mock.patch('source.lib.worker.handle_next_task')
+    def test_worker_puts_rechecks_to_recheck_tube(self, handle_next_task_m, get_tube_m):
+        config = mock.Mock(STATS_INTERVAL=60)
+        config.RECHECK_QUEUE_TUBE = 'url_recheck.queue'
+
+        worker.worker(config, 10)
+
+        self.assertEqual(get_tube_m.call_args_list[-1][1]['name'], 'url_recheck.queue')
+        self.assertEqual(handle_next_task_m.call_args[0][3], get_tube_m.return_value)
+
+    @mock.patch('source.lib.worker.ack_and_put')
+    def test_settle_tasks_recheck_delay(self, ack_and_put_m):
+        config = mock.Mock(RECHECK_DELAY=300)
+        input_tube, output_tube = self.get_same_server_tubes()
+        data = {'url': 'url', 'recheck': True, 'recheck_delay': 900}
+        task = mock.Mock(task_id='1')
+
+        worker.settle_tasks(config, [(task, (True, data))], input_tube, output_tube)
+
+        self.assertEqual(ack_and_put_m.call_args[0][1][0][3], {'delay': 900, 'pri': None})
+
+    @mock.patch('source.lib.worker.ack_and_put')
+    def test_settle_paths_priority(self, ack_and_put_m):
+        config = mock.Mock(RECHECK_DELAY=300)
+        same_input, same_output = self.get_same_server_tubes()
+        other_input, other_output = mock.Mock(), mock.Mock()
+        other_input.queue.host, other_input.queue.port = 'other', 33013
+        task = mock.Mock(task_id='1')
+        task.meta.return_value = {'pri': '118'}
+
+        worker.settle_tasks(config, [(task, (True, {}))], same_input, same_output)
+        worker.settle_tasks(config, [(task, (True, {}))], other_input, other_output)
+
+        self.assertIsNone(ack_and_put_m.call_args[0][1][0][3]['pri'])
+        self.assertEqual(task.meta.call_count, 1)
+        self.assertEqual(other_input.put.call_args[1]['pri'], 10)
+
+    def test_get_recheck_delay_not_less_than_config(self):
+        config = mock.Mock(RECHECK_DELAY=300)
+
+        self.assertEqual(worker.get_recheck_delay(config, {'recheck_delay': 30}), 300)
+        self.assertEqual(worker.get_recheck_delay(config, {}), 300)
+
+    def test_make_task_result_delays_recheck_of_failing_host(self):
+        task = mock.Mock()
+        task.data = {'url': 'http://a.ru/', 'url_id': 'url_id'}
+        breaker = mock.Mock()
+        breaker.retry_delay = mock.Mock(return_value=120.5)
+
+        is_input, data = worker.make_task_result(task, (['ERROR'], ['http://a.ru/', 'http://b.ru/'], []), breaker)
+
+        self.assertTrue(is_input)
+        self.assertEqual(data['recheck_delay'], 121)
+        breaker.retry_delay.assert_called_once_with('b.ru')
+
+    def test_make_task_result_host_not_failing(self):
+        task = mock.Mock()
+        task.data = {'url': 'http://a.ru/', 'url_id': 'url_id'}
+        breaker = mock.Mock()
+        breaker.retry_delay = mock.Mock(return_value=0)
+
+        is_input, data = worker.make_task_result(task, (['ERROR'], ['http://a.ru/'], []), breaker)
+
+        self.assertNotIn('recheck_delay', data)
+
+    @mock.patch('source.lib.worker.ack_and_put', mock.Mock(side_effect=DatabaseError))
+    def test_settle_tasks_ack_fail(self):
+        input_tube, output_tube = self.get_same_server_tubes()
+        finished = [(mock.Mock(), (False, {}))]
+
+        worker.settle_tasks(mock.Mock(), finished, input_tube, output_tube)
+
+        self.assertEqual(finished, [])
+
+    @mock.patch('source.lib.worker.ack_and_put')
+    def test_settle_tasks_other_server(self, ack_and_put_m):
+        task = mock.Mock()
+        output_tube = mock.Mock()
+
+        worker.settle_tasks(mock.Mock(), [(task, (False, {'url_id': 1}))], mock.Mock(), output_tube)
+
+        self.assertFalse(ack_and_put_m.called)
+        output_tube.put.assert_called_once_with({'url_id': 1})
+        self.assertTrue(task.ack.called)
+
+    def test_get_redirect_history_from_task_shares_check(self):
+        task = mock.Mock()
+        task.data = {'url': 'http://mail.ru', 'url_id': 'url_id', 'suspicious': True}
+        flights = mock.Mock()
+        flights.resolve = mock.Mock(return_value=([], ['http://mail.ru/'], []))
+
+        with mock.patch('source.lib.worker.get_redirect_history') as get_redirect_history_m:
+            is_input, data = worker.get_redirect_history_from_task(task, 10, flights=flights)
+
+        self.assertFalse(get_redirect_history_m.called)
+        self.assertEqual(flights.resolve.call_args[0][0], 'http://mail.ru')
+        self.assertEqual(data, {
+            'url_id': 'url_id', 'result': [[], ['http://mail.ru/'], []], 'check_type': 'normal', 'suspicious': True
+        })
+
+    def test_get_redirect_history_from_task_recheck_not_shared(self):
+        task = mock.Mock()
+        task.data = {'url': 'url', 'url_id': 'url_id', 'recheck': True}
+        flights = mock.Mock()
+
+        with mock.patch('source.lib.worker.get_redirect_history', mock.Mock(return_value=([], ['url'], []))):
+            worker.get_redirect_history_from_task(task, 10, flights=flights)
+
+        self.assertFalse(flights.resolve.called)
+
+    def test_get_redirect_history_from_task_uses_hop_cache(self):
+        task = mock.Mock()
+        task.data = {'url': 'url', 'url_id': 'url_id'}
+        hop_cache = mock.Mock()
+
+        with mock.patch('source.lib.worker.get_redirect_history',
+                        mock.Mock(return_value=([], ['url'], []))) as get_redirect_history_m:
+            worker.get_redirect_history_from_task(task, 10, hop_cache=hop_cache)
+
+        self.assertEqual(get_redirect_history_m.call_args[0][5], hop_cache)
+
+    def test_get_redirect_history_from_task_recheck_bypasses_hop_cache(self):
+        task = mock.Mock()
+        task.data = {'url': 'url', 'url_id': 'url_id', 'recheck': True}
+
+        with mock.patch('source.lib.worker.get_redirect_history',
+                        mock.Mock(return_value=([], ['url'], []))) as get_redirect_history_m:
+            worker.get_redirect_history_from_task(task, 10, hop_cache=mock.Mock())
+
+        self.assertIsNone(get_redirect_history_m.call_args[0][5])
+
+    def test_handle_tasks_concurrently_recheck_bypasses_hop_cache(self):
+        engine = mock.Mock()
+        engine.free_count = mock.Mock(return_value=1)
+        task = mock.Mock()
+        task.data = {'url': 'url', 'url_id': 'url_id', 'recheck': True}
+
+        with mock.patch('source.lib.worker.take_many', mock.Mock(return_value=[task])):
+            worker.handle_tasks_concurrently(mock.Mock(), engine, mock.Mock(), mock.Mock(), [])
+
+        self.assertFalse(engine.submit.call_args[1]['use_cache'])
@@ -1,4 +1,5 @@
 import gevent
+import json
 import requests
 import unittest
 import mock
@@ -37,8 +38,8 @@ class NotificationPusherTestCase(unittest.TestCase):
         notification_pusher.logger = self.logger_temp
 
     @mock.patch('source.notification_pusher.current_thread', mock.Mock())
-    @mock.patch('source.notification_pusher.requests.post', mock.Mock(return_value=mock.Mock()))
-    def test_notification_worker(self):
+    @mock.patch('source.notification_pusher.get_session_pool')
+    def test_notification_worker(self, get_session_pool_m):
         test_task_data = {
             'f1': 1,
             'f2': 2,
@@ -53,9 +54,12 @@ class NotificationPusherTestCase(unittest.TestCase):
         self.assertEqual(len(m_calls), 1)
         self.assertEqual(m_calls[0][0], 'put')
         self.assertEqual(m_calls[0][1], ((test_task, 'ack'),))
+        self.assertEqual(get_session_pool_m.return_value.post.call_args[0][0], 'test_url')
 
     @mock.patch('source.notification_pusher.current_thread', mock.Mock())
-    @mock.patch('source.notification_pusher.requests.post', mock.Mock(side_effect=[requests.RequestException()]))
+    @mock.patch('source.notification_pusher.get_session_pool', mock.Mock(return_value=mock.Mock(
+        post=mock.Mock(side_effect=[requests.RequestException()])
+    )))
     def test_notification_worker_fail(self):
         test_task_data = {
             'f1': 1,
@@ -72,6 +76,22 @@ class NotificationPusherTestCase(unittest.TestCase):
         self.assertEqual(m_calls[0][0], 'put')
         self.assertEqual(m_calls[0][1], ((test_task, 'bury'),))
 
+    @mock.patch('source.notification_pusher.get_callback_lanes', mock.Mock(return_value=mock.Mock(
+        host_stats=mock.Mock(return_value={})
+    )))
+    @mock.patch('source.notification_pusher.get_session_pool')
+    def test_report_session_stats(self, get_session_pool_m):
+        get_session_pool_m.return_value.stats = {'created': 1, 'evicted': 0, 'requests': 5}
+        get_session_pool_m.return_value.host_stats = mock.Mock(return_value={
+            ('http', 'partner.ru'): {'active': 0, 'connections': 1, 'requests': 5}
+        })
+
+        notification_pusher.report_session_stats()
+
+        notification_pusher.logger.info.assert_called_with(
+            'Callback host [http://partner.ru]: connections=1 requests=5.'
+        )
+
     @mock.patch('source.notification_pusher.stop_handler', mock.Mock())
     @mock.patch('source.notification_pusher.gevent.signal')
     def test_install_signal_handlers(self, signal_m):
@@ -105,32 +125,36 @@ class NotificationPusherTestCase(unittest.TestCase):
                                  notification_pusher.SIGNAL_EXIT_CODE_OFFSET + sig,
                                  'Wrong exit_code')
 
-    def test_done_with_processed_tasks(self):
+    @mock.patch('source.notification_pusher.utils.settle_many')
+    def test_done_with_processed_tasks(self, settle_many_m):
         queue_m = mock.Mock()
-        task = mock.Mock()
-        queue_m.get_nowait = mock.Mock(return_value=(task, 'test_method'))
-        queue_m.qsize = mock.Mock(return_value=1)
+        task1, task2 = mock.Mock(task_id=1), mock.Mock(task_id=2)
+        queue_m.get_nowait = mock.Mock(side_effect=[(task1, 'ack'), (task2, 'bury')])
+        queue_m.qsize = mock.Mock(return_value=2)
+        settle_many_m.return_value = {1, 2}
 
-        notification_pusher.done_with_processed_tasks(queue_m)
+        notification_pusher.done_with_processed_tasks('tube', queue_m)
 
-        self.assertTrue(task.test_method.called, "task's method not called")
+        settle_many_m.assert_called_once_with('tube', [(task1, 'ack'), (task2, 'bury')])
 
-    def test_done_with_processed_tasks_db_exception_handling(self):
+    @mock.patch('source.notification_pusher.utils.settle_many')
+    def test_done_with_processed_tasks_db_exception_handling(self, settle_many_m):
         queue_m = mock.Mock()
         task = mock.Mock()
-        queue_m.get_nowait = mock.Mock(return_value=(task, 'test_method'))
+        queue_m.get_nowait = mock.Mock(return_value=(task, 'ack'))
         queue_m.qsize = mock.Mock(return_value=1)
 
         import tarantool
 
-        task.test_method = mock.Mock(side_effect=tarantool.DatabaseError())
+        settle_many_m.side_effect = tarantool.DatabaseError()
 
         try:
-            notification_pusher.done_with_processed_tasks(queue_m)
+            notification_pusher.done_with_processed_tasks('tube', queue_m)
         except tarantool.DatabaseError:
             self.fail('tarantool.DatabaseError raised from notification_pusher')
 
-    def test_done_with_processed_tasks_queue_empty(self):
+    @mock.patch('source.notification_pusher.utils.settle_many')
+    def test_done_with_processed_tasks_queue_empty(self, settle_many_m):
         from gevent import queue as gevent_queue
 
         queue_m = mock.Mock()
@@ -138,9 +162,73 @@ class NotificationPusherTestCase(unittest.TestCase):
         queue_m.qsize = mock.Mock(return_value=1)
 
         try:
-            notification_pusher.done_with_processed_tasks(queue_m)
+            notification_pusher.done_with_processed_tasks('tube', queue_m)
         except gevent_queue.Empty:
             self.fail('gevent_queue.Empty raised from notification_pusher')
+        self.assertFalse(settle_many_m.called)
+
+    @mock.patch('source.notification_pusher.logger')
+    @mock.patch('source.notification_pusher.utils.settle_many')
+    def test_settle_processed_tasks_reports_failed(self, settle_many_m, logger_m):
+        task1, task2 = mock.Mock(task_id=1), mock.Mock(task_id=2)
+        settle_many_m.return_value = {1}
+        queue_lock = mock.MagicMock()
+
+        notification_pusher.settle_processed_tasks('tube', [(task1, 'ack'), (task2, 'bury')], queue_lock)
+
+        self.assertTrue(queue_lock.__enter__.called, 'settle without queue lock')
+        self.assertEqual(logger_m.warning.call_count, 1)
+        self.assertIn('task#2', logger_m.warning.call_args[0][0])
+
+    def test_collect_processed_tasks_batch_size(self):
+        from gevent import queue as gevent_queue
+
+        task_queue = gevent_queue.Queue()
+        for number in xrange(5):
+            task_queue.put((number, 'ack'))
+
+        settlements = notification_pusher.collect_processed_tasks(task_queue, 3, 10)
+
+        self.assertEqual(settlements, [(0, 'ack'), (1, 'ack'), (2, 'ack')])
+        self.assertEqual(task_queue.qsize(), 2)
+
+    def test_collect_processed_tasks_flush_interval(self):
+        from gevent import queue as gevent_queue
+
+        task_queue = gevent_queue.Queue()
+        task_queue.put((0, 'ack'))
+        gevent.spawn_later(0.2, task_queue.put, (1, 'ack'))
+
+        settlements = notification_pusher.collect_processed_tasks(task_queue, 3, 0.05)
+
+        self.assertEqual(settlements, [(0, 'ack')])
+
+    def test_collect_processed_tasks_empty(self):
+        from gevent import queue as gevent_queue
+
+        self.assertEqual(notification_pusher.collect_processed_tasks(gevent_queue.Queue(), 3, 0.01), [])
+
+    @mock.patch('source.notification_pusher.current_thread', mock.Mock())
+    @mock.patch('source.notification_pusher.settle_processed_tasks')
+    @mock.patch('source.notification_pusher.collect_processed_tasks')
+    def test_ack_processed_tasks(self, collect_m, settle_m):
+        config = Config()
+        config.ACK_BATCH_SIZE = 10
+        config.ACK_FLUSH_INTERVAL = 0.5
+        settlements = [('task', 'ack')]
+
+        def collect(*args):
+            if collect_m.call_count == 2:
+                break_run()
+                return []
+            return settlements
+        collect_m.side_effect = collect
+
+        with mock.patch('source.notification_pusher.run_application', True):
+            notification_pusher.ack_processed_tasks(config, 'tube', 'queue', 'lock')
+
+        collect_m.assert_called_with('queue', 10, 0.5)
+        settle_m.assert_called_once_with('tube', settlements, 'lock')
 
     @mock.patch('source.notification_pusher.Greenlet', mock.MagicMock())
     @mock.patch('source.lib.utils.Config')
@@ -156,8 +244,16 @@ class NotificationPusherTestCase(unittest.TestCase):
     @mock.patch('source.notification_pusher.gevent_queue.Queue')
     @mock.patch('source.notification_pusher.Pool')
     @mock.patch('source.notification_pusher.tarantool_queue.Queue')
-    def test_configure_infrastructure(self, Queue, Pool, GQueue):
+    @mock.patch('source.notification_pusher.init_session_pool')
+    @mock.patch('source.notification_pusher.init_callback_lanes')
+    def test_configure_infrastructure(self, init_callback_lanes_m, init_session_pool_m, Queue, Pool, GQueue):
         config = Config()
+        config.CALLBACK_MAX_CONNECTIONS = 5
+        config.CALLBACK_IDLE_TIMEOUT = 30
+        config.CALLBACK_HOST_QUOTA = 4
+        config.CALLBACK_SLOW_HOST_QUOTA = 1
+        config.CALLBACK_SLOW_LANE_SIZE = 2
+        config.CALLBACK_SLOW_LATENCY = 3
         config.QUEUE_HOST = 'test'
         config.QUEUE_PORT = 8888
         config.QUEUE_SPACE = 'space'
@@ -174,6 +270,8 @@ class NotificationPusherTestCase(unittest.TestCase):
 
         Pool.assert_called_with(config.WORKER_POOL_SIZE)
         GQueue.assert_called_with()
+        init_session_pool_m.assert_called_once_with(5, 30)
+        init_callback_lanes_m.assert_called_once_with(4, 1, 2, 3)
 
     @mock.patch('source.lib.utils.Config')
     @mock.patch('gevent.queue.Queue')
@@ -181,12 +279,19 @@ class NotificationPusherTestCase(unittest.TestCase):
     @mock.patch('gevent.pool.Pool')
     @mock.patch('source.notification_pusher.start_worker_with_task')
     @mock.patch('source.notification_pusher.done_with_processed_tasks', mock.Mock())
-    def test_start_workers(self, start_worker_with_task_m, worker_pool, tube, processed_task_queue, config):
+    @mock.patch('source.notification_pusher.get_callback_lanes', mock.Mock())
+    @mock.patch('source.lib.utils.take_many')
+    def test_start_workers(self, take_many_m, start_worker_with_task_m, worker_pool, tube, processed_task_queue,
+                           config):
         free_workers_count = 10
         worker_pool.free_count = mock.Mock(return_value=free_workers_count)
+        take_many_m.return_value = [
+            mock.Mock(data={'callback_url': 'http://partner.ru/'}) for _ in xrange(free_workers_count)
+        ]
 
         notification_pusher.start_workers(config, processed_task_queue, tube, worker_pool)
 
+        take_many_m.assert_called_once_with(tube, free_workers_count, config.QUEUE_TAKE_TIMEOUT)
         self.assertEquals(start_worker_with_task_m.call_count,
                           free_workers_count,
                           'Not enough workers have been created')
@@ -197,31 +302,279 @@ class NotificationPusherTestCase(unittest.TestCase):
     @mock.patch('gevent.pool.Pool')
     @mock.patch('source.notification_pusher.start_worker_with_task')
     @mock.patch('source.notification_pusher.done_with_processed_tasks', mock.Mock())
+    @mock.patch('source.lib.utils.take_many', mock.Mock(return_value=[]))
     def test_start_workers_task_is_none(self, start_worker_with_task_m, worker_pool, tube, processed_task_queue,
                                         config):
         free_workers_count = 5
 
-        tube.take = mock.Mock(return_value=None)
         worker_pool.free_count = mock.Mock(return_value=free_workers_count)
 
         notification_pusher.start_workers(config, processed_task_queue, tube, worker_pool)
 
         self.assertEquals(start_worker_with_task_m.call_count, 0, 'Should not have created workers')
 
-    @mock.patch('source.notification_pusher.configure_infrastructure', mock.Mock(return_value=(1, 1, 1)))
+    @mock.patch('source.notification_pusher.configure_infrastructure')
     @mock.patch('source.notification_pusher.run_application', mock.Mock())
-    def test_main_loop(self):
+    @mock.patch('source.notification_pusher.gevent.spawn')
+    def test_main_loop(self, spawn_m, configure_infrastructure_m):
         config = Config()
         config.SLEEP = 42
+        config.HTTP_CONNECTION_TIMEOUT = 5
+        worker_pool = mock.Mock()
+        configure_infrastructure_m.return_value = (1, 2, worker_pool, 4)
+        spawn_m.return_value.ready = mock.Mock(return_value=False)
+        calls = mock.Mock()
+        calls.attach_mock(spawn_m.return_value.join, 'join')
+        calls.attach_mock(worker_pool.join, 'pool_join')
+
+        with mock.patch('source.notification_pusher.run_application', True):
+            with mock.patch('source.notification_pusher.done_with_processed_tasks') as done_m:
+                with mock.patch('source.notification_pusher.report_session_stats', mock.Mock()):
+                    with mock.patch('source.notification_pusher.sleep',
+                                    mock.Mock(side_effect=break_run)) as main_loop_sleep:
+                        notification_pusher.main_loop(config)
+
+                        done_m.assert_called_once_with(2, 1, 4)
+                        main_loop_sleep.assert_called_once_with(config.SLEEP)
+        spawn_m.assert_any_call(notification_pusher.feed_workers, config, 1, 2, worker_pool, 4)
+        spawn_m.assert_any_call(notification_pusher.ack_processed_tasks, config, 2, 1, 4)
+        self.assertEqual(calls.mock_calls, [
+            mock.call.join(timeout=5), mock.call.pool_join(timeout=5), mock.call.join()
+        ], 'send workers not waited before acker on stop')
+        self.assertTrue(spawn_m.return_value.kill.called, 'feeder not stopped with main loop')
+
+    @mock.patch('source.notification_pusher.configure_infrastructure', mock.Mock(return_value=(1, 2, 3, 4)))
+    @mock.patch('source.notification_pusher.gevent.spawn')
+    def test_main_loop_feeder_error(self, spawn_m):
+        spawn_m.return_value.ready = mock.Mock(return_value=True)
+        spawn_m.return_value.get = mock.Mock(side_effect=ValueError)
 
         with mock.patch('source.notification_pusher.run_application', True):
-            with mock.patch('source.notification_pusher.start_workers', mock.MagicMock()) as main_loop_iter:
-                with mock.patch('source.notification_pusher.sleep', mock.Mock(side_effect=break_run)) as main_loop_sleep:
-                    notification_pusher.main_loop(config)
+            self.assertRaises(ValueError, notification_pusher.main_loop, Config())
+        self.assertTrue(spawn_m.return_value.kill.called)
+
+    @mock.patch('source.notification_pusher.start_workers')
+    @mock.patch('source.notification_pusher.current_thread', mock.Mock())
+    def test_feed_workers(self, start_workers_m):
+        start_workers_m.side_effect = break_run
+
+        with mock.patch('source.notification_pusher.run_application', True):
+            notification_pusher.feed_workers('config', 'queue', 'tube', 'pool', 'lock')
+
+        start_workers_m.assert_called_once_with('config', 'queue', 'tube', 'pool', 'lock', {})
+
+    @mock.patch('source.notification_pusher.release_batches')
+    @mock.patch('source.notification_pusher.current_thread', mock.Mock())
+    def test_feed_workers_releases_batches_on_stop(self, release_batches_m):
+        def start_workers(config, queue, tube, pool, lock, batches):
+            batches['url'] = (['task'], 'timer')
+            break_run()
+
+        with mock.patch('source.notification_pusher.start_workers', start_workers):
+            with mock.patch('source.notification_pusher.run_application', True):
+                notification_pusher.feed_workers('config', 'queue', 'tube', 'pool', 'lock')
+
+        release_batches_m.assert_called_once_with({'url': (['task'], 'timer')}, 'lock')
+
+    @mock.patch('source.notification_pusher.release_batches')
+    @mock.patch('source.notification_pusher.current_thread', mock.Mock())
+    def test_feed_workers_releases_batches_when_killed(self, release_batches_m):
+        def start_workers(config, queue, tube, pool, lock, batches):
+            batches['url'] = (['task'], 'timer')
+            raise gevent.GreenletExit
+
+        with mock.patch('source.notification_pusher.start_workers', start_workers):
+            with mock.patch('source.notification_pusher.run_application', True):
+                self.assertRaises(gevent.GreenletExit, notification_pusher.feed_workers,
+                                  'config', 'queue', 'tube', 'pool', 'lock')
+
+        release_batches_m.assert_called_once_with({'url': (['task'], 'timer')}, 'lock')
+
+    def test_release_batches(self):
+        import tarantool
+
+        task1, task2 = mock.Mock(), mock.Mock()
+        task1.release.side_effect = tarantool.DatabaseError
+        timer = mock.Mock()
+        batches = {'url': ([task1, task2], timer)}
+        queue_lock = mock.MagicMock()
+
+        notification_pusher.release_batches(batches, queue_lock)
+
+        self.assertEqual(batches, {})
+        timer.kill.assert_called_once_with()
+        task1.release.assert_called_once_with()
+        task2.release.assert_called_once_with()
+        self.assertEqual(queue_lock.__enter__.call_count, 2)
+
+    @mock.patch('source.notification_pusher.gevent.spawn_later')
+    @mock.patch('source.notification_pusher.start_batch_worker')
+    def test_add_task_to_batch(self, start_batch_worker_m, spawn_later_m):
+        config = Config()
+        config.CALLBACK_BATCH_HOSTS = {'batch.example.com': (2, 0.5)}
+        batches = {}
+        url = 'http://Batch.example.com/callback'
+        task1, task2 = mock.Mock(data=None), mock.Mock(data=None)
+
+        self.assertTrue(notification_pusher.add_task_to_batch(config, 'queue', task1, url, 'pool', batches))
+        spawn_later_m.assert_called_once_with(
+            0.5, start_batch_worker_m, config, 'queue', 'pool', batches, url, [task1]
+        )
+        self.assertEqual(batches, {url: ([task1], spawn_later_m.return_value)})
+        self.assertFalse(start_batch_worker_m.called)
+
+        self.assertTrue(notification_pusher.add_task_to_batch(config, 'queue', task2, url, 'pool', batches))
+        start_batch_worker_m.assert_called_once_with(config, 'queue', 'pool', batches, url, [task1, task2])
+
+    def test_add_task_to_batch_other_host(self):
+        config = Config()
+        config.CALLBACK_BATCH_HOSTS = {'batch.example.com': (2, 0.5)}
+        batches = {}
+
+        self.assertFalse(notification_pusher.add_task_to_batch(
+            config, 'queue', mock.Mock(), 'http://other.example.com/', 'pool', batches
+        ))
+        self.assertEqual(batches, {})
+
+    @mock.patch('source.notification_pusher.Greenlet')
+    def test_start_batch_worker(self, greenlet_m):
+        config = Config()
+        config.HTTP_CONNECTION_TIMEOUT = 5
+        worker_pool = mock.Mock()
+        batch = ['task']
+        batches = {'url': (batch, mock.Mock())}
+
+        notification_pusher.start_batch_worker(config, 'queue', worker_pool, batches, 'url', batch)
+        notification_pusher.start_batch_worker(config, 'queue', worker_pool, batches, 'url', batch)
+
+        self.assertEqual(batches, {})
+        greenlet_m.assert_called_once_with(
+            notification_pusher.notification_batch_worker, batch, 'queue', timeout=5, verify=False
+        )
+        worker_pool.add.assert_called_once_with(greenlet_m.return_value)
+
+    @mock.patch('source.notification_pusher.current_thread', mock.Mock())
+    @mock.patch('source.notification_pusher.get_session_pool')
+    def test_notification_batch_worker(self, get_session_pool_m):
+        tasks = [TestTask(1, {'f': 1, 'callback_url': 'test_url'}), TestTask(2, {'f': 2, 'callback_url': 'test_url'})]
+        get_session_pool_m.return_value.post.return_value.json.return_value = [True, False]
+        task_queue = mock.Mock()
+
+        notification_pusher.notification_batch_worker(tasks, task_queue)
+
+        url, = get_session_pool_m.return_value.post.call_args[0]
+        self.assertEqual(url, 'test_url')
+        self.assertEqual(
+            json.loads(get_session_pool_m.return_value.post.call_args[1]['data']),
+            [{'f': 1, 'id': 1}, {'f': 2, 'id': 2}]
+        )
+        self.assertEqual(task_queue.put.call_args_list, [mock.call((tasks[0], 'ack')), mock.call((tasks[1], 'bury'))])
+
+    @mock.patch('source.notification_pusher.current_thread', mock.Mock())
+    @mock.patch('source.notification_pusher.get_session_pool', mock.Mock(return_value=mock.Mock(
+        post=mock.Mock(side_effect=[requests.RequestException()])
+    )))
+    def test_notification_batch_worker_fail(self):
+        tasks = [TestTask(1, {'callback_url': 'test_url'}), TestTask(2, {'callback_url': 'test_url'})]
+        task_queue = mock.Mock()
+
+        notification_pusher.notification_batch_worker(tasks, task_queue)
+
+        self.assertEqual(task_queue.put.call_args_list, [mock.call((tasks[0], 'bury')), mock.call((tasks[1], 'bury'))])
+
+    def test_get_batch_results_without_per_task_answer(self):
+        response = mock.Mock()
+        response.json.side_effect = ValueError
+
+        self.assertEqual(notification_pusher.get_batch_results(response, 2), [True, True])
+
+        response.json.side_effect = None
+        response.json.return_value = [False]
+        self.assertEqual(notification_pusher.get_batch_results(response, 2), [True, True])
+
+    @mock.patch('source.notification_pusher.get_callback_lanes')
+    @mock.patch('source.notification_pusher.defer_task')
+    @mock.patch('source.notification_pusher.start_worker_with_task')
+    @mock.patch('source.lib.utils.take_many')
+    def test_start_workers_defers_saturated_host(self, take_many_m, start_worker_with_task_m, defer_task_m,
+                                                 get_callback_lanes_m):
+        config = mock.Mock()
+        task1 = mock.Mock(data={'callback_url': 'http://fast.ru/'})
+        task2 = mock.Mock(data={'callback_url': 'http://slow.ru/'})
+        take_many_m.return_value = [task1, task2]
+        get_callback_lanes_m.return_value.enter = mock.Mock(side_effect=lambda url: url == 'http://fast.ru/')
+
+        queue_lock = mock.MagicMock()
+
+        notification_pusher.start_workers(config, 'queue', 'tube', mock.Mock(), queue_lock)
+
+        start_worker_with_task_m.assert_called_once_with(config, 'queue', task1, mock.ANY)
+        defer_task_m.assert_called_once_with(config, task2, queue_lock)
+
+    @mock.patch('source.notification_pusher.get_callback_lanes')
+    @mock.patch('source.notification_pusher.start_worker_with_task')
+    @mock.patch('source.lib.utils.take_many')
+    def test_start_workers_buries_task_without_callback_url(self, take_many_m, start_worker_with_task_m,
+                                                           get_callback_lanes_m):
+        tasks = [
+            mock.Mock(data={'f': 1}), mock.Mock(data=None), mock.Mock(data={'callback_url': 'partner.ru/cb'})
+        ]
+        take_many_m.return_value = tasks
+        processed_task_queue = mock.Mock()
+
+        notification_pusher.start_workers(mock.Mock(), processed_task_queue, 'tube', mock.Mock(), mock.MagicMock())
+
+        self.assertFalse(start_worker_with_task_m.called)
+        self.assertFalse(get_callback_lanes_m.return_value.enter.called)
+        self.assertEqual(processed_task_queue.put.call_args_list, [mock.call((task, 'bury')) for task in tasks])
+
+    def test_defer_task(self):
+        config = Config()
+        config.CALLBACK_DEFER_DELAY = 7
+        task = mock.Mock()
+        queue_lock = mock.MagicMock()
+
+        notification_pusher.defer_task(config, task, queue_lock)
+
+        task.release.assert_called_once_with(delay=7)
+        self.assertTrue(queue_lock.__enter__.called, 'release without queue lock')
+
+    def test_defer_task_db_exception_handling(self):
+        import tarantool
+
+        config = Config()
+        config.CALLBACK_DEFER_DELAY = 7
+        task = mock.Mock()
+        task.release.side_effect = tarantool.DatabaseError()
+
+        try:
+            notification_pusher.defer_task(config, task)
+        except tarantool.DatabaseError:
+            self.fail('tarantool.DatabaseError raised from notification_pusher')
+
+    @mock.patch('source.notification_pusher.current_thread', mock.Mock())
+    @mock.patch('source.notification_pusher.get_callback_lanes')
+    @mock.patch('source.notification_pusher.get_session_pool', mock.Mock(return_value=mock.Mock(
+        post=mock.Mock(side_effect=[requests.RequestException()])
+    )))
+    def test_notification_worker_leaves_lane(self, get_callback_lanes_m):
+        test_task = TestTask(42, {'callback_url': 'http://partner.ru/'})
+
+        notification_pusher.notification_worker(test_task, mock.Mock())
+
+        url, latency = get_callback_lanes_m.return_value.leave.call_args[0]
+        self.assertEqual(url, 'http://partner.ru/')
+        self.assertGreaterEqual(latency, 0)
+
+    @mock.patch('source.lib.utils.take_many', mock.Mock(return_value=[]))
+    def test_start_workers_waits_for_free_worker(self):
+        worker_pool = mock.Mock()
+        queue_lock = mock.MagicMock()
+
+        notification_pusher.start_workers(mock.Mock(), mock.Mock(), mock.Mock(), worker_pool, queue_lock)
 
-                    self.assertTrue(main_loop_iter.called)
-                    self.assertEqual(main_loop_iter.call_count, 1)
-                    main_loop_sleep.assert_called_once_with(config.SLEEP)
+        self.assertTrue(worker_pool.wait_available.called)
+        self.assertTrue(queue_lock.__enter__.called, 'take without queue lock')
 
     @mock.patch('source.notification_pusher.utils.parse_cmd_args', mock.Mock())
     @mock.patch('source.notification_pusher.dictConfig', mock.Mock())
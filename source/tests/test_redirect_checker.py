@@ -59,6 +59,13 @@ class RedirectCheckerTestCase(unittest.TestCase):
 
         self.assertEqual(spawn_workers_m.called, False)
 
+    @mock.patch('source.redirect_checker.cpu_count', mock.Mock(return_value=8))
+    def test_get_worker_pool_size_per_core(self):
+        config = Config()
+        config.WORKER_POOL_SIZE = None
+
+        self.assertEqual(redirect_checker.get_worker_pool_size(config), 8)
+
     @mock.patch('source.redirect_checker.worker', mock.Mock())
     @mock.patch('source.lib.utils.check_network_status', mock.Mock(return_value=False))
     def test_main_loop_iteration_no_network_access(self):
@@ -86,6 +93,12 @@ class RedirectCheckerTestCase(unittest.TestCase):
     def test_main_loop(self):
         config = mock.Mock()
         config.SLEEP = 42
+        config.WORKER_PREFORK = False
+        config.NETWORK_CHECK_URLS = None
+        config.WORKER_AUTOSCALE = False
+        config.WORKER_POOL_SIZE = 8
+        config.RECHECK_WORKER_POOL_SIZE = 2
+        config.HOST_MAX_CONCURRENCY, config.HOST_MAX_RATE = 40, 100
 
         def break_run(*args, **kwargs):
             redirect_checker.run_application = False
@@ -96,6 +109,191 @@ class RedirectCheckerTestCase(unittest.TestCase):
         self.assertTrue(main_loop_iter.called)
         self.assertEqual(main_loop_iter.call_count, 1)
         main_loop_sleep.assert_called_once_with(config.SLEEP)
+        recheck_config = main_loop_iter.call_args[0][6]
+        for lane_config in (config, recheck_config):
+            self.assertEqual((lane_config.WORKER_HOST_MAX_CONCURRENCY, lane_config.WORKER_HOST_MAX_RATE), (4, 10.0))
+
+    @mock.patch('os.getpid', mock.Mock(return_value=24))
+    @mock.patch('source.redirect_checker.run_application', mock.Mock())
+    @mock.patch('source.redirect_checker.signal')
+    @mock.patch('source.redirect_checker.prefork_worker')
+    def test_main_loop_prefork(self, prefork_worker_m, signal_m):
+        config = mock.Mock()
+        config.WORKER_PREFORK = True
+        config.NETWORK_CHECK_URLS = None
+        config.WORKER_AUTOSCALE = False
+        config.WORKER_POOL_SIZE = 8
+        config.RECHECK_WORKER_POOL_SIZE = 2
+        config.HOST_MAX_CONCURRENCY, config.HOST_MAX_RATE = 40, 100
+
+        def break_run(*args, **kwargs):
+            redirect_checker.run_application = False
+
+        with mock.patch('source.redirect_checker.main_loop_iteration') as main_loop_iter:
+            with mock.patch('source.redirect_checker.sleep', mock.Mock(side_effect=break_run)):
+                redirect_checker.main_loop(config)
+
+        prefork_worker_m.assert_called_once_with(config)
+        signal_m.signal.assert_called_once_with(signal_m.SIGCHLD, redirect_checker.handle_sigchld)
+        self.assertEqual(main_loop_iter.call_args[0][2], {})
+        self.assertIsNotNone(main_loop_iter.call_args[0][3])
+
+    @mock.patch('source.redirect_checker.utils.check_network_status', mock.Mock(return_value=True))
+    @mock.patch('source.redirect_checker.worker', mock.Mock())
+    @mock.patch('source.redirect_checker.report_ready_workers')
+    @mock.patch('source.redirect_checker.time', mock.Mock(return_value=100))
+    @mock.patch('source.lib.utils.spawn_workers')
+    def test_main_loop_iteration_records_spawn_times(self, spawn_workers_m, report_ready_workers_m):
+        config = Config()
+        config.CHECK_URL = 'test_url'
+        config.HTTP_TIMEOUT = 10
+        config.WORKER_POOL_SIZE = 2
+        spawn_workers_m.return_value = [mock.Mock(pid=1), mock.Mock(pid=2)]
+        spawn_times, ready_queue = {}, mock.Mock()
+
+        with mock.patch('source.redirect_checker.active_children', lambda: MyActiveChildren(0)):
+            redirect_checker.main_loop_iteration(config, 42, spawn_times, ready_queue)
+
+        self.assertEqual(spawn_workers_m.call_args[1]['kwargs'], {'ready_queue': ready_queue})
+        self.assertEqual(spawn_times, {1: 100, 2: 100})
+        report_ready_workers_m.assert_called_once_with(ready_queue, spawn_times)
+
+    @mock.patch('source.redirect_checker.utils.check_network_status')
+    @mock.patch('source.redirect_checker.worker', mock.Mock())
+    @mock.patch('source.lib.utils.spawn_workers')
+    def test_main_loop_iteration_health_down_keeps_workers(self, spawn_workers_m, check_network_status_m):
+        config = Config()
+        config.WORKER_POOL_SIZE = 10
+        health = mock.Mock()
+        health.is_up = mock.Mock(return_value=False)
+        children = [mock.Mock()]
+
+        with mock.patch('source.redirect_checker.active_children', lambda: children):
+            redirect_checker.main_loop_iteration(config, 42, health=health)
+
+        health.ensure_running.assert_called_once_with(42)
+        self.assertFalse(check_network_status_m.called)
+        self.assertFalse(spawn_workers_m.called)
+        self.assertFalse(children[0].terminate.called)
+
+    @mock.patch('source.redirect_checker.worker', mock.Mock())
+    @mock.patch('source.lib.utils.spawn_workers')
+    def test_main_loop_iteration_health_up_passes_event(self, spawn_workers_m):
+        config = Config()
+        config.WORKER_POOL_SIZE = 2
+        health = mock.Mock()
+        health.is_up = mock.Mock(return_value=True)
+        health_process = mock.Mock()
+        health_process.name = redirect_checker.HEALTH_PROCESS_NAME
+
+        with mock.patch('source.redirect_checker.active_children', lambda: [health_process, mock.Mock()]):
+            redirect_checker.main_loop_iteration(config, 42, health=health)
+
+        self.assertEqual(spawn_workers_m.call_args[1]['num'], 1)
+        self.assertEqual(spawn_workers_m.call_args[1]['kwargs'], {'network_up': health.up})
+
+    @mock.patch('source.redirect_checker.utils.check_network_status', mock.Mock(return_value=True))
+    @mock.patch('source.redirect_checker.worker', mock.Mock())
+    @mock.patch('source.redirect_checker.os.kill')
+    @mock.patch('source.lib.utils.spawn_workers')
+    def test_main_loop_iteration_autoscaler_stops_extra_workers(self, spawn_workers_m, kill_m):
+        autoscaler = mock.Mock()
+        autoscaler.refresh = mock.Mock(return_value=2)
+        stopping = {3, 100}
+        children = [mock.Mock(pid=pid) for pid in (1, 2, 3, 4, 5)]
+
+        with mock.patch('source.redirect_checker.active_children', lambda: children):
+            redirect_checker.main_loop_iteration(mock.Mock(), 42, autoscaler=autoscaler, stopping=stopping)
+
+        self.assertFalse(spawn_workers_m.called)
+        self.assertEqual(kill_m.call_args_list, [
+            mock.call(4, redirect_checker.WORKER_STOP_SIGNAL), mock.call(5, redirect_checker.WORKER_STOP_SIGNAL)
+        ])
+        self.assertEqual(stopping, {3, 4, 5})
+
+    @mock.patch('source.redirect_checker.utils.check_network_status', mock.Mock(return_value=True))
+    @mock.patch('source.redirect_checker.worker', mock.Mock())
+    @mock.patch('source.redirect_checker.os.kill')
+    @mock.patch('source.lib.utils.spawn_workers')
+    def test_main_loop_iteration_stops_extra_workers_without_autoscaler(self, spawn_workers_m, kill_m):
+        config = Config()
+        config.CHECK_URL = 'test_url'
+        config.HTTP_TIMEOUT = 10
+        config.WORKER_POOL_SIZE = 2
+        stopping = set()
+        children = [mock.Mock(pid=pid) for pid in (1, 2, 3)]
+
+        with mock.patch('source.redirect_checker.active_children', lambda: children):
+            redirect_checker.main_loop_iteration(config, 42, stopping=stopping)
+            redirect_checker.main_loop_iteration(config, 42, stopping=stopping)
+
+        self.assertFalse(spawn_workers_m.called)
+        kill_m.assert_called_once_with(3, redirect_checker.WORKER_STOP_SIGNAL)
+        self.assertEqual(stopping, {3})
+
+    @mock.patch('source.redirect_checker.utils.check_network_status', mock.Mock(return_value=True))
+    @mock.patch('source.redirect_checker.worker', mock.Mock())
+    @mock.patch('source.lib.utils.spawn_workers')
+    def test_main_loop_iteration_autoscaler_grows_pool(self, spawn_workers_m):
+        autoscaler = mock.Mock()
+        autoscaler.refresh = mock.Mock(return_value=5)
+        children = [mock.Mock(pid=pid) for pid in (1, 2)]
+
+        with mock.patch('source.redirect_checker.active_children', lambda: children):
+            redirect_checker.main_loop_iteration(mock.Mock(), 42, autoscaler=autoscaler, stopping={2})
+
+        self.assertEqual(spawn_workers_m.call_args[1]['num'], 4)
+
+    @mock.patch('source.redirect_checker.utils.check_network_status', mock.Mock(return_value=True))
+    @mock.patch('source.redirect_checker.worker', mock.Mock())
+    @mock.patch('source.redirect_checker.report_lanes')
+    @mock.patch('source.lib.utils.spawn_workers')
+    def test_main_loop_iteration_spawns_recheck_workers(self, spawn_workers_m, report_lanes_m):
+        config = Config()
+        config.CHECK_URL = 'test_url'
+        config.HTTP_TIMEOUT = 10
+        config.WORKER_POOL_SIZE = 2
+        recheck_config = Config()
+        recheck_config.WORKER_POOL_SIZE = 3
+        recheck_worker = mock.Mock()
+        recheck_worker.name = redirect_checker.RECHECK_WORKER_NAME
+        children = [mock.Mock(), mock.Mock(), recheck_worker]
+
+        with mock.patch('source.redirect_checker.active_children', lambda: children):
+            redirect_checker.main_loop_iteration(config, 42, recheck_config=recheck_config)
+
+        self.assertEqual(spawn_workers_m.call_count, 1)
+        self.assertEqual(spawn_workers_m.call_args[1]['num'], 2)
+        self.assertEqual(spawn_workers_m.call_args[1]['args'], (recheck_config,))
+        self.assertEqual(spawn_workers_m.call_args[1]['name'], redirect_checker.RECHECK_WORKER_NAME)
+        report_lanes_m.assert_called_once_with(config, recheck_config)
+
+    @mock.patch('source.redirect_checker.utils.get_tube')
+    def test_report_lanes(self, get_tube_m):
+        get_tube_m.return_value.statistics = mock.Mock(return_value={'tasks': {'ready': '5', 'delayed': '7'}})
+        config, recheck_config = mock.Mock(), mock.Mock()
+
+        with mock.patch('source.redirect_checker.active_children', lambda: [mock.Mock()]):
+            redirect_checker.report_lanes(config, recheck_config)
+
+        self.assertEqual(redirect_checker.logger.info.call_args_list, [
+            mock.call(u'Lane fresh: workers=1 ready=5 delayed=7 taken=0'),
+            mock.call(u'Lane recheck: workers=0 ready=5 delayed=7 taken=0'),
+        ])
+        self.assertEqual(get_tube_m.call_args[0][3], recheck_config.INPUT_QUEUE_TUBE)
+
+    @mock.patch('source.redirect_checker.utils.get_process_memory', mock.Mock(return_value=(2048 * 1024, 1024 * 1024)))
+    def test_report_ready_workers(self):
+        ready_queue = mock.Mock()
+        ready_queue.empty = mock.Mock(side_effect=[False, True])
+        ready_queue.get = mock.Mock(return_value=(1, 101.5))
+        spawn_times = {1: 100, 2: 100, 3: 100}
+
+        with mock.patch('source.redirect_checker.active_children', lambda: [mock.Mock(pid=2)]):
+            redirect_checker.report_ready_workers(ready_queue, spawn_times)
+
+        self.assertEqual(spawn_times, {2: 100})
+        redirect_checker.logger.info.assert_called_once_with(u'Worker pid=1 ready in 1.500s. rss=2048KB shared=1024KB')
 
     @mock.patch('source.redirect_checker.utils.parse_cmd_args', mock.Mock())
     @mock.patch('source.redirect_checker.main_loop')